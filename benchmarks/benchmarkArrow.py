@@ -0,0 +1,72 @@
+"""
+Benchmark comparing ways of reading the results of a CatalogDBObject query
+as pyarrow RecordBatches:  converting each recarray returned by query_columns
+into Arrow (the old path), and query_columns(..., output='arrow'), with the
+batches built from the rows of the DB-API cursor or (if adbc_driver_sqlite
+is installed) read by ADBC.  Needs pyarrow.
+
+usage: python benchmarkArrow.py --n_rows 1000000 --chunk_size 100000
+"""
+from __future__ import print_function
+import argparse
+import os
+import tempfile
+import pyarrow
+
+from lsst.sims.catalogs.db import decode_categorical
+from benchmarkUtils import makeBenchmarkDB, benchmarkStars, timeIt
+
+try:
+    import adbc_driver_sqlite
+    _has_adbc = True
+except ImportError:
+    _has_adbc = False
+
+
+class benchmarkCursorStars(benchmarkStars):
+    useADBC = False
+
+
+def recarrays_to_arrow(dbobj, chunk_size):
+    """
+    Query dbobj for recarrays and copy each of them into a RecordBatch
+    """
+    batches = []
+    for chunk in dbobj.query_columns(chunk_size=chunk_size):
+        names = list(chunk.dtype.names)
+        batches.append(pyarrow.RecordBatch.from_arrays([pyarrow.array(decode_categorical(chunk[name]))
+                                                        for name in names], names=names))
+    return batches
+
+
+def query_arrow(dbobj, chunk_size):
+    """
+    Query dbobj for RecordBatches
+    """
+    return list(dbobj.query_columns(chunk_size=chunk_size, output='arrow'))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=1000000)
+    parser.add_argument('--chunk_size', type=int, default=100000)
+    args = parser.parse_args()
+
+    filename = os.path.join(tempfile.gettempdir(), 'sims_catalogs_arrow_benchmark.db')
+    makeBenchmarkDB(filename, args.n_rows)
+
+    methods = [('recarray', lambda: recarrays_to_arrow(benchmarkStars(database=filename),
+                                                       args.chunk_size)),
+               ('cursor', lambda: query_arrow(benchmarkCursorStars(database=filename),
+                                              args.chunk_size))]
+    if _has_adbc:
+        methods.append(('adbc', lambda: query_arrow(benchmarkStars(database=filename),
+                                                    args.chunk_size)))
+
+    print('%10s %12s %10s' % ('method', 'time (s)', 'rows'))
+    for name, method in methods:
+        t_query, batches = timeIt(method)
+        print('%10s %12.4f %10d' % (name, t_query, sum(batch.num_rows for batch in batches)))
+
+    os.unlink(filename)
@@ -0,0 +1,86 @@
+"""
+Compare the wall-clock time of running many cone-search queries at once
+with query_columns in a pool of threads and with query_columns_async in
+one event loop.  The consumer simulates catalog-writing work by waiting
+for a fixed time per chunk (time.sleep in the threads, asyncio.sleep in
+the event loop), so both approaches can overlap that work with the queries.
+
+Requires aiosqlite.
+
+usage: python benchmarkAsyncQueries.py --n_rows 1000000 --n_pointings 200 --concurrency 8
+"""
+from __future__ import print_function
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from lsst.sims.utils import ObservationMetaData
+from benchmarkUtils import makeBenchmarkDB, benchmarkStars, timeIt
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=1000000)
+    parser.add_argument('--n_pointings', type=int, default=200)
+    parser.add_argument('--radius', type=float, default=2.0,
+                        help='radius of each cone in degrees')
+    parser.add_argument('--chunk_size', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of threads, and async_concurrency')
+    parser.add_argument('--work', type=float, default=0.01,
+                        help='seconds of simulated work per chunk')
+    parser.add_argument('--database', type=str, default=None)
+    args = parser.parse_args()
+
+    database = args.database
+    if database is None:
+        database = os.path.join(tempfile.gettempdir(), 'sims_catalogs_benchmark.db')
+    makeBenchmarkDB(database, args.n_rows)
+
+    rng = np.random.RandomState(42)
+    pointings = [ObservationMetaData(pointingRA=ra, pointingDec=dec,
+                                     boundType='circle', boundLength=args.radius)
+                 for ra, dec in zip(rng.random_sample(args.n_pointings)*360.0,
+                                    rng.random_sample(args.n_pointings)*120.0 - 60.0)]
+    colnames = ['id', 'raJ2000', 'decJ2000', 'sedFilename']
+
+    dbobj = benchmarkStars(database=database)
+    dbobj.async_concurrency = args.concurrency
+
+    def consume_threaded(obs):
+        n_rows = 0
+        for chunk in dbobj.query_columns(colnames=colnames, obs_metadata=obs,
+                                         chunk_size=args.chunk_size):
+            time.sleep(args.work)
+            n_rows += len(chunk)
+        # release this worker thread's session (and its sqlite connection)
+        dbobj.connection.session.remove()
+        return n_rows
+
+    def run_threaded():
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            return sum(executor.map(consume_threaded, pointings))
+
+    async def consume_async(obs):
+        n_rows = 0
+        async for chunk in dbobj.query_columns_async(colnames=colnames, obs_metadata=obs,
+                                                     chunk_size=args.chunk_size):
+            await asyncio.sleep(args.work)
+            n_rows += len(chunk)
+        return n_rows
+
+    async def gather_async():
+        return sum(await asyncio.gather(*[consume_async(obs) for obs in pointings]))
+
+    def run_async():
+        return asyncio.run(gather_async())
+
+    print('%10s %12s %10s %12s' % ('method', 'n_rows', 'time (s)', 'queries/s'))
+    for name, function in (('threads', run_threaded), ('asyncio', run_async)):
+        elapsed, n_rows = timeIt(function)
+        print('%10s %12d %10.3f %12.1f' % (name, n_rows, elapsed, len(pointings)/elapsed))
@@ -0,0 +1,76 @@
+"""
+Microbenchmark comparing three representations of a string column with a
+few hundred distinct values (sedFilename) in the recarrays returned by
+CatalogDBObject:  the old blanket 256 character unicode column, a column
+sized to fit its values (CatalogDBObject.sizeStrings), and a dictionary-encoded
+column (CatalogDBObject.categoricalColumns).  For each, the size of a chunk,
+the time to convert the rows into it, and the time taken by the test for
+NULL strings done by InstanceCatalog._filter_chunk are reported.
+
+usage: python benchmarkCategorical.py --n_rows 1000000
+"""
+from __future__ import print_function
+import argparse
+import os
+import tempfile
+import numpy as np
+from sqlalchemy import create_engine, text
+
+from lsst.sims.catalogs.db import ConversionPlan, get_vocabulary, decode_categorical
+from benchmarkUtils import makeBenchmarkDB, timeIt
+
+
+def not_null_str(values):
+    """
+    The test InstanceCatalog._filter_chunk applies to string columns
+    """
+    values = np.char.lower(values.astype('str'))
+    return np.logical_and(values != 'none', np.logical_and(values != 'nan', values != 'null'))
+
+
+def not_null_categorical(codes):
+    """
+    The same test applied to the vocabulary of a categorical column
+    """
+    present = np.flatnonzero(np.bincount(codes, minlength=1))
+    vocabulary_switch = np.zeros(present[-1]+1 if len(present) > 0 else 0, dtype=bool)
+    vocabulary_switch[present] = not_null_str(decode_categorical(present.astype(codes.dtype)))
+    return vocabulary_switch[codes]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    filename = os.path.join(tempfile.gettempdir(), 'sims_catalogs_categorical_benchmark.db')
+    makeBenchmarkDB(filename, args.n_rows, n_extra_cols=2)
+    engine = create_engine('sqlite:///%s' % filename)
+    with engine.connect() as connection:
+        rows = connection.execute(text('SELECT id, sedFilename, mag_0 FROM stars')).fetchall()
+
+    dtype = np.dtype([('id', int), ('sedFilename', str, 256), ('mag_0', float)])
+    # sized columns start from one character (unless the database declares a length)
+    sized_dtype = np.dtype([('id', int), ('sedFilename', str, 1), ('mag_0', float)])
+    plans = [('U256', lambda: ConversionPlan(dtype)),
+             ('sized', lambda: ConversionPlan(sized_dtype, sized=['sedFilename'])),
+             ('categorical', lambda: ConversionPlan(dtype, categorical=['sedFilename']))]
+
+    print('%12s %12s %12s %12s' % ('column', 'MB/chunk', 'convert (s)', 'filter (s)'))
+    control = None
+    for name, make_plan in plans:
+        t_convert, chunk = timeIt(lambda: make_plan().convert(rows))
+        column = chunk['sedFilename']
+        if get_vocabulary(column) is None:
+            t_filter, mask = timeIt(lambda: not_null_str(column))
+        else:
+            t_filter, mask = timeIt(lambda: not_null_categorical(column))
+        if control is None:
+            control = (chunk['sedFilename'], mask)
+        elif (not np.array_equal(decode_categorical(column), control[0]) or
+              not np.array_equal(mask, control[1])):
+            raise RuntimeError("the %s column did not reproduce the U256 column" % name)
+        print('%12s %12.2f %12.4f %12.4f' % (name, chunk.nbytes/1024.0**2, t_convert, t_filter))
+
+    os.unlink(filename)
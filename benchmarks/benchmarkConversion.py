@@ -0,0 +1,66 @@
+"""
+Microbenchmark comparing the conversion of query rows into a recarray by
+numpy.rec.fromrecords (the old path) and by rows_to_recarray (the columnar
+path used by CatalogDBObject and DBObject) for tables of 10, 30 and 100 columns.
+
+The rows are real sqlalchemy Rows fetched from a sqlite database, so that
+the cost of getting values out of them is included.
+
+usage: python benchmarkConversion.py --n_rows 100000
+"""
+from __future__ import print_function
+from builtins import range
+import argparse
+import os
+import sqlite3
+import tempfile
+import numpy as np
+from sqlalchemy import create_engine, text
+
+from lsst.sims.catalogs.db import rows_to_recarray
+from benchmarkUtils import timeIt
+
+
+def make_wide_db(filename, n_rows, n_cols, seed=33):
+    """
+    Write a table 'wide' with an int id column, one 16 character
+    string column and n_cols-2 float columns
+    """
+    if os.path.exists(filename):
+        os.unlink(filename)
+    rng = np.random.RandomState(seed)
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE wide (id int, sed text%s)' %
+                 ''.join([', f%d real' % ii for ii in range(n_cols-2)]))
+    values = rng.random_sample((n_rows, n_cols-2))
+    conn.executemany('INSERT INTO wide VALUES (%s)' % ', '.join(['?']*n_cols),
+                     [(ii, 'sed_%d.txt' % (ii % 300)) + tuple(values[ii]) for ii in range(n_rows)])
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=100000)
+    parser.add_argument('--n_cols', type=int, nargs='+', default=[10, 30, 100])
+    args = parser.parse_args()
+
+    filename = os.path.join(tempfile.gettempdir(), 'sims_catalogs_conversion_benchmark.db')
+    make_wide_db(filename, args.n_rows, max(args.n_cols))
+    engine = create_engine('sqlite:///%s' % filename)
+
+    print('%8s %16s %16s %8s' % ('n_cols', 'fromrecords (s)', 'columnar (s)', 'ratio'))
+    for n_cols in args.n_cols:
+        names = ['id', 'sed'] + ['f%d' % ii for ii in range(n_cols-2)]
+        dtype = np.dtype([('id', int), ('sed', str, 256)] + [(name, float) for name in names[2:]])
+        with engine.connect() as connection:
+            rows = connection.execute(text('SELECT %s FROM wide' % ', '.join(names))).fetchall()
+
+        t_old, control = timeIt(lambda: np.rec.fromrecords([tuple(row) for row in rows], dtype=dtype))
+        t_new, test = timeIt(lambda: rows_to_recarray(rows, dtype))
+        if test.tobytes() != control.tobytes():
+            raise RuntimeError("rows_to_recarray did not reproduce fromrecords")
+        print('%8d %16.4f %16.4f %8.2f' % (n_cols, t_old, t_new, t_old/t_new))
+
+    os.unlink(filename)
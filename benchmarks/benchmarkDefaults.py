@@ -0,0 +1,90 @@
+"""
+Microbenchmark comparing two ways of applying CatalogDBObject.dbDefaultValues
+while converting a chunk of query rows into a recarray:  substituting the
+defaults row by row, in Python (the old path), and passing them to
+rows_to_recarray, which replaces NULL, zero and empty values with one
+vectorized mask per column.
+
+The rows are real sqlalchemy Rows fetched from a sqlite database in
+which a fraction of the values in the columns with defaults are NULL.
+
+usage: python benchmarkDefaults.py --n_rows 1000000
+"""
+from __future__ import print_function
+from builtins import range
+import argparse
+import os
+import sqlite3
+import tempfile
+import numpy as np
+from sqlalchemy import create_engine, text
+
+from lsst.sims.catalogs.db import rows_to_recarray
+from benchmarkUtils import timeIt
+
+
+def make_galaxy_db(filename, n_rows, n_defaults, n_cols, null_fraction, seed=45):
+    """
+    Write a table 'galaxies' with an int id column, a string column and
+    n_cols-2 float columns, the first n_defaults of which (and the string
+    column) have null_fraction of their values set to NULL
+    """
+    if os.path.exists(filename):
+        os.unlink(filename)
+    rng = np.random.RandomState(seed)
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE galaxies (id int, sed text%s)' %
+                 ''.join([', f%d real' % ii for ii in range(n_cols-2)]))
+    values = rng.random_sample((n_rows, n_cols-2)).astype(object)
+    values[:, :n_defaults][rng.random_sample((n_rows, n_defaults)) < null_fraction] = None
+    seds = np.array(['sed_%d.txt' % (ii % 300) for ii in range(n_rows)], dtype=object)
+    seds[rng.random_sample(n_rows) < null_fraction] = None
+    conn.executemany('INSERT INTO galaxies VALUES (%s)' % ', '.join(['?']*n_cols),
+                     [(ii, seds[ii]) + tuple(values[ii]) for ii in range(n_rows)])
+    conn.commit()
+    conn.close()
+
+
+def convert_row_by_row(rows, dtype, defaults):
+    """
+    The conversion CatalogDBObject used to do when any column had a default
+    """
+    names = dtype.names
+    results_array = []
+    for result in rows:
+        results_array.append(tuple(result[colName]
+                                   if result[colName] or
+                                   colName not in defaults
+                                   else defaults[colName]
+                                   for colName in names))
+    return rows_to_recarray(results_array, dtype)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=1000000)
+    parser.add_argument('--n_cols', type=int, default=20)
+    parser.add_argument('--n_defaults', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--null_fraction', type=float, default=0.1)
+    args = parser.parse_args()
+
+    filename = os.path.join(tempfile.gettempdir(), 'sims_catalogs_defaults_benchmark.db')
+    make_galaxy_db(filename, args.n_rows, max(args.n_defaults), args.n_cols, args.null_fraction)
+    engine = create_engine('sqlite:///%s' % filename)
+
+    names = ['id', 'sed'] + ['f%d' % ii for ii in range(args.n_cols-2)]
+    dtype = np.dtype([('id', int), ('sed', str, 40)] + [(name, float) for name in names[2:]])
+    with engine.connect() as connection:
+        rows = connection.execute(text('SELECT %s FROM galaxies' % ', '.join(names))).fetchall()
+
+    print('%10s %16s %16s %8s' % ('n_defaults', 'row by row (s)', 'vectorized (s)', 'ratio'))
+    for n_defaults in args.n_defaults:
+        defaults = dict([('sed', 'flat.txt')] + [('f%d' % ii, -1.0) for ii in range(n_defaults)])
+        t_old, control = timeIt(lambda: convert_row_by_row(rows, dtype, defaults))
+        t_new, test = timeIt(lambda: rows_to_recarray(rows, dtype, defaults=defaults))
+        if test.tobytes() != control.tobytes():
+            raise RuntimeError("the vectorized defaults did not reproduce the row by row defaults")
+        print('%10d %16.4f %16.4f %8.2f' % (n_defaults + 1, t_old, t_new, t_old/t_new))
+
+    os.unlink(filename)
@@ -0,0 +1,45 @@
+"""
+Compare the wall-clock time of extracting a whole table with a single
+chunked query against splitting the query into id-range partitions,
+each run on its own database connection.
+
+usage: python benchmarkPartitions.py --n_rows 1000000 --chunk_size 50000
+"""
+from __future__ import print_function
+import argparse
+import os
+import tempfile
+
+from benchmarkUtils import makeBenchmarkDB, benchmarkStars, timeIt
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=1000000)
+    parser.add_argument('--chunk_size', type=int, default=50000)
+    parser.add_argument('--database', type=str, default=None)
+    args = parser.parse_args()
+
+    database = args.database
+    if database is None:
+        database = os.path.join(tempfile.gettempdir(), 'sims_catalogs_benchmark.db')
+    makeBenchmarkDB(database, args.n_rows)
+
+    dbobj = benchmarkStars(database=database)
+    colnames = ['id', 'raJ2000', 'decJ2000', 'sedFilename']
+
+    def consume(partitions, ordered):
+        n_rows = 0
+        for chunk in dbobj.query_columns(colnames=colnames, chunk_size=args.chunk_size,
+                                         partitions=partitions, ordered=ordered):
+            n_rows += len(chunk)
+        return n_rows
+
+    print('%10s %8s %12s %10s' % ('partitions', 'ordered', 'n_rows', 'time (s)'))
+    elapsed, n_rows = timeIt(lambda: consume(None, True))
+    print('%10s %8s %12d %10.3f' % (None, True, n_rows, elapsed))
+    for partitions in (1, 2, 4, 8):
+        for ordered in (True, False):
+            elapsed, n_rows = timeIt(lambda: consume(partitions, ordered))
+            print('%10d %8s %12d %10.3f' % (partitions, ordered, n_rows, elapsed))
@@ -0,0 +1,47 @@
+"""
+Compare the wall-clock time of consuming a chunked query with and without
+background prefetching.  The consumer simulates catalog-writing work by
+sleeping for a fixed time per chunk, so the benefit of prefetching is the
+amount of database time that can be hidden behind that work.
+
+usage: python benchmarkPrefetch.py --n_rows 1000000 --chunk_size 50000 --work 0.1
+"""
+from __future__ import print_function
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarkUtils import makeBenchmarkDB, benchmarkStars, timeIt
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=1000000)
+    parser.add_argument('--chunk_size', type=int, default=50000)
+    parser.add_argument('--work', type=float, default=0.1,
+                        help='seconds of simulated work per chunk')
+    parser.add_argument('--database', type=str, default=None)
+    args = parser.parse_args()
+
+    database = args.database
+    if database is None:
+        database = os.path.join(tempfile.gettempdir(), 'sims_catalogs_benchmark.db')
+    makeBenchmarkDB(database, args.n_rows)
+
+    dbobj = benchmarkStars(database=database)
+    colnames = ['id', 'raJ2000', 'decJ2000', 'sedFilename']
+
+    def consume(prefetch):
+        n_rows = 0
+        for chunk in dbobj.query_columns(colnames=colnames, chunk_size=args.chunk_size,
+                                         prefetch=prefetch):
+            time.sleep(args.work)
+            n_rows += len(chunk)
+        return n_rows
+
+    print('%10s %12s %10s' % ('prefetch', 'n_rows', 'time (s)'))
+    for prefetch in (None, 1, 2, 4):
+        elapsed, n_rows = timeIt(lambda: consume(prefetch))
+        print('%10s %12d %10.3f' % (prefetch, n_rows, elapsed))
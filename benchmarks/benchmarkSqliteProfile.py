@@ -0,0 +1,59 @@
+"""
+Compare the throughput of cone-search query_columns calls on a sqlite
+database opened with sqlite's default settings, with the 'read'
+sqlite_profile (memory-mapped I/O, a large page cache, in-memory
+temporary storage and a read-only connection) and with the 'read_wal'
+sqlite_profile (the same, plus WAL).
+
+Note that the 'read_wal' profile switches the database file to WAL mode,
+which persists; it is therefore timed last.
+
+usage: python benchmarkSqliteProfile.py --n_rows 5000000 --radius 2.0 --n_cones 20
+"""
+from __future__ import print_function
+from builtins import range
+import argparse
+import os
+import tempfile
+import numpy as np
+
+from lsst.sims.utils import ObservationMetaData
+from benchmarkUtils import makeBenchmarkDB, benchmarkStars, timeIt
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=5000000)
+    parser.add_argument('--radius', type=float, default=2.0,
+                        help='radius of each cone in degrees')
+    parser.add_argument('--n_cones', type=int, default=20)
+    parser.add_argument('--chunk_size', type=int, default=50000)
+    parser.add_argument('--database', type=str, default=None)
+    args = parser.parse_args()
+
+    database = args.database
+    if database is None:
+        database = os.path.join(tempfile.gettempdir(), 'sims_catalogs_benchmark.db')
+    makeBenchmarkDB(database, args.n_rows)
+
+    rng = np.random.RandomState(42)
+    cones = [ObservationMetaData(pointingRA=ra, pointingDec=dec,
+                                 boundType='circle', boundLength=args.radius)
+             for ra, dec in zip(rng.random_sample(args.n_cones)*360.0,
+                                rng.random_sample(args.n_cones)*120.0 - 60.0)]
+    colnames = ['id', 'raJ2000', 'decJ2000', 'sedFilename']
+
+    def consume(dbobj):
+        n_rows = 0
+        for obs in cones:
+            for chunk in dbobj.query_columns(colnames=colnames, obs_metadata=obs,
+                                             chunk_size=args.chunk_size):
+                n_rows += len(chunk)
+        return n_rows
+
+    print('%10s %12s %10s %12s' % ('profile', 'n_rows', 'time (s)', 'rows/s'))
+    for profile in (None, 'read', 'read_wal'):
+        dbobj = benchmarkStars(database=database, sqlite_profile=profile)
+        elapsed, n_rows = timeIt(lambda: consume(dbobj))
+        print('%10s %12d %10.3f %12.0f' % (profile, n_rows, elapsed, n_rows/elapsed))
@@ -0,0 +1,67 @@
+"""
+Measure the peak resident set size of query_columns as a function of the
+number of rows returned, with and without result streaming.
+
+Each measurement runs in its own subprocess, because peak RSS can only
+grow over the lifetime of a process.  With streaming enabled, peak RSS
+should be independent of the number of rows queried.
+
+usage: python benchmarkStreaming.py --n_rows 100000 1000000 --chunk_size 10000
+"""
+from __future__ import print_function
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from benchmarkUtils import makeBenchmarkDB, benchmarkStars
+
+
+def run_query(database, limit, chunk_size, stream):
+    """
+    Query limit rows from database and return the peak RSS in MB
+    """
+    from lsst.sims.catalogs.db import ChunkIterator
+
+    dbobj = benchmarkStars(database=database)
+    query = dbobj._get_column_query(['id', 'raJ2000', 'decJ2000', 'sedFilename']).limit(limit)
+    n_rows = 0
+    for chunk in ChunkIterator(dbobj, query, chunk_size, stream_results=stream):
+        n_rows += len(chunk)
+
+    # ru_maxrss is in kB on Linux and bytes on OSX
+    scale = 1024.0 if sys.platform != 'darwin' else 1024.0*1024.0
+    return n_rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, nargs='+', default=[100000, 300000, 1000000])
+    parser.add_argument('--chunk_size', type=int, default=10000)
+    parser.add_argument('--database', type=str, default=None)
+    parser.add_argument('--child', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        limit, stream = args.child.split(',')
+        n_rows, rss = run_query(args.database, int(limit), args.chunk_size, stream == 'True')
+        print('%d %.1f' % (n_rows, rss))
+        sys.exit(0)
+
+    database = args.database
+    if database is None:
+        database = os.path.join(tempfile.gettempdir(), 'sims_catalogs_benchmark.db')
+    makeBenchmarkDB(database, max(args.n_rows))
+
+    print('%12s %10s %16s' % ('n_rows', 'stream', 'peak RSS (MB)'))
+    for limit in args.n_rows:
+        for stream in (False, True):
+            output = subprocess.check_output([sys.executable, __file__,
+                                              '--database', database,
+                                              '--chunk_size', str(args.chunk_size),
+                                              '--child', '%d,%s' % (limit, stream)])
+            n_rows, rss = output.decode().split()
+            print('%12s %10s %16s' % (n_rows, stream, rss))
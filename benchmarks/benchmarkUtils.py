@@ -0,0 +1,98 @@
+"""
+Utilities shared by the scripts in this directory.  None of these are
+run by the unit tests; they exist to give reproducible performance
+numbers for the query machinery in lsst.sims.catalogs.db
+"""
+from __future__ import print_function
+from builtins import range
+import os
+import sqlite3
+import time
+import numpy as np
+
+from lsst.sims.catalogs.db import CatalogDBObject
+
+__all__ = ["makeBenchmarkDB", "benchmarkStars", "timeIt"]
+
+
+class benchmarkStars(CatalogDBObject):
+    """
+    A CatalogDBObject for the 'stars' table written by makeBenchmarkDB
+    """
+    objid = 'benchmark_stars'
+    tableid = 'stars'
+    idColKey = 'id'
+    driver = 'sqlite'
+    raColName = 'ra'
+    decColName = 'decl'
+    skipRegistration = True
+    columns = [('id', None, int),
+               ('raJ2000', 'ra*%f' % (np.pi/180.)),
+               ('decJ2000', 'decl*%f' % (np.pi/180.)),
+               ('sedFilename', 'sedFilename', str, 40)]
+
+
+def makeBenchmarkDB(filename, n_rows, n_extra_cols=10, chunk_size=100000, seed=99):
+    """
+    Write a sqlite database containing a table 'stars' with n_rows rows.
+
+    The table has the columns id, ra, decl (in degrees), sedFilename
+    and n_extra_cols float columns named mag_0, mag_1...
+
+    If filename already exists and contains a table with the right
+    number of rows, it is re-used.
+    """
+    extra_names = ['mag_%d' % ii for ii in range(n_extra_cols)]
+
+    if os.path.exists(filename):
+        conn = sqlite3.connect(filename)
+        try:
+            n_existing = conn.execute('SELECT COUNT(*) FROM stars').fetchone()[0]
+            n_cols = len(conn.execute('SELECT * FROM stars LIMIT 1').description)
+        except sqlite3.OperationalError:
+            n_existing = -1
+            n_cols = -1
+        conn.close()
+        if n_existing == n_rows and n_cols == 4 + n_extra_cols:
+            return
+        os.unlink(filename)
+
+    rng = np.random.RandomState(seed)
+    sed_names = np.array(['sed_%d.txt.gz' % ii for ii in range(300)])
+
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE stars (id int, ra real, decl real, sedFilename text%s)' %
+                 ''.join([', %s real' % name for name in extra_names]))
+
+    insert = 'INSERT INTO stars VALUES (%s)' % ', '.join(['?']*(4 + n_extra_cols))
+    for i_start in range(0, n_rows, chunk_size):
+        n_local = min(chunk_size, n_rows - i_start)
+        ra = rng.random_sample(n_local)*360.0
+        dec = np.degrees(np.arcsin(rng.random_sample(n_local)*2.0 - 1.0))
+        sed = sed_names[rng.randint(0, len(sed_names), n_local)]
+        extra = rng.random_sample((n_local, n_extra_cols))*10.0 + 15.0
+        rows = [(i_start + ii, ra[ii], dec[ii], str(sed[ii])) + tuple(extra[ii])
+                for ii in range(n_local)]
+        conn.executemany(insert, rows)
+
+    conn.execute('CREATE INDEX star_id_idx ON stars (id)')
+    conn.execute('CREATE INDEX star_ra_idx ON stars (ra)')
+    conn.execute('CREATE INDEX star_dec_idx ON stars (decl)')
+    conn.commit()
+    conn.close()
+
+
+def timeIt(function, n_repeat=3):
+    """
+    Call function() n_repeat times and return the shortest wall-clock time
+    (in seconds) and the value returned by the last call
+    """
+    best = None
+    result = None
+    for ii in range(n_repeat):
+        t_start = time.time()
+        result = function()
+        elapsed = time.time() - t_start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
@@ -219,6 +219,10 @@ class CompoundCatalogDBObject(_CompoundCatalogDBObject_mixin, CatalogDBObject):
         self._make_dbTypeMap()
         self._make_dbDefaultValues()
 
+        # the sized string columns copied from the CatalogDBObjects
+        # (see CatalogDBObject.sizeStrings) must be sized here too
+        self.sizeStrings = any(dbo.sizeStrings for dbo in self._dbObjectClassList)
+
         dbo = self._dbObjectClassList[0](connection=connection)
         # need to instantiate the first one because sometimes
         # idColKey is not defined until instantiation
@@ -1,3 +1,9 @@
 from .dbConnection import *
 from .CompoundCatalogDBObject import *
 from .utils import *
+from .resultConversion import *
+from .categorical import *
+from .queryCache import *
+from .schemaCache import *
+from .spatialIndex import *
+from .queryStats import *
@@ -0,0 +1,388 @@
+"""
+Return the results of CatalogDBObject queries as pyarrow RecordBatches (see
+CatalogDBObject.query_columns with output='arrow'), for consumers that work
+on Arrow data and would otherwise copy every recarray into Arrow.  This module
+needs pyarrow.
+
+Where an ADBC driver for the database is installed (e.g. adbc_driver_sqlite),
+the batches are read from it as they are; otherwise they are built one column
+at a time from the rows of the DB-API cursor, without going through a recarray.
+"""
+import importlib
+import numpy
+import pyarrow
+import pyarrow.compute
+
+from .categorical import categorical_dtype, get_vocabulary
+from .queryStats import _compile_query
+
+__all__ = ["ArrowChunkIterator", "RecordBatchChunk", "arrow_type", "adbc_drivers"]
+
+
+#: The ADBC driver module used for each dialect (if it is installed)
+adbc_drivers = {'sqlite': 'adbc_driver_sqlite',
+                'postgresql': 'adbc_driver_postgresql'}
+
+
+def arrow_type(dtype):
+    """
+    Return the pyarrow type of a column of numpy dtype dtype (a field of the
+    dtype of a ConversionPlan).  Strings, whatever their width, become pyarrow
+    strings; categorical columns become dictionary-encoded strings.
+    """
+    if get_vocabulary(dtype) is not None:
+        return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    if dtype.kind in ('U', 'S', 'O'):
+        return pyarrow.string()
+    return pyarrow.from_numpy_dtype(dtype)
+
+
+def _to_arrow(values, field_type):
+    """
+    Return a pyarrow array of field_type holding the list values
+    (one column of the rows returned by a DB-API cursor)
+    """
+    try:
+        return pyarrow.array(values, type=field_type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        # e.g. Decimals in a float column, or numbers in a string column
+        return pyarrow.array(values).cast(field_type)
+
+
+def _with_default(column, default):
+    """
+    Return the pyarrow array column with its NULL, zero or empty values
+    replaced by default (as ConversionPlan does for its defaults)
+    """
+    if pyarrow.types.is_string(column.type):
+        empty = ''
+    elif pyarrow.types.is_boolean(column.type):
+        empty = False
+    else:
+        empty = 0
+    falsy = pyarrow.compute.fill_null(pyarrow.compute.equal(column, pyarrow.scalar(empty, column.type)),
+                                      True)
+    return pyarrow.compute.if_else(falsy, pyarrow.scalar(default).cast(column.type), column)
+
+
+def _concat_batches(batches):
+    """
+    Return the list of RecordBatches (which share a schema) as one RecordBatch
+    """
+    if len(batches) == 1:
+        return batches[0]
+    return pyarrow.Table.from_batches(batches).combine_chunks().to_batches()[0]
+
+
+class ArrowChunkIterator(object):
+    """
+    Iterator over the chunks of the results of a CatalogDBObject query as
+    pyarrow RecordBatches (see CatalogDBObject.query_columns with output='arrow').
+
+    The columns have the types of the fields of the query's ConversionPlan
+    (see arrow_type); NULLs are kept as Arrow nulls, except in columns with
+    defaults (see CatalogDBObject.dbDefaultValues), where they are replaced.
+    Categorical columns are dictionary-encoded, with one dictionary per chunk.
+
+    The query is only executed when the first chunk is asked for.  It is run
+    on a connection of its own by an ADBC driver if one is installed for the
+    database (and the query can be rendered without bound parameters);
+    otherwise, on the session of the CatalogDBObject's connection, whose DB-API
+    cursor the rows are fetched from directly.
+    """
+
+    def __init__(self, dbobj, query, chunk_size, bounds=None, plan=None, use_adbc=True):
+        """
+        @param [in] dbobj is the CatalogDBObject whose query this is
+
+        @param [in] query is the sqlalchemy Query
+
+        @param [in] chunk_size is the number of rows to return per chunk
+        (None means return all of the rows as a single chunk)
+
+        @param [in] bounds are optional circular bounds, as in ChunkIterator
+
+        @param [in] plan is the ConversionPlan of the query (see
+        CatalogDBObject._get_query_conversion_plan), which gives the names
+        and types of the columns and their defaults
+
+        @param [in] use_adbc is a boolean controlling whether an ADBC driver
+        is used when one is available (default True)
+        """
+        self.dbobj = dbobj
+        self.plan = plan
+        self.chunk_size = chunk_size
+        self.bounds = bounds
+        self.use_adbc = use_adbc
+        if self.bounds is not None:
+            query = dbobj._add_bounds_columns(query)
+        if hasattr(query, 'statement'):
+            query = query.statement
+        self._statement = query
+
+        fields = [pyarrow.field(name, arrow_type(plan.dtype[name])) for name in plan.dtype.names]
+        #: the schema of the RecordBatches returned
+        self.schema = pyarrow.schema(fields)
+        # categorical columns are fetched as strings and encoded chunk by chunk
+        self._categorical = [ii for ii, field in enumerate(fields)
+                             if pyarrow.types.is_dictionary(field.type)]
+        raw_fields = [pyarrow.field(field.name, pyarrow.string())
+                      if ii in self._categorical else field
+                      for ii, field in enumerate(fields)]
+        if self.bounds is not None:
+            raw_fields += [pyarrow.field(label, pyarrow.float64())
+                           for label in dbobj._boundsColumnLabels]
+        self._raw_schema = pyarrow.schema(raw_fields)
+        self._defaults = [(ii, plan.defaults[field.name]) for ii, field in enumerate(fields)
+                          if field.name in plan.defaults]
+
+        self._batches = None
+        self._pending = []
+        self._adbc_connection = None
+        self._result = None
+        self._exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._exhausted:
+            raise StopIteration
+        try:
+            if self._batches is None:
+                self._batches = self._execute()
+            chunk = self._next_chunk()
+        except BaseException:
+            self.close()
+            raise
+        if chunk is None or self.chunk_size is None:
+            self.close()
+            if chunk is None:
+                raise StopIteration
+        return chunk
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        Stop iterating, releasing the database cursor
+        """
+        self._exhausted = True
+        self._pending = []
+        self._close_cursor()
+
+    def _close_cursor(self):
+        """
+        Close the database cursor (and any ADBC connection)
+        """
+        try:
+            if self._result is not None:
+                self._result.close()
+            if self._adbc_connection is not None:
+                self._adbc_connection.close()
+        finally:
+            self._result = None
+            self._adbc_connection = None
+
+    def _execute(self):
+        """
+        Execute the query, returning an iterator over RecordBatches
+        of its rows (with the types of self._raw_schema, or ones that
+        can be cast to them)
+        """
+        batches = None
+        if self.use_adbc:
+            batches = self._execute_adbc()
+        if batches is None:
+            batches = self._execute_cursor()
+        return batches
+
+    def _execute_adbc(self):
+        """
+        Execute the query with the ADBC driver for the database, returning
+        an iterator over the RecordBatches it reads, or None if there is no
+        such driver or it cannot run the query (e.g. because it calls the
+        functions that DBConnection declares to sqlite)
+        """
+        connection = self.dbobj.connection
+        dbUrl = connection.engine.url
+        dialect = dbUrl.get_backend_name()
+        if dialect not in adbc_drivers:
+            return None
+        if dialect == 'sqlite' and dbUrl.database in (None, '', ':memory:'):
+            # in-memory sqlite databases are private to their connection
+            return None
+        sql, is_literal = _compile_query(self._statement, connection.engine.dialect)
+        if not is_literal:
+            return None
+        try:
+            dbapi = importlib.import_module(adbc_drivers[dialect] + '.dbapi')
+        except ImportError:
+            return None
+
+        if dialect == 'sqlite':
+            uri = dbUrl.database
+        else:
+            uri = dbUrl.set(drivername=dialect).render_as_string(hide_password=False)
+        self._adbc_connection = dbapi.connect(uri)
+        try:
+            # the cursor is kept open (and closed by close()) while the batches are read
+            self._result = self._adbc_connection.cursor()
+            self._result.execute(sql)
+            reader = self._result.fetch_record_batch()
+        except Exception:
+            self._close_cursor()
+            return None
+        return iter(reader)
+
+    def _execute_cursor(self):
+        """
+        Execute the query on the session of the CatalogDBObject's connection,
+        returning a generator of RecordBatches of chunk_size rows.  If the
+        query can be rendered without bound parameters, its rows are fetched
+        as plain tuples from a DB-API cursor of the connection (rather than
+        as sqlalchemy Rows, which a streaming result also buffers ahead of
+        the cursor).
+        """
+        connection = self.dbobj.connection.session.connection()
+        sql, is_literal = _compile_query(self._statement, connection.dialect)
+        if is_literal:
+            self._result = connection.connection.cursor()
+            self._result.execute(sql)
+        else:
+            statement = self._statement
+            if self.chunk_size is not None:
+                statement = statement.execution_options(stream_results=True)
+            self._result = connection.execute(statement)
+        return self._fetch_cursor_batches(self._result)
+
+    def _fetch_cursor_batches(self, cursor):
+        while True:
+            if self.chunk_size is None:
+                rows = cursor.fetchall()
+            else:
+                rows = cursor.fetchmany(self.chunk_size)
+            if len(rows) == 0:
+                return
+            columns = list(zip(*rows))
+            yield pyarrow.RecordBatch.from_arrays([_to_arrow(list(column), field.type)
+                                                  for column, field in zip(columns, self._raw_schema)],
+                                                 schema=self._raw_schema)
+            if self.chunk_size is None:
+                return
+
+    def _next_chunk(self):
+        """
+        Return the next RecordBatch of chunk_size rows (or fewer, if the
+        results run out), or None if there are no more rows
+        """
+        n_rows = sum(batch.num_rows for batch in self._pending)
+        while self.chunk_size is None or n_rows < self.chunk_size:
+            batch = next(self._batches, None)
+            if batch is None:
+                break
+            batch = self._postprocess_batch(batch)
+            if batch.num_rows > 0:
+                self._pending.append(batch)
+                n_rows += batch.num_rows
+        if n_rows == 0:
+            return None
+
+        if self.chunk_size is None or n_rows <= self.chunk_size:
+            chunk = _concat_batches(self._pending)
+            self._pending = []
+        else:
+            # the rows beyond chunk_size (at most part of the last
+            # batch) are kept, as a zero-copy slice, for the next chunk
+            last = self._pending[-1]
+            n_kept = last.num_rows - (n_rows - self.chunk_size)
+            chunk = _concat_batches(self._pending[:-1] + [last.slice(0, n_kept)])
+            self._pending = [last.slice(n_kept)]
+
+        columns = chunk.columns
+        for ii in self._categorical:
+            columns[ii] = columns[ii].dictionary_encode()
+        return pyarrow.RecordBatch.from_arrays(columns, schema=self.schema)
+
+    def _postprocess_batch(self, batch):
+        """
+        Cast a RecordBatch read from the database to self._raw_schema, keep
+        only its rows within self.bounds (dropping the bounds columns)
+        and replace NULL values by the defaults
+        """
+        columns = [column if column.type == field.type else column.cast(field.type)
+                   for column, field in zip(batch.columns, self._raw_schema)]
+        if self.bounds is not None:
+            ra = numpy.radians(columns[-2].to_numpy(zero_copy_only=False))
+            dec = numpy.radians(columns[-1].to_numpy(zero_copy_only=False))
+            mask = pyarrow.array(self.dbobj._coordinates_mask(ra, dec, self.bounds))
+            columns = [column.filter(mask) for column in columns[:-2]]
+        for ii, default in self._defaults:
+            columns[ii] = _with_default(columns[ii], default)
+        return pyarrow.RecordBatch.from_arrays(columns, names=self.schema.names)
+
+
+class RecordBatchChunk(object):
+    """
+    A pyarrow RecordBatch dressed up as enough of a recarray for the
+    getters of an InstanceCatalog:  chunk.dtype.names, len(chunk),
+    chunk[name] and chunk[indices] (which returns the selected rows
+    as another RecordBatchChunk).
+
+    chunk[name] is a numpy view of the column's Arrow buffer (so read-only)
+    wherever numpy can represent the column without a copy, i.e. for numbers
+    without NULLs.  NULLs in integer columns make the column float (with NaN
+    for NULL); string columns are converted into arrays of objects.  The codes
+    of dictionary-encoded columns are returned, as a categorical column (see
+    categorical.py), whose vocabulary is the dictionary.
+    """
+
+    def __init__(self, batch):
+        """
+        @param [in] batch is a pyarrow RecordBatch
+        """
+        self.batch = batch
+        # the numpy arrays already made of the columns
+        self._columns = {}
+        self.dtype = numpy.dtype([(str(field.name), self._numpy_type(field.type))
+                                  for field in batch.schema])
+
+    @staticmethod
+    def _numpy_type(field_type):
+        if pyarrow.types.is_dictionary(field_type):
+            return numpy.int32
+        if pyarrow.types.is_string(field_type) or pyarrow.types.is_large_string(field_type):
+            return object
+        return field_type.to_pandas_dtype()
+
+    def __len__(self):
+        return self.batch.num_rows
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._columns:
+                self._columns[key] = self._column_to_numpy(self.batch.column(key))
+            return self._columns[key]
+        if isinstance(key, tuple):
+            # the output of numpy.where
+            key, = key
+        indices = numpy.arange(len(self))[key]
+        return RecordBatchChunk(self.batch.take(pyarrow.array(indices)))
+
+    @staticmethod
+    def _column_to_numpy(column):
+        if pyarrow.types.is_dictionary(column.type) and column.null_count == 0:
+            codes = column.indices.cast(pyarrow.int32()).to_numpy()
+            return codes.view(categorical_dtype(column.dictionary.to_pylist()))
+        return column.to_numpy(zero_copy_only=False)
+
+    def shares_memory(self, array):
+        """
+        Return True if the numpy array may share memory with
+        the columns of the chunk already handed out
+        """
+        return any(numpy.may_share_memory(array, column) for column in self._columns.values())
@@ -0,0 +1,180 @@
+"""
+Run CatalogDBObject queries on sqlalchemy's asyncio engine, so that one
+process can keep many queries in flight (see
+CatalogDBObject.query_columns_async).  This module needs python 3 and an
+asyncio database driver, e.g. aiosqlite for sqlite databases.
+"""
+import asyncio
+import numpy
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .dbConnection import declareTrigFunctions
+
+__all__ = ["AsyncChunkIterator", "get_async_engine", "async_drivers"]
+
+
+#: The asyncio driver used for each dialect
+async_drivers = {'sqlite': 'aiosqlite',
+                 'postgresql': 'asyncpg',
+                 'mysql': 'aiomysql'}
+
+
+def get_async_engine(connection, max_concurrent=8):
+    """
+    Return a tuple (engine, semaphore): the sqlalchemy AsyncEngine connected to
+    the database of connection (a DBConnection), and the asyncio.Semaphore limiting
+    the number of queries open on it at once.  Both belong to the running event
+    loop; they are made when first asked for and then kept with the connection
+    (until the loop is collected).  The engine's pool is disposed of, closing
+    its connections, whenever the last query running on it finishes.
+
+    @param [in] connection is a DBConnection
+
+    @param [in] max_concurrent is the size of the semaphore
+    (only used when the engine is made)
+    """
+    loop = asyncio.get_running_loop()
+    record = connection._async_engines.get(loop)
+    if record is not None:
+        return record[0], record[1]
+
+    dbUrl = connection._get_url()
+    dialect = dbUrl.get_backend_name()
+    if dialect not in async_drivers:
+        raise ValueError("There is no asyncio driver for %s databases; "
+                         "the known drivers are %s" % (dialect, str(async_drivers)))
+    if dialect == 'sqlite' and dbUrl.database in (None, '', ':memory:'):
+        raise ValueError("Cannot query an in-memory sqlite database asynchronously "
+                         "(the asyncio engine cannot see it)")
+    dbUrl = dbUrl.set(drivername='%s+%s' % (dialect, async_drivers[dialect]))
+
+    pool_kwargs = connection._get_pool_kwargs(dbUrl, connection.pool_size,
+                                              connection.max_overflow)
+    engine = create_async_engine(dbUrl, echo=connection.verbose, **pool_kwargs)
+    if dialect == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', declareTrigFunctions)
+        if len(connection._sqlite_pragmas) > 0:
+            event.listen(engine.sync_engine, 'connect', connection._set_sqlite_pragmas)
+
+    # the engine, its semaphore and the number of queries running on it
+    record = [engine, asyncio.Semaphore(max_concurrent), 0]
+    connection._async_engines[loop] = record
+    return record[0], record[1]
+
+
+async def _generate_chunks(dbobj, statement, chunk_size, bounds, plan):
+    """
+    Execute statement and yield the chunks of its results (see
+    AsyncChunkIterator).  The semaphore and the connection are released when
+    the generator finishes, raises or is closed; the engine is disposed of if
+    no other query is running on it (so that its pool does not outlive the
+    event loop).  The generator must not refer to its AsyncChunkIterator, so
+    that an abandoned iterator is closed as soon as it is collected.
+    """
+    engine, semaphore = get_async_engine(dbobj.connection,
+                                         max_concurrent=dbobj.async_concurrency)
+    record = dbobj.connection._async_engines[asyncio.get_running_loop()]
+    record[2] += 1
+    try:
+        async with semaphore:
+            async with engine.connect() as connection:
+                result = await connection.stream(statement)
+                try:
+                    while True:
+                        chunk = await _fetch_chunk(dbobj, result, chunk_size, bounds)
+                        if len(chunk) > 0:
+                            if plan is None:
+                                yield dbobj._postprocess_results(chunk)
+                            else:
+                                yield dbobj._final_pass(
+                                    dbobj._convert_results_to_numpy_recarray_catalogDBObj(chunk,
+                                                                                          plan=plan))
+                        if len(chunk) == 0 or chunk_size is None:
+                            return
+                finally:
+                    await result.close()
+    finally:
+        record[2] -= 1
+        if record[2] == 0:
+            # the engine stays usable; its pool is started again when needed
+            await engine.dispose()
+
+
+async def _fetch_chunk(dbobj, result, chunk_size, bounds):
+    """
+    Fetch the next chunk of rows from result (keeping only those within
+    bounds, as in ChunkIterator._fetch_chunk_in_bounds)
+    """
+    chunk = []
+    while True:
+        if chunk_size is None:
+            rows = await result.all()
+        else:
+            rows = await result.fetchmany(chunk_size - len(chunk))
+        if bounds is None:
+            return rows
+        if len(rows) == 0:
+            return chunk
+        mask = dbobj._bounds_mask(rows, bounds)
+        chunk.extend([rows[ii] for ii in numpy.flatnonzero(mask)])
+        if chunk_size is None or len(chunk) >= chunk_size:
+            return chunk
+
+
+class AsyncChunkIterator(object):
+    """
+    Asynchronous iterator over the chunks of the results of a CatalogDBObject
+    query (see CatalogDBObject.query_columns_async).
+
+    The query is only executed when the first chunk is asked for.  A database
+    connection (and a place in the semaphore of get_async_engine) is held from
+    then until the results are exhausted, or aclose() is called.  To be sure
+    that they are released as soon as a loop over the chunks is left early, use
+
+        async with dbobj.query_columns_async(...) as chunks:
+            async for chunk in chunks:
+
+    (otherwise they are released when the iterator is garbage collected).
+    """
+
+    def __init__(self, dbobj, query, chunk_size, bounds=None, plan=None):
+        """
+        @param [in] dbobj is the CatalogDBObject whose query this is
+
+        @param [in] query is the sqlalchemy Query
+
+        @param [in] chunk_size is the number of rows to return per chunk
+        (None means return all of the rows as a single chunk)
+
+        @param [in] bounds are optional circular bounds, as in ChunkIterator
+
+        @param [in] plan is an optional ConversionPlan, as in ChunkIterator
+        """
+        self.dbobj = dbobj
+        self.plan = plan
+        self.chunk_size = chunk_size
+        self.bounds = bounds
+        if self.bounds is not None:
+            query = dbobj._add_bounds_columns(query)
+        if hasattr(query, 'statement'):
+            query = query.statement
+        self._chunks = _generate_chunks(dbobj, query, chunk_size, bounds, plan)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._chunks.__anext__()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Stop iterating, releasing the database connection
+        """
+        await self._chunks.aclose()
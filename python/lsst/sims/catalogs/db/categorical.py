@@ -0,0 +1,64 @@
+"""
+Dictionary-encoded ('categorical') string columns.  A categorical column is
+held in a recarray as integer codes; the list of the distinct values the
+codes refer to (the vocabulary) travels with the column in the metadata of
+its numpy dtype, so that it survives slicing and indexing of the recarray.
+See CatalogDBObject.categoricalColumns.
+"""
+import numpy
+
+__all__ = ["categorical_dtype", "get_vocabulary", "is_categorical",
+           "decode_categorical"]
+
+
+def categorical_dtype(vocabulary):
+    """
+    Return the dtype of the codes of a categorical column
+
+    @param [in] vocabulary is the list of the values of the column; code ii
+    refers to vocabulary[ii].  The list may be appended to (but not otherwise
+    changed) after the dtype is made; the codes already issued remain valid.
+    """
+    return numpy.dtype(numpy.int32, metadata={'vocabulary': vocabulary})
+
+
+def get_vocabulary(column):
+    """
+    Return the vocabulary of column (a numpy array or dtype),
+    or None if it is not categorical
+    """
+    dtype = getattr(column, 'dtype', column)
+    if dtype.metadata is None:
+        return None
+    return dtype.metadata.get('vocabulary')
+
+
+def is_categorical(column):
+    """
+    Return True if column (a numpy array or dtype) is categorical
+    """
+    return get_vocabulary(column) is not None
+
+
+def decode_categorical(column, dtype=str):
+    """
+    Return the values of a categorical column as an array of strings
+    (which is what the column would have held if it were not categorical).
+    Any other column is returned as it is.
+
+    @param [in] column is a numpy array
+
+    @param [in] dtype is the type of the output.  With dtype=object, the
+    output holds the values in the vocabulary themselves, which costs one
+    pointer per row rather than a fixed-width copy of each string.
+    """
+    vocabulary = get_vocabulary(column)
+    if vocabulary is None:
+        return column
+    # a copy, in case another thread is adding to the vocabulary
+    vocabulary = list(vocabulary)
+    values = numpy.empty(len(vocabulary), dtype=object)
+    values[:] = vocabulary
+    if dtype is not object:
+        values = values.astype(dtype)
+    return values[numpy.asarray(column, dtype=numpy.int32)]
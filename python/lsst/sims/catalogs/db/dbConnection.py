@@ -17,21 +17,34 @@ if sys.version_info.major == 2:
     str_cast = past_str
 
 from builtins import zip
+from builtins import range
 from builtins import object
 import warnings
 import numpy
 import os
+import math
+import re
+import decimal
+import numbers
+import queue
+import threading
+import weakref
 import inspect
 from io import BytesIO
 from collections import OrderedDict
 
-from .utils import loadData
+from .utils import loadData, parse_byte_budget
+from .resultConversion import rows_to_recarray, ConversionPlan
+from .schemaCache import SchemaCache
+from .queryStats import ChunkStats
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.sql import expression
-from sqlalchemy.engine import reflection, url
+from sqlalchemy.engine import url
 from sqlalchemy import (create_engine, MetaData,
-                        Table, event, text)
+                        Table, event, text, func)
 from sqlalchemy import exc as sa_exc
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import inspect as sa_inspect
 from lsst.daf.butler.registry import DbAuth
 from lsst.sims.utils.CodeUtilities import sims_clean_up
 from lsst.utils import getPackageDir
@@ -41,68 +54,972 @@ from lsst.utils import getPackageDir
 #TODO: test for cdecimal and use it if it exists.
 from future.utils import with_metaclass
 
-__all__ = ["ChunkIterator", "DBObject", "CatalogDBObject", "fileDBObject"]
+__all__ = ["ChunkIterator", "KeysetChunkIterator", "PartitionedChunkIterator", "MultiBoundsChunkIterator",
+           "DBObject", "CatalogDBObject", "fileDBObject", "sqlite_profiles"]
 
 def valueOfPi():
     """
     A function to return the value of pi.  This is needed for adding PI()
     to sqlite databases
     """
-    return numpy.pi
+    return math.pi
 
-def declareTrigFunctions(conn,connection_rec,connection_proxy):
+def _null_safe(function):
+    """
+    Wrap a function of floats from the math module for use in sqlite:
+    NULL arguments and arguments outside of the function's domain (which
+    make math raise an exception, and would abort the whole query) give NULL
+    """
+    def wrapped(*args):
+        try:
+            return function(*args)
+        except (TypeError, ValueError, OverflowError):
+            return None
+    return wrapped
+
+def _create_function(conn, name, n_args, function):
+    try:
+        conn.create_function(name, n_args, function, deterministic=True)
+    except (TypeError, NotImplementedError, AttributeError):
+        # python < 3.8 or sqlite < 3.8.3 cannot flag functions as deterministic
+        conn.create_function(name, n_args, function)
+
+def declareTrigFunctions(conn,connection_rec,connection_proxy=None):
     """
     A database event listener
     which will define the math functions necessary for evaluating the
     Haversine function in sqlite databases (where they are not otherwise
     defined)
 
+    The functions come from the math module (which is much cheaper to call
+    on one value at a time than numpy) and are declared deterministic, so
+    that sqlite may evaluate them once for constant arguments.
+
     see:    http://docs.sqlalchemy.org/en/latest/core/events.html
     """
 
-    conn.create_function("COS",1,numpy.cos)
-    conn.create_function("SIN",1,numpy.sin)
-    conn.create_function("ASIN",1,numpy.arcsin)
-    conn.create_function("SQRT",1,numpy.sqrt)
-    conn.create_function("POWER",2,numpy.power)
-    conn.create_function("PI",0,valueOfPi)
+    _create_function(conn, "COS", 1, _null_safe(math.cos))
+    _create_function(conn, "SIN", 1, _null_safe(math.sin))
+    _create_function(conn, "ASIN", 1, _null_safe(math.asin))
+    _create_function(conn, "SQRT", 1, _null_safe(math.sqrt))
+    _create_function(conn, "POWER", 2, _null_safe(math.pow))
+    _create_function(conn, "PI", 0, valueOfPi)
+
+#: Named sets of PRAGMAs that DBConnection can apply to every new sqlite
+#: connection (see the sqlite_profile kwarg of DBConnection).  'read' is
+#: for reading large local databases: it memory-maps up to 1 GB of the file,
+#: gives the page cache 256 MB, keeps temporary tables and indices in memory
+#: and makes the connection read-only; it never writes to the database file.
+#: 'read_wal' also switches the database to write-ahead logging (so readers
+#: do not block each other or a writer).  That is a change to the file
+#: itself, which persists: it needs write access to the file and its
+#: directory (for the -wal and -shm files), and it changes the file's
+#: modification time and size, which discards results cached for it by
+#: QueryCache and SchemaCache.  The PRAGMAs are applied in order;
+#: journal_mode has to come before query_only.
+sqlite_profiles = {'read': OrderedDict([('mmap_size', 1073741824),
+                                        ('cache_size', -262144),
+                                        ('temp_store', 'MEMORY'),
+                                        ('query_only', 'ON')]),
+                   'read_wal': OrderedDict([('journal_mode', 'WAL'),
+                                            ('mmap_size', 1073741824),
+                                            ('cache_size', -262144),
+                                            ('temp_store', 'MEMORY'),
+                                            ('query_only', 'ON')])}
+
+#------------------------------------------------------------
+# dtype inference for the results of arbitrary queries
+
+# characters numpy.genfromtxt deletes from field names
+_deleted_name_chars = set("""~!@#$%^&*()-=+~\\|]}[{';: /?.>,<""")
+
+
+def _validate_names(names):
+    """
+    Turn the column names of a result set into valid, unique numpy field
+    names the way numpy.genfromtxt does, e.g. 'MAX(thrice)' becomes
+    'MAXthrice' and a second 'id' becomes 'id_1'
+    """
+    validated = []
+    seen = {}
+    n_empty = 0
+    for name in names:
+        name = str(name).strip().replace(' ', '_')
+        name = ''.join([cc for cc in name if cc not in _deleted_name_chars])
+        if name == '':
+            name = 'f%d' % n_empty
+            n_empty += 1
+        elif name in ('return', 'file', 'print'):
+            name += '_'
+        n_seen = seen.get(name, 0)
+        if n_seen > 0:
+            validated.append('%s_%d' % (name, n_seen))
+        else:
+            validated.append(name)
+        seen[name] = n_seen + 1
+    return validated
+
+
+def _python_kind(python_type):
+    """
+    Return which of bool, int, float, str or bytes a python type
+    is stored as in a numpy array (object if it is none of them)
+    """
+    if issubclass(python_type, (bool, numpy.bool_)):
+        return bool
+    if issubclass(python_type, numbers.Integral):
+        return int
+    if issubclass(python_type, (numbers.Real, decimal.Decimal)):
+        return float
+    if issubclass(python_type, str):
+        return str
+    if issubclass(python_type, bytes):
+        return bytes
+    return object
+
+
+def _sampled_kind(values):
+    """
+    Return the kind (see _python_kind) that can hold all of the non-NULL
+    values in a column of results (None if they are all NULL)
+    """
+    kinds = set([_python_kind(tt) for tt in set(map(type, values)) if tt is not type(None)])
+    if len(kinds) == 0:
+        return None
+    if len(kinds) == 1:
+        return kinds.pop()
+    if kinds == set([int, float]):
+        return float
+    return object
+
+
+def _resolve_kind(declared, sampled):
+    """
+    Combine the kind a column is declared to have (by SQLAlchemy or the
+    DBAPI cursor) with the kind of the values actually returned.  The
+    declared kind is used unless the values contradict it.
+    """
+    if sampled is None:
+        return float if declared in (None, numbers.Number) else declared
+    if declared is float and sampled is int:
+        return float
+    return sampled
 
 #------------------------------------------------------------
 # Iterator for database chunks
 
+class _PrefetchError(object):
+    """
+    Wrapper used to pass an exception raised in a _PrefetchWorker
+    back to the thread consuming the ChunkIterator
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class _PrefetchWorker(threading.Thread):
+    """
+    A background thread that executes the query belonging to a ChunkIterator,
+    and then fetches and post-processes chunks of the result, storing up to
+    queue_depth of them in a bounded queue until the ChunkIterator asks for them.
+
+    By default, the query is executed on the ChunkIterator's connection and the
+    worker has its own queue; session and output_queue override these (so that
+    several workers can run queries on different connections and, optionally,
+    share one queue).
+    """
+
+    _done = object()  # sentinel marking the end of the results
+
+    def __init__(self, chunk_iterator, query, queue_depth, session=None, output_queue=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        # only hold a weak reference to the ChunkIterator, so that
+        # a consumer abandoning the iterator shuts this thread down
+        self._chunk_iterator = weakref.ref(chunk_iterator)
+        if session is None:
+            session = chunk_iterator.dbobj.connection.session
+        self._session = session
+        self._query = query
+        if output_queue is None:
+            output_queue = queue.Queue(maxsize=queue_depth)
+        self._queue = output_queue
+        self._stop_event = threading.Event()
+        self._exhausted = False
+
+    def run(self):
+        # the connection's session is a scoped_session, so this thread
+        # executes the query on its own session (and database connection)
+        session = self._session
+        try:
+            chunk_iterator = self._chunk_iterator()
+            if chunk_iterator is None:
+                return
+            exec_query = chunk_iterator._execute(session, self._query)
+            del chunk_iterator
+            try:
+                while not self._stop_event.is_set():
+                    chunk_iterator = self._chunk_iterator()
+                    if chunk_iterator is None:
+                        break
+                    chunk = chunk_iterator._fetch_chunk(exec_query)
+                    if len(chunk) == 0:
+                        chunk_iterator._finish()
+                        break
+                    result = chunk_iterator._postprocess_results(chunk, exec_query=exec_query)
+                    del chunk_iterator
+                    self._put(result)
+            finally:
+                exec_query.close()
+            self._put(self._done)
+        except Exception as ee:
+            self._put(_PrefetchError(ee))
+        finally:
+            session.remove()
+
+    def _put(self, item):
+        """
+        Put item on the queue, giving up if the consumer asks us to stop
+        """
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        """
+        Return the next post-processed chunk, raising StopIteration when
+        the results are exhausted (or the worker was stopped), and re-raising
+        any exception raised by the worker.
+        """
+        if self._exhausted:
+            raise StopIteration
+
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if not self.is_alive() and self._queue.empty():
+                    item = self._done
+                    break
+
+        if item is self._done:
+            self._exhausted = True
+            raise StopIteration
+        if isinstance(item, _PrefetchError):
+            self._exhausted = True
+            raise item.exception
+        return item
+
+    def stop(self):
+        """
+        Tell the worker to stop fetching chunks and wait for it to exit
+        """
+        self._exhausted = True
+        self._stop_event.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
 class ChunkIterator(object):
     """Iterator for query chunks"""
-    def __init__(self, dbobj, query, chunk_size, arbitrarySQL = False):
+    # number of rows in the first chunk when sizing chunks by chunk_bytes
+    # without an estimate of the size of a row
+    _probe_rows = 1000
+
+    def __init__(self, dbobj, query, chunk_size, arbitrarySQL = False,
+                 stream_results = None, prefetch = None,
+                 chunk_bytes = None, row_bytes = None, cache_writer = None,
+                 bounds = None, stats = None, plan = None):
+        """
+        @param [in] dbobj is the DBObject whose connection will execute the query
+
+        @param [in] query is either a sqlalchemy Query or a string of SQL
+
+        @param [in] chunk_size is the number of rows to return per chunk
+        (None means return all of the rows as a single chunk)
+
+        @param [in] arbitrarySQL is a boolean indicating whether the rows
+        should be post-processed as the results of an arbitrary SQL query
+
+        @param [in] stream_results is a boolean controlling whether rows
+        are streamed from the database chunk_size rows at a time, rather than
+        being buffered client-side all at once.  Defaults to True if chunk_size
+        is specified.
+
+        @param [in] prefetch is an optional int.  If specified, a background
+        thread will execute the query and fetch and post-process up to prefetch
+        chunks ahead of the consumer, so that database I/O overlaps with whatever
+        the consumer does with each chunk.  Call close() (or exhaust the iterator)
+        to shut the thread down.
+
+        @param [in] chunk_bytes is an optional memory budget per chunk, either
+        an int number of bytes or a string like '256MB'.  If specified (instead
+        of chunk_size), the number of rows per chunk is chosen so that each chunk,
+        plus whatever the consumer reports allocating per row through
+        set_row_overhead(), fits in the budget.  The number of rows is re-derived
+        from the actual size of each chunk as chunks are returned.
+
+        @param [in] row_bytes is an optional estimate of the size in bytes of one
+        post-processed row, used to size the first chunk when chunk_bytes is
+        specified.  If not given, the first chunk is a probe of _probe_rows rows.
+
+        @param [in] cache_writer is an optional object (see QueryCache) to which
+        each chunk is passed (through its add_chunk method) after being converted
+        into a recarray, but before _final_pass.  Its commit method is called once
+        all of the rows have been returned; its abort method is called if the
+        iterator is closed before then.
+
+        @param [in] bounds are optional circular bounds (from an ObservationMetaData)
+        which the rows of query (a CatalogDBObject query, filtered with exact=False)
+        are tested against as they are fetched; see CatalogDBObject._bounds_mask.
+        Chunks still contain chunk_size rows (bar the last).
+
+        @param [in] stats is an optional QueryStats, in which the SQL of the
+        query and the timings of its execution and of each chunk are recorded.
+        It is also available as the stats attribute of the iterator.
+
+        @param [in] plan is an optional ConversionPlan (see
+        CatalogDBObject._get_query_conversion_plan) with which the rows of
+        each chunk are converted into a recarray, rather than working out the
+        dtype of every chunk from its rows
+        """
+        chunk_size = self._init_state(dbobj, chunk_size, chunk_bytes=chunk_bytes,
+                                      row_bytes=row_bytes, arbitrarySQL=arbitrarySQL,
+                                      cache_writer=cache_writer, bounds=bounds,
+                                      stats=stats, plan=plan)
+        if self.bounds is not None:
+            query = dbobj._add_bounds_columns(query)
+
+        # the text of an arbitrary query is the key under which
+        # the dtype inferred for its results is cached
+        if self.arbitrarySQL:
+            try:
+                is_string = isinstance(query, basestring)
+            except:
+                is_string = isinstance(query, str)
+            if is_string:
+                self._query_text = query
+
+        if stream_results is None:
+            stream_results = chunk_size is not None
+        self.stream_results = stream_results
+
+        if self.stream_results:
+            query = self._make_streaming(query, chunk_size)
+
+        if prefetch is not None and prefetch < 1:
+            raise ValueError("prefetch must be a positive int; you gave %s" % str(prefetch))
+
+        if prefetch is not None and not self._can_prefetch():
+            warnings.warn("Cannot prefetch chunks from an in-memory sqlite database "
+                          "(a background thread cannot see it); fetching synchronously")
+            prefetch = None
+        self.prefetch = prefetch
+
+        if self.stats is not None:
+            self.stats.set_query(dbobj.connection, query)
+
+        if self.prefetch is not None:
+            self._worker = _PrefetchWorker(self, query, self.prefetch)
+            self._worker.start()
+        else:
+            self.exec_query = self._execute(dbobj.connection.session, query)
+
+    def _init_state(self, dbobj, chunk_size, chunk_bytes=None, row_bytes=None,
+                    arbitrarySQL=False, stream_results=False, prefetch=None,
+                    cache_writer=None, bounds=None, stats=None, plan=None):
+        """
+        Set every attribute read by the methods of ChunkIterator (and its
+        subclasses) that are not specific to one of them.  The arguments are as
+        in __init__; every constructor calls this first.  Returns self.chunk_size.
+        """
         self.dbobj = dbobj
-        self.exec_query = dbobj.connection.session.execute(query)
-        self.chunk_size = chunk_size
+        self.exec_query = None
+        self._worker = None
 
         #arbitrarySQL exists in case a CatalogDBObject calls
         #get_arbitrary_chunk_iterator; in that case, we need to
         #be able to tell this object to call _postprocess_arbitrary_results,
         #rather than _postprocess_results
         self.arbitrarySQL = arbitrarySQL
+        self._query_text = None
+
+        self.stream_results = stream_results
+        self.prefetch = prefetch
+        self.cache_writer = cache_writer
+        self.bounds = bounds
+        self.stats = stats
+        self.plan = plan
+        self._fetch_time = 0.0
+        return self._set_chunk_size(chunk_size, chunk_bytes, row_bytes)
+
+    def _set_chunk_size(self, chunk_size, chunk_bytes, row_bytes):
+        """
+        Set self.chunk_size (and the attributes used to size chunks by
+        chunk_bytes) from the constructor arguments.  Returns self.chunk_size.
+        """
+        if chunk_bytes is not None:
+            if chunk_size is not None:
+                raise ValueError("Cannot specify both chunk_size and chunk_bytes")
+            chunk_bytes = parse_byte_budget(chunk_bytes)
+        self.chunk_bytes = chunk_bytes
+        self._row_bytes = row_bytes
+        self._row_overhead = 0
+
+        if self.chunk_bytes is not None:
+            if self._row_bytes is None:
+                chunk_size = self._probe_rows
+            else:
+                chunk_size = self._rows_in_budget()
+        self.chunk_size = chunk_size
+        return chunk_size
+
+    @staticmethod
+    def _make_streaming(query, chunk_size):
+        """
+        Return a version of query that will not be buffered client-side.
+
+        The ORM Query path pre-fetches every row of the result before the
+        first call to fetchmany, so we execute the underlying statement with
+        yield_per instead.  stream_results requests a server-side cursor on
+        dialects that support one (it is ignored by the others).
+        """
+        if hasattr(query, 'statement'):
+            query = query.statement
+        elif not hasattr(query, 'execution_options'):
+            query = text(query)
+
+        options = {'stream_results': True}
+        if chunk_size is not None:
+            options['yield_per'] = chunk_size
+        return query.execution_options(**options)
+
+    def _can_prefetch(self):
+        """
+        A background thread gets its own database connection; in-memory
+        sqlite databases are private to the connection that created them.
+        """
+        engine_url = self.dbobj.connection.engine.url
+        if self.dbobj.connection.engine.dialect.name != 'sqlite':
+            return True
+        return engine_url.database not in (None, '', ':memory:')
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.chunk_size is None:
-            chunk = self.exec_query.fetchall()
-            return self._postprocess_results(chunk)
-        elif self.chunk_size is not None:
-            chunk = self.exec_query.fetchmany(self.chunk_size)
-            return self._postprocess_results(chunk)
-        else:
+        if self._worker is not None:
+            return self._worker.get()
+        chunk = self._fetch_chunk(self.exec_query)
+        if len(chunk) == 0:
+            self._finish()
             raise StopIteration
+        result = self._postprocess_results(chunk, exec_query=self.exec_query)
+        if self.chunk_size is None:
+            # fetchall has returned every row
+            self._finish()
+        return result
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
-    def _postprocess_results(self, chunk):
+    def close(self):
+        """
+        Stop iterating, shutting down the prefetch thread (if any)
+        """
+        if self._worker is not None:
+            self._worker.stop()
+        if self.cache_writer is not None:
+            self.cache_writer.abort()
+            self.cache_writer = None
+
+    def _finish(self):
+        """
+        Called once all of the rows of the query have been fetched
+        """
+        if self.cache_writer is not None:
+            self.cache_writer.commit()
+            self.cache_writer = None
+
+    def set_row_overhead(self, row_overhead):
+        """
+        Tell the iterator how many bytes per row the consumer allocates
+        on top of each chunk it is handed (e.g. the columns an InstanceCatalog
+        computes from the chunk).  Only used when sizing chunks by chunk_bytes.
+        The largest overhead reported is kept, so that subsequent chunks stay
+        within the budget.
+        """
+        self._row_overhead = max(self._row_overhead, int(numpy.ceil(row_overhead)))
+        if self.chunk_bytes is not None and self._row_bytes is not None:
+            self.chunk_size = self._rows_in_budget()
+
+    def _rows_in_budget(self):
+        """
+        The number of rows that fit in chunk_bytes, given the current estimate
+        of the bytes per row (never less than one row)
+        """
+        return max(1, self.chunk_bytes//max(1, self._row_bytes + self._row_overhead))
+
+    def _execute(self, session, query):
+        """
+        Execute query on session, recording how long that takes in self.stats
+        """
+        stats = self.stats
+        if stats is None:
+            return session.execute(query)
+        start = stats.timer()
+        exec_query = session.execute(query)
+        stats.execute_time = stats.timer() - start
+        return exec_query
+
+    def _fetch_chunk(self, exec_query):
+        stats = self.stats
+        if stats is None:
+            return self._fetch_rows(exec_query)
+        start = stats.timer()
+        chunk = self._fetch_rows(exec_query)
+        # read by _postprocess_results, which is always called next in the same thread
+        self._fetch_time = stats.timer() - start
+        return chunk
+
+    def _fetch_rows(self, exec_query):
+        if self.bounds is not None:
+            return self._fetch_chunk_in_bounds(exec_query)
+        if self.chunk_size is None:
+            return exec_query.fetchall()
+        return exec_query.fetchmany(self.chunk_size)
+
+    def _fetch_chunk_in_bounds(self, exec_query):
+        """
+        Fetch rows, keeping those within self.bounds, until there are chunk_size
+        of them (or all of the rows have been fetched)
+        """
+        chunk = []
+        while True:
+            if self.chunk_size is None:
+                rows = exec_query.fetchall()
+            else:
+                rows = exec_query.fetchmany(self.chunk_size - len(chunk))
+            if len(rows) == 0:
+                return chunk
+            mask = self.dbobj._bounds_mask(rows, self.bounds)
+            chunk.extend([rows[ii] for ii in numpy.flatnonzero(mask)])
+            if self.chunk_size is None or len(chunk) >= self.chunk_size:
+                return chunk
+
+    def _postprocess_results(self, chunk, exec_query=None):
         if len(chunk)==0:
             raise StopIteration
+        stats = self.stats
         if self.arbitrarySQL:
-            return self.dbobj._postprocess_arbitrary_results(chunk)
+            if self.dbobj.dtype is None:
+                self.dbobj.dtype = self.dbobj._infer_dtype(chunk, exec_query=exec_query,
+                                                           query=self._query_text)
+            if stats is None:
+                result = self.dbobj._postprocess_arbitrary_results(chunk)
+            else:
+                result = self._timed_postprocess(chunk, self.dbobj._convert_results_to_numpy_recarray_dbobj)
+        elif self.cache_writer is not None or stats is not None or self.plan is not None:
+            result = self._timed_postprocess(chunk, self._convert_catalog_results)
         else:
-            return self.dbobj._postprocess_results(chunk)
+            result = self.dbobj._postprocess_results(chunk)
+
+        if self.chunk_bytes is not None:
+            nbytes = getattr(result, 'nbytes', None)
+            if nbytes is not None and len(result) > 0:
+                self._row_bytes = int(numpy.ceil(float(nbytes)/len(result)))
+                self.chunk_size = self._rows_in_budget()
+        return result
+
+    def _convert_catalog_results(self, chunk):
+        """
+        Convert the rows of a CatalogDBObject query into a recarray
+        (with self.plan, if there is one)
+        """
+        return self.dbobj._convert_results_to_numpy_recarray_catalogDBObj(chunk,
+                                                                          plan=self.plan)
+
+    def _timed_postprocess(self, chunk, convert):
+        """
+        Convert chunk into a recarray with convert, pass it to the cache_writer
+        (if any), and apply the _final_pass of dbobj, recording the timings of
+        the chunk in self.stats (if any)
+        """
+        stats = self.stats
+        if stats is not None:
+            start = stats.timer()
+        converted = convert(chunk)
+        if self.cache_writer is not None:
+            self.cache_writer.add_chunk(converted)
+        if stats is None:
+            return self.dbobj._final_pass(converted)
+
+        convert_time = stats.timer() - start
+        start = stats.timer()
+        result = self.dbobj._final_pass(converted)
+        final_pass_time = stats.timer() - start
+        stats.add_chunk(ChunkStats(n_rows=len(result), nbytes=getattr(result, 'nbytes', 0),
+                                   fetch_time=self._fetch_time,
+                                   convert_time=convert_time, final_pass_time=final_pass_time))
+        return result
+
+
+class KeysetChunkIterator(ChunkIterator):
+    """
+    Iterator for query chunks that pages through the results of a
+    CatalogDBObject query by the value of its id column, i.e. each chunk
+    is the result of a separate query
+
+        ... WHERE idCol > :last_id ORDER BY idCol LIMIT :chunk_size
+
+    No cursor (or database connection) is held open between chunks, so
+    the iteration can be stopped and later resumed from the position
+    property, which is JSON-serializable.  The id column must be unique.
+    """
+    def __init__(self, dbobj, query, id_column, chunk_size, limit=None,
+                 resume_from=None, chunk_bytes=None, row_bytes=None, plan=None):
+        """
+        @param [in] dbobj is the CatalogDBObject whose connection will execute the query
+
+        @param [in] query is a sqlalchemy Query whose first column is id_column
+        (without a limit; see below)
+
+        @param [in] id_column is the (unique) table column to page on
+
+        @param [in] chunk_size is the number of rows to return per chunk
+
+        @param [in] limit is an optional limit on the total number of rows returned
+
+        @param [in] resume_from is an optional position (as returned by the
+        position property of a previous KeysetChunkIterator over the same query)
+        after which to start returning rows
+
+        @param [in] chunk_bytes, row_bytes and plan are as in ChunkIterator
+        """
+        chunk_size = self._init_state(dbobj, chunk_size, chunk_bytes=chunk_bytes,
+                                      row_bytes=row_bytes, plan=plan)
+        if chunk_size is None:
+            raise ValueError("Keyset pagination requires either chunk_size or chunk_bytes")
+
+        self._query = query
+        self._id_column = id_column
+        self._limit = limit
+        self._n_returned = 0
+        self._exhausted = False
+        self._last_id = None
+
+        if resume_from is not None:
+            if resume_from.get('id_column') != id_column.name:
+                raise ValueError("Cannot resume paging on %s from a position on %s"
+                                 % (id_column.name, resume_from.get('id_column')))
+            self._last_id = resume_from['last_id']
+            self._n_returned = resume_from.get('n_returned', 0)
+
+    @property
+    def position(self):
+        """
+        A JSON-serializable dict recording how far through the results the
+        chunks returned so far have reached.  Pass it as resume_from to
+        query_columns to pick up where this iterator left off.
+        """
+        return {'id_column': self._id_column.name,
+                'last_id': self._last_id,
+                'n_returned': self._n_returned}
+
+    def _page_query(self, n_rows):
+        query = self._query
+        if self._last_id is not None:
+            query = query.filter(self._id_column > self._last_id)
+        return query.order_by(self._id_column).limit(n_rows).statement
+
+    def __next__(self):
+        if self._exhausted:
+            raise StopIteration
+
+        n_rows = self.chunk_size
+        if self._limit is not None:
+            n_rows = min(n_rows, self._limit - self._n_returned)
+            if n_rows <= 0:
+                self._exhausted = True
+                raise StopIteration
+
+        # check a connection out of the engine's pool for just this page
+        with self.dbobj.connection.engine.connect() as conn:
+            chunk = conn.execute(self._page_query(n_rows)).fetchall()
+
+        if len(chunk) < n_rows:
+            self._exhausted = True
+        if len(chunk) == 0:
+            raise StopIteration
+
+        last_id = chunk[-1][0]
+        if isinstance(last_id, numpy.generic):
+            last_id = last_id.item()
+
+        result = self._postprocess_results(chunk)
+        self._last_id = last_id
+        self._n_returned += len(chunk)
+        return result
+
+
+class PartitionedChunkIterator(ChunkIterator):
+    """
+    Iterator for query chunks that splits a CatalogDBObject query into
+    n_partitions ranges of its (integer) id column -- or of the rowid, for
+    sqlite tables whose id column is not an integer -- and runs each range
+    on its own DBConnection in a background thread, so that the database
+    can work on all of the partitions at once.
+
+    If ordered is True, chunks are returned partition by partition, in order
+    of the id ranges; otherwise, chunks are returned as soon as any partition
+    has produced one.  Each partition holds at most queue_depth chunks waiting
+    to be consumed.
+
+    Each partition is a range query on the partitioning column, so that
+    column should be indexed (the sqlite rowid always is).
+    """
+    def __init__(self, dbobj, query, id_column, n_partitions, chunk_size,
+                 ordered=True, queue_depth=2, limit=None,
+                 chunk_bytes=None, row_bytes=None, plan=None):
+        """
+        @param [in] dbobj is the CatalogDBObject whose database will be queried
+
+        @param [in] query is a sqlalchemy Query (without a limit; see below)
+
+        @param [in] id_column is the table column on which to partition the query
+
+        @param [in] n_partitions is the number of partitions (and connections)
+
+        @param [in] chunk_size is the number of rows to return per chunk
+
+        @param [in] ordered is a boolean controlling whether chunks are returned
+        in order of the partitions
+
+        @param [in] queue_depth is the number of chunks each partition may fetch
+        ahead of the consumer
+
+        @param [in] limit is an optional limit on the total number of rows returned
+
+        @param [in] chunk_bytes, row_bytes and plan are as in ChunkIterator
+        """
+        self._workers = []
+        self._connections = []
+        self._exhausted = False
+
+        chunk_size = self._init_state(dbobj, chunk_size, chunk_bytes=chunk_bytes,
+                                      row_bytes=row_bytes, stream_results=True,
+                                      prefetch=queue_depth, plan=plan)
+        if chunk_size is None:
+            raise ValueError("Partitioned queries require either chunk_size or chunk_bytes")
+        if n_partitions < 1:
+            raise ValueError("n_partitions must be a positive int; you gave %s" % str(n_partitions))
+        if queue_depth < 1:
+            raise ValueError("queue_depth must be a positive int; you gave %s" % str(queue_depth))
+        if not self._can_prefetch():
+            raise ValueError("Cannot partition a query on an in-memory sqlite database "
+                             "(other connections cannot see it)")
+
+        self.ordered = ordered
+        self._limit = limit
+        self._n_returned = 0
+        self._i_worker = 0
+        self._n_done = 0
+
+        partition_column, ranges = self._get_partitions(query, id_column, n_partitions)
+        self.n_partitions = len(ranges)
+
+        self._queue = None
+        if not self.ordered:
+            self._queue = queue.Queue(maxsize=max(1, queue_depth*self.n_partitions))
+
+        connection = dbobj.connection
+        for i_range, (range_min, range_max) in enumerate(ranges):
+            partition = query.filter(partition_column >= range_min)
+            if i_range == len(ranges)-1:
+                partition = partition.filter(partition_column <= range_max)
+            else:
+                partition = partition.filter(partition_column < range_max)
+
+            partition_connection = DBConnection(database=connection.database,
+                                                driver=connection.driver,
+                                                host=connection.host,
+                                                port=connection.port,
+                                                verbose=connection.verbose,
+                                                pool_size=connection.pool_size,
+                                                max_overflow=connection.max_overflow,
+                                                sqlite_profile=connection.sqlite_profile)
+            self._connections.append(partition_connection)
+            self._workers.append(_PrefetchWorker(self, self._make_streaming(partition, chunk_size),
+                                                 queue_depth, session=partition_connection.session,
+                                                 output_queue=self._queue))
+
+        for worker in self._workers:
+            worker.start()
+
+    def _get_partitions(self, query, id_column, n_partitions):
+        """
+        Find the range of id_column (or of the rowid) spanned by the
+        results of query and split it into at most n_partitions
+        contiguous ranges.
+
+        Returns the column to partition on and a list of (min, max) tuples;
+        each range includes its min but not its max, except for the last,
+        which includes both.
+        """
+        def _get_range(column):
+            return query.with_entities(func.min(column), func.max(column)).one()
+
+        partition_column = id_column
+        column_min, column_max = _get_range(partition_column)
+        if column_min is None:
+            return partition_column, []
+
+        if not (isinstance(column_min, numbers.Integral) and
+                isinstance(column_max, numbers.Integral)):
+            if self.dbobj.connection.engine.dialect.name != 'sqlite':
+                raise ValueError("Cannot partition a query on the non-integer column %s"
+                                 % id_column.name)
+            partition_column = expression.column('rowid', _selectable=id_column.table)
+            column_min, column_max = _get_range(partition_column)
+
+        column_min = int(column_min)
+        column_max = int(column_max)
+        n_values = column_max - column_min + 1
+        edges = []
+        for i_edge in range(n_partitions+1):
+            edge = column_min + (n_values*i_edge)//n_partitions
+            if len(edges) == 0 or edge > edges[-1]:
+                edges.append(edge)
+
+        ranges = [(edges[i_edge], edges[i_edge+1]) for i_edge in range(len(edges)-1)]
+        ranges[-1] = (ranges[-1][0], column_max)
+        return partition_column, ranges
+
+    def __next__(self):
+        if self._exhausted:
+            raise StopIteration
+
+        try:
+            if self.ordered:
+                result = self._next_ordered()
+            else:
+                result = self._next_unordered()
+        except BaseException:
+            self.close()
+            raise
+
+        if self._limit is not None:
+            n_wanted = self._limit - self._n_returned
+            if len(result) >= n_wanted:
+                result = result[:n_wanted]
+                self.close()
+        self._n_returned += len(result)
+        return result
+
+    def _next_ordered(self):
+        while self._i_worker < len(self._workers):
+            try:
+                return self._workers[self._i_worker].get()
+            except StopIteration:
+                self._i_worker += 1
+        self._exhausted = True
+        raise StopIteration
+
+    def _next_unordered(self):
+        while self._n_done < len(self._workers):
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self._workers) and self._queue.empty():
+                    break
+                continue
+
+            if item is _PrefetchWorker._done:
+                self._n_done += 1
+            elif isinstance(item, _PrefetchError):
+                raise item.exception
+            else:
+                return item
+
+        self._exhausted = True
+        raise StopIteration
+
+    def close(self):
+        """
+        Stop iterating, shutting down the partition threads and their connections
+        """
+        self._exhausted = True
+        for worker in self._workers:
+            worker.stop()
+        for connection in self._connections:
+            connection.engine.dispose()
+        self._connections = []
+
+
+class MultiBoundsChunkIterator(ChunkIterator):
+    """
+    Iterator for the results of one CatalogDBObject query over the union of
+    several bounds (see CatalogDBObject.query_columns_multi).  Each chunk of
+    rows fetched from the database is tested against every one of the bounds,
+    converted into a recarray once, and returned as (i_bounds, sub_chunk)
+    pairs, one for each of the bounds containing any of its rows, in order
+    of i_bounds.  Rows within several of the bounds appear in each of their
+    sub_chunks.
+    """
+    def __init__(self, dbobj, query, chunk_size, bounds_list, prefetch=None, plan=None):
+        """
+        @param [in] dbobj is the CatalogDBObject whose database will be queried
+
+        @param [in] query is a sqlalchemy Query selecting (at least) every row
+        within any of bounds_list
+
+        @param [in] chunk_size is the number of rows to fetch from the database
+        at a time (None means fetch all of the rows at once); each sub_chunk
+        holds at most chunk_size rows
+
+        @param [in] bounds_list is a list of circular or box bounds (from
+        ObservationMetaData); see CatalogDBObject._coordinates_mask
+
+        @param [in] prefetch and plan are as in ChunkIterator
+        """
+        self.bounds_list = list(bounds_list)
+        self._pending = []
+        ChunkIterator.__init__(self, dbobj, dbobj._add_bounds_columns(query), chunk_size,
+                               prefetch=prefetch, plan=plan)
+
+    def __next__(self):
+        while len(self._pending) == 0:
+            self._pending = ChunkIterator.__next__(self)
+        return self._pending.pop(0)
+
+    def _postprocess_results(self, chunk, exec_query=None):
+        if len(chunk) == 0:
+            raise StopIteration
+        ra = numpy.radians(numpy.array([row[-2] for row in chunk], dtype=float))
+        dec = numpy.radians(numpy.array([row[-1] for row in chunk], dtype=float))
+        masks = numpy.array([self.dbobj._coordinates_mask(ra, dec, bounds)
+                             for bounds in self.bounds_list], dtype=bool)
+        in_any = masks.any(axis=0)
+        if not in_any.any():
+            return []
+
+        result = self._timed_postprocess([chunk[ii] for ii in numpy.flatnonzero(in_any)],
+                                         self._convert_catalog_results)
+        masks = masks[:, in_any]
+        return [(i_bounds, result[masks[i_bounds]]) for i_bounds in range(len(self.bounds_list))
+                if masks[i_bounds].any()]
 
 
 class DBConnection(object):
@@ -110,9 +1027,36 @@ class DBConnection(object):
     This is a class that will hold the engine, session, and metadata for a
     DBObject.  This will allow multiple DBObjects to share the same
     sqlalchemy connection, when appropriate.
+
+    The session is a scoped_session, so each thread gets its own.  If the
+    process forks, the child discards the database connections it inherited
+    from the parent (without closing them, since the parent still owns them)
+    the first time it uses the DBConnection, and opens its own.
+
+    The names of the tables and columns in the database are read once and
+    then answered from memory (see get_table_names, get_column_names and
+    refresh_schema).
     """
 
-    def __init__(self, database=None, driver=None, host=None, port=None, verbose=False):
+    # SQL reading the names of the columns of every table in the current
+    # database in one query, by dialect.  Each returns (table, column) rows
+    # in column order.
+    _bulk_column_sql = {
+        'sqlite': "SELECT m.name, p.name FROM sqlite_master AS m "
+                  "JOIN pragma_table_info(m.name) AS p "
+                  "WHERE m.type IN ('table', 'view') ORDER BY m.name, p.cid",
+        'postgresql': "SELECT table_name, column_name FROM information_schema.columns "
+                      "WHERE table_schema = current_schema() "
+                      "ORDER BY table_name, ordinal_position",
+        'mysql': "SELECT table_name, column_name FROM information_schema.columns "
+                 "WHERE table_schema = DATABASE() "
+                 "ORDER BY table_name, ordinal_position",
+        'mssql': "SELECT table_name, column_name FROM information_schema.columns "
+                 "WHERE table_schema = SCHEMA_NAME() "
+                 "ORDER BY table_name, ordinal_position"}
+
+    def __init__(self, database=None, driver=None, host=None, port=None, verbose=False,
+                 pool_size=None, max_overflow=None, sqlite_profile=None):
         """
         @param [in] database is the name of the database file being connected to
 
@@ -123,6 +1067,18 @@ class DBConnection(object):
         @param [in] port is the port on the remote host to connect to, if appropriate
 
         @param [in] verbose is a boolean controlling sqlalchemy's verbosity
+
+        @param [in] pool_size is the optional number of connections the engine
+        keeps open (passed to sqlalchemy.create_engine if the dialect uses a
+        QueuePool; ignored, with a warning, otherwise)
+
+        @param [in] max_overflow is the optional number of connections the engine
+        may open beyond pool_size (passed on, or ignored, as is pool_size)
+
+        @param [in] sqlite_profile is an optional set of PRAGMAs to apply to each
+        new connection to a sqlite database: either the name of one of the profiles
+        in sqlite_profiles (e.g. 'read') or a dict mapping PRAGMA names to values.
+        It is ignored for other dialects.
         """
 
         self._database = database
@@ -130,8 +1086,20 @@ class DBConnection(object):
         self._host = host
         self._port = port
         self._verbose = verbose
+        self._pool_size = pool_size
+        self._max_overflow = max_overflow
+        self._sqlite_profile = sqlite_profile
+        self._sqlite_pragmas = self._get_sqlite_pragmas(sqlite_profile)
 
         self._validate_conn_params()
+        self._fork_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._schema_lock = threading.RLock()
+        self._inspector = None
+        self._table_names = None
+        self._column_names = {}
+        # the asyncio engines made by asyncQuery.get_async_engine, by event loop
+        self._async_engines = weakref.WeakKeyDictionary()
         self._connect_to_engine()
 
     def __del__(self):
@@ -150,8 +1118,11 @@ class DBConnection(object):
         except AttributeError:
             pass
 
-    def _connect_to_engine(self):
-
+    def _get_url(self):
+        """
+        Return the sqlalchemy URL of the database (with credentials
+        from DbAuth, if the database is on a remote host)
+        """
         #DbAuth will not look up hosts that are None, '' or 0
         if self._host:
             # This is triggered when you need to connect to a remote database.
@@ -176,17 +1147,120 @@ class DBConnection(object):
         else:
             dbUrl = url.URL.create(self._driver,
                                    database=self._database)
+        return dbUrl
 
+    @staticmethod
+    def _uses_queue_pool(dbUrl):
+        """
+        Return True if create_engine gives the database at the sqlalchemy URL
+        dbUrl a QueuePool (the only pools that take pool_size and max_overflow;
+        e.g. sqlite databases in files get a NullPool)
+        """
+        return issubclass(dbUrl.get_dialect().get_pool_class(dbUrl), QueuePool)
 
-        self._engine = create_engine(dbUrl, echo=self._verbose)
+    @staticmethod
+    def _get_pool_kwargs(dbUrl, pool_size, max_overflow):
+        """
+        Return the dict of the pool_size and max_overflow (those that are not None)
+        to pass to create_engine for the database at the sqlalchemy URL dbUrl.
+        They are dropped, with a warning, if its pool is not a QueuePool.
+        """
+        pool_kwargs = {}
+        if pool_size is not None:
+            pool_kwargs['pool_size'] = pool_size
+        if max_overflow is not None:
+            pool_kwargs['max_overflow'] = max_overflow
+        if len(pool_kwargs) > 0 and not DBConnection._uses_queue_pool(dbUrl):
+            warnings.warn("Ignoring %s: the connection pool of %s databases is a %s"
+                          % (', '.join(sorted(pool_kwargs)), dbUrl.drivername,
+                             dbUrl.get_dialect().get_pool_class(dbUrl).__name__))
+            return {}
+        return pool_kwargs
+
+    def _connect_to_engine(self):
+        dbUrl = self._get_url()
+        pool_kwargs = self._get_pool_kwargs(dbUrl, self._pool_size, self._max_overflow)
+        self._engine = create_engine(dbUrl, echo=self._verbose, **pool_kwargs)
 
         if self._engine.dialect.name == 'sqlite':
-            event.listen(self._engine, 'checkout', declareTrigFunctions)
+            event.listen(self._engine, 'connect', declareTrigFunctions)
+            if len(self._sqlite_pragmas) > 0:
+                event.listen(self._engine, 'connect', self._set_sqlite_pragmas)
 
         self._session = scoped_session(sessionmaker(autoflush=True,
                                                     bind=self._engine))
         self._metadata = MetaData(bind=self._engine)
 
+    @staticmethod
+    def _get_sqlite_pragmas(sqlite_profile):
+        """
+        Return the OrderedDict of PRAGMAs (name: value) described by sqlite_profile
+        """
+        if sqlite_profile is None:
+            return OrderedDict()
+        try:
+            is_string = isinstance(sqlite_profile, basestring)
+        except:
+            is_string = isinstance(sqlite_profile, str)
+        if is_string:
+            if sqlite_profile not in sqlite_profiles:
+                raise ValueError("Unknown sqlite_profile '%s'; the known profiles are %s"
+                                 % (sqlite_profile, str(sorted(sqlite_profiles.keys()))))
+            return OrderedDict(sqlite_profiles[sqlite_profile])
+
+        pragmas = OrderedDict(sqlite_profile)
+        for name, value in pragmas.items():
+            # PRAGMAs cannot take bound parameters, so only allow
+            # names and values that cannot smuggle in other SQL
+            if not str(name).isidentifier() or \
+               not (isinstance(value, numbers.Integral) or str(value).lstrip('-').isalnum()):
+                raise ValueError("Invalid sqlite PRAGMA %s=%s" % (str(name), str(value)))
+        return pragmas
+
+    def _set_sqlite_pragmas(self, dbapi_connection, connection_record):
+        """
+        A database event listener which applies self._sqlite_pragmas
+        to each new connection
+        """
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self._sqlite_pragmas.items():
+                try:
+                    cursor.execute('PRAGMA %s=%s' % (name, value))
+                except self._engine.dialect.dbapi.Error as e:
+                    # e.g. WAL cannot be enabled on a read-only database file
+                    warnings.warn("Could not set sqlite PRAGMA %s=%s on %s: %s"
+                                  % (name, value, self._database, str(e)))
+        finally:
+            cursor.close()
+
+    def _check_process(self):
+        """
+        If this process was forked from the one that opened the connection,
+        drop the pooled connections and the sessions inherited from the parent
+        (sharing them between processes corrupts them, sqlite handles in
+        particular) so that this process opens its own.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._fork_lock:
+            if self._pid == os.getpid():
+                return
+            self._engine.dispose(close=False)
+            self._session = scoped_session(sessionmaker(autoflush=True,
+                                                        bind=self._engine))
+            self._schema_lock = threading.RLock()
+            self._pid = os.getpid()
+
+    def dispose(self):
+        """
+        Close the idle connections held by the engine's pool.  The DBConnection
+        remains usable; new connections are opened as they are needed.
+        """
+        self._check_process()
+        self._session.remove()
+        self._engine.dispose()
+
 
     def _validate_conn_params(self):
         """Validate connection parameters
@@ -239,17 +1313,103 @@ class DBConnection(object):
                (str(self._port) == str(other._port))
 
 
+    @property
+    def inspector(self):
+        """
+        A sqlalchemy Inspector on the engine.  It caches everything it reflects
+        until refresh_schema() is called.
+        """
+        self._check_process()
+        with self._schema_lock:
+            if self._inspector is None:
+                self._inspector = sa_inspect(self._engine)
+            return self._inspector
+
+    def refresh_schema(self):
+        """
+        Forget the table and column names read from the database, so
+        that they are read again (e.g. after tables have been created)
+        """
+        self._check_process()
+        with self._schema_lock:
+            self._inspector = None
+            self._table_names = None
+            self._column_names = {}
+
+    def get_table_names(self):
+        """
+        Return a list of the names of the tables (and views) in the database
+        """
+        inspector = self.inspector
+        with self._schema_lock:
+            if self._table_names is None:
+                self._table_names = [str(xx) for xx in inspector.get_table_names()] + \
+                                    [str(xx) for xx in inspector.get_view_names()]
+            return list(self._table_names)
+
+    def _get_bulk_column_names(self):
+        """
+        Return a dict mapping the name of every table in the database to the
+        list of the names of its columns, read in one query; or None if this
+        dialect has no such query (or it fails).
+        """
+        sql = self._bulk_column_sql.get(self.engine.dialect.name)
+        if sql is None:
+            return None
+        column_names = OrderedDict()
+        try:
+            with self.engine.connect() as bulk_connection:
+                for table_name, column_name in bulk_connection.execute(text(sql)):
+                    column_names.setdefault(str(table_name), []).append(str(column_name))
+        except sa_exc.DBAPIError:
+            return None
+        return column_names
+
+    def get_column_names(self, tableName=None, bulk=True):
+        """
+        Return a list of the names of the columns in the specified table.
+        If no table is specified, return a dict of lists keyed to the table names.
+
+        If bulk is True and no table is specified, the columns of every table are
+        read in one query where the dialect supports it, rather than table by table.
+        """
+        table_names = self.get_table_names()
+        if tableName is not None:
+            if tableName not in table_names:
+                return []
+            table_names = [tableName]
+
+        inspector = self.inspector
+        with self._schema_lock:
+            missing = [name for name in table_names if name not in self._column_names]
+            if bulk and len(missing) > 1:
+                bulk_names = self._get_bulk_column_names()
+                if bulk_names is not None:
+                    for name in missing:
+                        if name in bulk_names:
+                            self._column_names[name] = bulk_names[name]
+            for name in table_names:
+                if name not in self._column_names:
+                    self._column_names[name] = [str(xx['name']) for xx in inspector.get_columns(name)]
+
+            if tableName is not None:
+                return list(self._column_names[tableName])
+            return OrderedDict([(name, list(self._column_names[name])) for name in table_names])
+
     @property
     def engine(self):
+        self._check_process()
         return self._engine
 
     @property
     def session(self):
+        self._check_process()
         return self._session
 
 
     @property
     def metadata(self):
+        self._check_process()
         return self._metadata
 
     @property
@@ -272,11 +1432,106 @@ class DBConnection(object):
     def verbose(self):
         return self._verbose
 
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+    @property
+    def max_overflow(self):
+        return self._max_overflow
+
+    @property
+    def sqlite_profile(self):
+        return self._sqlite_profile
+
+
+class _ConnectionRegistry(OrderedDict):
+    """
+    A cache of open DBConnections, keyed on the tuple (driver, host, port, database),
+    so that DBObjects connecting to the same database share one connection.
+
+    Lookups are thread-safe.  The registry keeps the max_size most recently used
+    connections; when a connection is pushed out, its engine is disposed of,
+    closing the idle connections in its pool (DBObjects still holding it can
+    keep using it; the engine opens new connections as they are needed).
+    Being a dict, the registry can be emptied by sims_clean_up.
+    """
+
+    def __init__(self, max_size=None):
+        OrderedDict.__init__(self)
+        self.max_size = max_size
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+    @staticmethod
+    def make_key(driver, host, port, database, sqlite_profile=None,
+                 pool_size=None, max_overflow=None):
+        key = (str(driver), str(host), str(port), str(database))
+        if sqlite_profile is not None:
+            # connections with different PRAGMAs are not interchangeable
+            key += (repr(list(DBConnection._get_sqlite_pragmas(sqlite_profile).items())),)
+        if pool_size is not None or max_overflow is not None:
+            # nor are connections with different pools, if their dialect
+            # has a QueuePool (otherwise the pool settings are ignored)
+            try:
+                uses_queue_pool = DBConnection._uses_queue_pool(url.URL.create(str(driver),
+                                                                               database=database))
+            except sa_exc.ArgumentError:
+                uses_queue_pool = True
+            if uses_queue_pool:
+                key += ('pool', pool_size, max_overflow)
+        return key
+
+    def _get_lock(self):
+        # a lock inherited across a fork may have been held by a thread
+        # that does not exist in the child, so the child makes a new one
+        if self._pid != os.getpid():
+            self._lock = threading.RLock()
+            self._pid = os.getpid()
+        return self._lock
+
+    def get_connection(self, database, driver, host, port, pool_size=None, max_overflow=None,
+                       sqlite_profile=None):
+        """
+        Return the cached DBConnection to the specified database, opening
+        (and caching) it if there is none.
+        """
+        key = self.make_key(driver, host, port, database, sqlite_profile=sqlite_profile,
+                            pool_size=pool_size, max_overflow=max_overflow)
+        with self._get_lock():
+            conn = self.pop(key, None)
+            if conn is None:
+                conn = DBConnection(database=database, driver=driver, host=host, port=port,
+                                    pool_size=pool_size, max_overflow=max_overflow,
+                                    sqlite_profile=sqlite_profile)
+            # (re-)inserting the key makes it the most recently used
+            self[key] = conn
+
+            evicted = []
+            while self.max_size is not None and len(self) > self.max_size:
+                evicted.append(self.popitem(last=False)[1])
+
+        # DBConnection.dispose() would also remove this thread's session,
+        # which a DBObject may still be using
+        for old_conn in evicted:
+            old_conn.engine.dispose()
+
+        return conn
+
 
 class DBObject(object):
 
+    #: Optional size of the connection pool (and number of connections it may
+    #: open beyond that) for new connections; see DBConnection.  Only dialects
+    #: with a QueuePool use them (not sqlite databases in files).
+    pool_size = None
+    max_overflow = None
+
+    #: Optional set of PRAGMAs applied to new sqlite connections; see DBConnection
+    sqlite_profile = None
+
     def __init__(self, database=None, driver=None, host=None, port=None, verbose=False,
-                 connection=None, cache_connection=True):
+                 connection=None, cache_connection=True, sqlite_profile=None):
         """
         Initialize DBObject.
 
@@ -296,18 +1551,28 @@ class DBObject(object):
 
         @param [in] cache_connection is a boolean.  If True, DBObject will use a cache of
         DBConnections (if available) to get the connection to this database.
+
+        @param [in] sqlite_profile is an optional set of PRAGMAs to apply to new
+        connections to a sqlite database, e.g. 'read' (see DBConnection).  It
+        overrides the sqlite_profile class attribute, and is ignored if connection
+        is specified.
         """
 
         self.dtype = None
         #this is a cache for the query, so that any one query does not have to guess dtype multiple times
 
+        # dtypes inferred for the results of arbitrary queries, keyed on the
+        # normalized text of the query (see _infer_dtype)
+        self._dtype_cache = {}
+
         if connection is None:
             #Explicit constructor to DBObject preferred
             kwargDict = dict(database=database,
                          driver=driver,
                          host=host,
                          port=port,
-                         verbose=verbose)
+                         verbose=verbose,
+                         sqlite_profile=sqlite_profile)
 
             for key, value in kwargDict.items():
                 if value is not None or not hasattr(self, key):
@@ -330,6 +1595,8 @@ class DBObject(object):
         will for CatalogDBObject) for a DBConnection matching the specified
         parameters.  If it exists, return it.  If not, open a connection to
         the specified database, add it to the cache, and return the connection.
+        New connections are opened with the pool_size, max_overflow and
+        sqlite_profile attributes.
 
         Parameters
         ----------
@@ -347,42 +1614,40 @@ class DBObject(object):
         """
 
         if use_cache and hasattr(self, '_connection_cache'):
-            for conn in self._connection_cache:
-                if str(conn.database) == str(database):
-                    if str(conn.driver) == str(driver):
-                        if str(conn.host) == str(host):
-                            if str(conn.port) == str(port):
-                                return conn
-
-        conn = DBConnection(database=database, driver=driver, host=host, port=port)
-
-        if use_cache and hasattr(self, '_connection_cache'):
-            self._connection_cache.append(conn)
+            return self._connection_cache.get_connection(database, driver, host, port,
+                                                         pool_size=self.pool_size,
+                                                         max_overflow=self.max_overflow,
+                                                         sqlite_profile=self.sqlite_profile)
 
-        return conn
+        return DBConnection(database=database, driver=driver, host=host, port=port,
+                            pool_size=self.pool_size, max_overflow=self.max_overflow,
+                            sqlite_profile=self.sqlite_profile)
 
     def get_table_names(self):
-        """Return a list of the names of the tables (and views) in the database"""
-        return [str(xx) for xx in reflection.Inspector.from_engine(self.connection.engine).get_table_names()] + \
-        [str(xx) for xx in reflection.Inspector.from_engine(self.connection.engine).get_view_names()]
+        """
+        Return a list of the names of the tables (and views) in the database.
+        The names are read once per connection; call
+        self.connection.refresh_schema() to read them again.
+        """
+        return self.connection.get_table_names()
 
-    def get_column_names(self, tableName=None):
+    def get_column_names(self, tableName=None, bulk=True):
         """
         Return a list of the names of the columns in the specified table.
         If no table is specified, return a dict of lists.  The dict will be keyed
         to the table names.  The lists will be of the column names in that table
+
+        If bulk is True and no table is specified, the columns of every table are
+        read in a single query where the database supports it.  Column names are
+        read once per connection; call self.connection.refresh_schema() to read
+        them again.
         """
-        tableNameList = self.get_table_names()
         if tableName is not None:
-            if tableName not in tableNameList:
-                return []
-            return [str_cast(xx['name']) for xx in reflection.Inspector.from_engine(self.connection.engine).get_columns(tableName)]
-        else:
-            columnDict = {}
-            for name in tableNameList:
-                columnList = [str_cast(xx['name']) for xx in reflection.Inspector.from_engine(self.connection.engine).get_columns(name)]
-                columnDict[name] = columnList
-            return columnDict
+            return [str_cast(xx) for xx in self.connection.get_column_names(tableName)]
+        columnDict = {}
+        for name, columnList in self.connection.get_column_names(bulk=bulk).items():
+            columnDict[name] = [str_cast(xx) for xx in columnList]
+        return columnDict
 
     def _final_pass(self, results):
         """ Make final modifications to a set of data before returning it to the user
@@ -398,60 +1663,169 @@ class DBObject(object):
         """
         return results
 
-    def _convert_results_to_numpy_recarray_dbobj(self, results):
-        if self.dtype is None:
-            """
-            Determine the dtype from the data.
-            Store it in a global variable so we do not have to repeat on every chunk.
-            """
-            dataString = ''
-
-            # We are going to detect the dtype by reading in a single row
-            # of data with np.genfromtxt.  To do this, we must pass the
-            # row as a string delimited by a specified character.  Here we
-            # select a character that does not occur anywhere in the data.
-            delimit_char_list = [',', ';', '|', ':', '/', '\\']
-            delimit_char = None
-            for cc in delimit_char_list:
-                is_valid = True
-                for xx in results[0]:
-                    if cc in str(xx):
-                        is_valid = False
+    def _infer_dtype(self, results, exec_query=None, query=None):
+        """
+        Determine the dtype of the results of an arbitrary query.
+
+        The kind of each column comes from the SQLAlchemy types of the result
+        columns and from the DBAPI cursor.description, where the database reports
+        them, checked against the python types of the values in results (which
+        also set the length of string columns).  If a column holds values numpy
+        cannot store, the dtype is guessed from the first row instead
+        (see _guess_dtype_from_first_row).
+
+        @param [in] results is a list of the rows returned by the query
+        (the first chunk, if the query is being iterated over)
+
+        @param [in] exec_query is the optional sqlalchemy result the rows came from
+
+        @param [in] query is the optional text of the query.  The dtype inferred
+        for a query is cached, so that repeating the query skips inference.
+
+        @param [out] a numpy dtype
+        """
+        if getattr(self, '_dtype_cache', None) is None:
+            # subclasses which do not call DBObject.__init__ (e.g. fileDBObject)
+            self._dtype_cache = {}
+
+        key = None
+        if query is not None:
+            key = ' '.join(query.split())
+            if key in self._dtype_cache:
+                return self._dtype_cache[key]
+
+        if len(results) > 0:
+            raw_names = list(results[0].keys())
+        elif exec_query is not None:
+            raw_names = list(exec_query.keys())
+        else:
+            raise RuntimeError("DBObject cannot detect the dtype of a query that returned no rows\n"
+                               "Please specify a dtype with the 'dtype' kwarg.")
+
+        declared = self._get_declared_kinds(exec_query, len(raw_names))
+        columns = list(zip(*results)) if len(results) > 0 else [()]*len(raw_names)
+
+        dt_list = []
+        for name, (declared_kind, declared_len), values in zip(_validate_names(raw_names), declared, columns):
+            kind = _resolve_kind(declared_kind, _sampled_kind(values))
+            if kind is object:
+                return self._guess_dtype_from_first_row(results)
+            if kind is int and None in values:
+                # integer columns cannot hold NULLs; numpy.nan can
+                kind = float
+
+            if kind in (str, bytes):
+                str_len = max([len(vv) for vv in values if vv is not None] + [declared_len or 0, 1])
+                dt_list.append((str_cast(name), str_cast if kind is str else bytes, str_len))
+            else:
+                dt_list.append((str_cast(name), kind))
+
+        dtype = numpy.dtype(dt_list)
+        if key is not None and len(results) > 0:
+            self._dtype_cache[key] = dtype
+        return dtype
+
+    def _get_declared_kinds(self, exec_query, n_columns):
+        """
+        Return a list of (kind, length) tuples giving the kind (see _python_kind)
+        and maximum length each of the n_columns columns of a result is declared
+        to have, either by its SQLAlchemy type or by the DBAPI cursor.description.
+        Either element is None when it is not known (text queries have no
+        SQLAlchemy types; sqlite reports no types in cursor.description).
+        """
+        declared = [(None, None)]*n_columns
+        context = getattr(exec_query, 'context', None)
+
+        compiled = getattr(context, 'compiled', None)
+        result_columns = getattr(compiled, '_result_columns', None)
+        if result_columns is not None and len(result_columns) == n_columns:
+            for i_col, column in enumerate(result_columns):
+                sa_type = column[3]
+                try:
+                    python_type = sa_type.python_type
+                except NotImplementedError:
+                    continue
+                declared[i_col] = (_python_kind(python_type), getattr(sa_type, 'length', None))
+
+        description = getattr(getattr(context, 'cursor', None), 'description', None)
+        dbapi = self.connection.engine.dialect.dbapi
+        if description is not None and len(description) == n_columns:
+            type_objects = [(getattr(dbapi, type_name, None), kind)
+                            for type_name, kind in (('STRING', str), ('BINARY', bytes),
+                                                    ('NUMBER', numbers.Number), ('ROWID', int))]
+            for i_col, column in enumerate(description):
+                if declared[i_col][0] is not None or column[1] is None:
+                    continue
+                for type_object, kind in type_objects:
+                    if type_object is not None and column[1] == type_object:
+                        str_len = column[3] if kind in (str, bytes) else None
+                        if str_len is not None and str_len < 0:
+                            str_len = None
+                        declared[i_col] = (kind, str_len)
                         break
 
-                if is_valid:
-                    delimit_char = cc
+        return declared
+
+    def _guess_dtype_from_first_row(self, results):
+        """
+        Guess the dtype of the results of an arbitrary query by reading
+        their first row with numpy.genfromtxt.  This is the fallback for
+        _infer_dtype.
+        """
+        dataString = ''
+
+        # We are going to detect the dtype by reading in a single row
+        # of data with np.genfromtxt.  To do this, we must pass the
+        # row as a string delimited by a specified character.  Here we
+        # select a character that does not occur anywhere in the data.
+        delimit_char_list = [',', ';', '|', ':', '/', '\\']
+        delimit_char = None
+        for cc in delimit_char_list:
+            is_valid = True
+            for xx in results[0]:
+                if cc in str(xx):
+                    is_valid = False
                     break
 
-            if delimit_char is None:
-                raise RuntimeError("DBObject could not detect the dtype of your return rows\n"
-                                   "Please specify a dtype with the 'dtype' kwarg.")
+            if is_valid:
+                delimit_char = cc
+                break
+
+        if delimit_char is None:
+            raise RuntimeError("DBObject could not detect the dtype of your return rows\n"
+                               "Please specify a dtype with the 'dtype' kwarg.")
+
+        for xx in results[0]:
+            if dataString != '':
+                dataString += delimit_char
+            dataString += str(xx)
+        names = [str_cast(ww) for ww in results[0].keys()]
+        dataArr = numpy.genfromtxt(BytesIO(dataString.encode()), dtype=None,
+                                   names=names, delimiter=delimit_char,
+                                   encoding='utf-8')
+        dt_list = []
+        for name in dataArr.dtype.names:
+            type_name = str(dataArr.dtype[name])
+            sub_list = [name]
+            if type_name.startswith('S') or type_name.startswith('|S'):
+                sub_list.append(str_cast)
+                sub_list.append(int(type_name.replace('S','').replace('|','')))
+            else:
+                sub_list.append(dataArr.dtype[name])
+            dt_list.append(tuple(sub_list))
 
-            for xx in results[0]:
-                if dataString != '':
-                    dataString += delimit_char
-                dataString += str(xx)
-            names = [str_cast(ww) for ww in results[0].keys()]
-            dataArr = numpy.genfromtxt(BytesIO(dataString.encode()), dtype=None,
-                                       names=names, delimiter=delimit_char,
-                                       encoding='utf-8')
-            dt_list = []
-            for name in dataArr.dtype.names:
-                type_name = str(dataArr.dtype[name])
-                sub_list = [name]
-                if type_name.startswith('S') or type_name.startswith('|S'):
-                    sub_list.append(str_cast)
-                    sub_list.append(int(type_name.replace('S','').replace('|','')))
-                else:
-                    sub_list.append(dataArr.dtype[name])
-                dt_list.append(tuple(sub_list))
+        return numpy.dtype(dt_list)
 
-            self.dtype = numpy.dtype(dt_list)
+    def _convert_results_to_numpy_recarray_dbobj(self, results):
+        if self.dtype is None:
+            # Determine the dtype from the data.
+            # Store it so we do not have to repeat on every chunk.
+            self.dtype = self._infer_dtype(results)
 
         if len(results) == 0:
             return numpy.recarray((0,), dtype = self.dtype)
 
-        retresults = numpy.rec.fromrecords([tuple(xx) for xx in results],dtype = self.dtype)
+        retresults = rows_to_recarray(results, self.dtype)
         return retresults
 
     def _postprocess_results(self, results):
@@ -493,7 +1867,11 @@ class DBObject(object):
                 raise RuntimeError("query made to DBObject execute contained %s " % badCommand)
 
         self.dtype = dtype
-        retresults = self._postprocess_arbitrary_results(self.connection.session.execute(query).fetchall())
+        exec_query = self.connection.session.execute(query)
+        results = exec_query.fetchall()
+        if self.dtype is None:
+            self.dtype = self._infer_dtype(results, exec_query=exec_query, query=query)
+        retresults = self._postprocess_arbitrary_results(results)
         return retresults
 
     def get_arbitrary_chunk_iterator(self, query, chunk_size = None, dtype =None):
@@ -598,15 +1976,46 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
     raColName = None
     decColName = None
 
-    _connection_cache = []  # a list to store open database connections in
+    #: The names of the columns holding the unit vector pointing at each row
+    #: (see add_unit_vector_columns).  If the table has them, circular bounds are
+    #: applied with a dot product instead of the Haversine formula.
+    unitVectorColNames = ('unit_x', 'unit_y', 'unit_z')
+
+    #: An optional SpatialIndex (see spatialIndex.py) used by filter() to select
+    #: the rows near the bounds before testing them exactly.  It is ignored
+    #: until it has been built on the table (fileDBObject builds it on loading).
+    spatialIndex = None
+
+    #: The most queries query_columns_async keeps open at once on each
+    #: database (in each event loop); see asyncQuery.get_async_engine
+    async_concurrency = 8
+
+    #: An optional QueryCache in which to cache the results of query_columns
+    query_cache = None
+
+    #: The SchemaCache from which default columns are built (None means
+    #: reflect the table every time).  By default, schemas are only cached
+    #: in memory; assign a SchemaCache with a cache_file to keep them on disk.
+    #: Call schema_cache.invalidate() after altering a table in a database
+    #: other than sqlite (see SchemaCache).
+    schema_cache = SchemaCache()
+
+    # the sqlalchemy Table, reflected from the database on first use
+    _table = None
+
+    # the labels of the RA and Dec columns added to queries tested by _bounds_mask
+    _boundsColumnLabels = ('_bounds_ra', '_bounds_dec')
+
+    # open database connections, shared by all CatalogDBObjects
+    _connection_cache = _ConnectionRegistry(max_size=32)
 
     #Provide information if this object should be tested in the unit test
     doRunTest = False
     testObservationMetaData = None
 
     #: Mapping of DDL types to python types.  Strings are assumed to be 256 characters
-    #: this can be overridden by modifying the dbTypeMap or by making a custom columns
-    #: list.
+    #: (unless sizeStrings is True) this can be overridden by modifying the dbTypeMap
+    #: or by making a custom columns list.
     #: numpy doesn't know how to convert decimal.Decimal types, so I changed this to float
     #: TODO this doesn't seem to make a difference but make sure.
     dbTypeMap = {'BIGINT':(int,), 'BOOLEAN':(bool,), 'FLOAT':(float,), 'INTEGER':(int,),
@@ -616,6 +2025,48 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
                  'REAL':(float,), 'DOUBLE':(float,), 'STRING':(str, 256), 'DOUBLE_PRECISION':(float,),
                  'DECIMAL':(float,)}
 
+    #: If True, the default columns of string types are not given the widths in
+    #: dbTypeMap: each starts at the length declared in the database (if any),
+    #: and is widened to fit the longest value in each chunk returned by
+    #: query_columns (see ConversionPlan), so that no value is truncated.
+    #: The width of such a column may then differ from one chunk of a query
+    #: to the next (it never narrows).
+    sizeStrings = False
+
+    #: The numpy kind of the default string columns under python 3:  'U' (unicode),
+    #: or 'S' (bytes, 1 byte per character instead of 4).  With sizeStrings, a
+    #: query returning a value that is not ASCII in an 'S' column raises a ValueError.
+    stringDtype = 'U'
+
+    #: The names of the (string) columns to return dictionary-encoded:  as int32
+    #: codes into a vocabulary of their distinct values, which is shared by the
+    #: chunks of a query (see categorical.py).  This saves memory (and time
+    #: comparing strings) for columns like SED file names, which hold a few
+    #: distinct values repeated over many rows.  Use decode_categorical to
+    #: turn the codes back into strings.  Queries returning such columns are
+    #: not added to the query_cache.
+    categoricalColumns = ()
+
+    #: If True, numeric columns are returned at reduced precision:  float columns
+    #: as float32 and integer columns as int32, halving the memory they take up.
+    #: The precision-critical columns (see _get_precision_critical_columns) are
+    #: always returned at full precision.
+    compactNumerics = False
+
+    #: A dict mapping column names to the numpy types in which to return them
+    #: (e.g. {'magNorm': numpy.float32}), overriding compactNumerics.  A type
+    #: that would lose precision cannot be given for a precision-critical column.
+    columnPrecision = {}
+
+    #: The names of any columns (besides the id, RA and Dec columns; see
+    #: _get_precision_critical_columns) never to return at reduced precision
+    precisionCriticalColumns = ()
+
+    #: If True, query_columns(..., output='arrow') reads the results with the
+    #: ADBC driver for the database (see arrowOutput.py) when one is installed,
+    #: rather than from the DB-API cursor of the connection
+    useADBC = True
+
     @classmethod
     def from_objid(cls, objid, *args, **kwargs):
         """Given a string objid, return an instance of
@@ -628,7 +2079,7 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
 
     def __init__(self, database=None, driver=None, host=None, port=None, verbose=False,
                  table=None, objid=None, idColKey=None, connection=None,
-                 cache_connection=True):
+                 cache_connection=True, sqlite_profile=None):
         if not verbose:
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore", category=sa_exc.SAWarning)
@@ -673,25 +2124,16 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
                           "possible.")
 
         super(CatalogDBObject, self).__init__(database=database, driver=driver, host=host, port=port,
-                                              verbose=verbose, connection=connection, cache_connection=True)
-
-        try:
-            self._get_table()
-        except sa_exc.OperationalError as e:
-            if self.driver == 'mssql+pymssql':
-                message = "\n To connect to the UW CATSIM database: "
-                message += " Check that you have valid connection parameters, an open ssh tunnel "
-                message += "and that your $HOME/.lsst/db-auth.paf contains the appropriate credientials. "
-                message += "Please consult the following link for more information on access: "
-                message += " https://confluence.lsstcorp.org/display/SIM/Accessing+the+UW+CATSIM+Database "
-            else:
-                message = ''
-            raise RuntimeError("Failed to connect to %s: sqlalchemy.%s %s" % (self.connection.engine, e.args[0], message))
+                                              verbose=verbose, connection=connection, cache_connection=True,
+                                              sqlite_profile=sqlite_profile)
 
-        #Need to do this after the table is instantiated so that
-        #the default columns can be filled from the table object.
+        # The table itself is only reflected when it is first used (see the
+        # table property); the default columns come from self.schema_cache.
         if self.generateDefaultColumnMap:
-            self._make_default_columns()
+            try:
+                self._make_default_columns()
+            except sa_exc.OperationalError as e:
+                self._raise_connection_error(e)
         # build column mapping and type mapping dicts from columns
         self._make_column_map()
         self._make_type_map()
@@ -718,16 +2160,120 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
     def getObjectTypeId(self):
         return self.objectTypeId
 
+    def _raise_connection_error(self, e):
+        if self.driver == 'mssql+pymssql':
+            message = "\n To connect to the UW CATSIM database: "
+            message += " Check that you have valid connection parameters, an open ssh tunnel "
+            message += "and that your $HOME/.lsst/db-auth.paf contains the appropriate credientials. "
+            message += "Please consult the following link for more information on access: "
+            message += " https://confluence.lsstcorp.org/display/SIM/Accessing+the+UW+CATSIM+Database "
+        else:
+            message = ''
+        raise RuntimeError("Failed to connect to %s: sqlalchemy.%s %s" % (self.connection.engine, e.args[0], message))
+
+    @property
+    def table(self):
+        """
+        The sqlalchemy Table being queried (reflected from the database on first use,
+        and again if it has been dropped from the connection's MetaData, as
+        add_unit_vector_columns does once it has changed the table)
+        """
+        if self._table is None or self._table_is_dropped():
+            # the Table joins the connection's MetaData before it is reflected,
+            # so another thread must not pick it up until reflection is over
+            with self.connection._schema_lock:
+                if self._table is None or self._table_is_dropped():
+                    try:
+                        self._get_table()
+                    except sa_exc.OperationalError as e:
+                        self._raise_connection_error(e)
+        return self._table
+
+    @table.setter
+    def table(self, table):
+        self._table = table
+
+    def _table_is_dropped(self):
+        """
+        Return True if self._table was reflected into the connection's MetaData
+        and has since been removed from it
+        """
+        metadata = self.connection.metadata
+        return (self._table.metadata is metadata and
+                metadata.tables.get(self._table.key) is not self._table)
+
     def _get_table(self):
         self.table = Table(self.tableid, self.connection.metadata,
                            autoload=True)
 
+    def _get_db_columns(self):
+        """
+        Return a list of (name, type, length) tuples describing the columns of
+        the table, where type is the upper-case name of the column's SQL type
+        and length is its declared length (None if it has none).
+        These come from self.schema_cache if there is one (so that the
+        table need not be reflected); otherwise from the table.
+        """
+        if self.schema_cache is not None:
+            return self.schema_cache.get_columns(self.connection, self.tableid, lengths=True)
+        return [(col, self.table.c[col].type.__visit_name__.upper(),
+                 getattr(self.table.c[col].type, 'length', None))
+                for col in self.table.c.keys()]
+
     def _make_column_map(self):
         self.columnMap = OrderedDict([(el[0], el[1] if el[1] else el[0])
                                      for el in self.columns])
     def _make_type_map(self):
         self.typeMap = OrderedDict([(el[0], el[2:] if len(el)> 2 else (float,))
                                    for el in self.columns])
+        self._apply_precision_policy()
+
+    def _get_precision_critical_columns(self):
+        """
+        Return the set of the names of the columns which must not be returned
+        at reduced precision:  the precisionCriticalColumns, the id column, and
+        the columns which are (or are computed from) the RA, Dec and unit
+        vector columns of the table
+        """
+        critical = set(self.precisionCriticalColumns)
+        critical.add(self.idColKey)
+        db_names = [name for name in (self.raColName, self.decColName) +
+                    tuple(self.unitVectorColNames) if name is not None]
+        patterns = [re.compile(r'\b%s\b' % re.escape(name), re.IGNORECASE) for name in db_names]
+        for col, expr in self.columnMap.items():
+            if any(pattern.search(str(expr)) for pattern in patterns):
+                critical.add(col)
+        return critical
+
+    def _apply_precision_policy(self):
+        """
+        Set the types in self.typeMap of the numeric columns to be returned
+        at other than the default precision (see compactNumerics and columnPrecision)
+        """
+        if not self.compactNumerics and len(self.columnPrecision) == 0:
+            return
+
+        unknown = [col for col in self.columnPrecision if col not in self.typeMap]
+        if len(unknown) > 0:
+            raise ValueError("columnPrecision names columns that are not in this "
+                             "CatalogDBObject: %s" % str(unknown))
+
+        critical = self._get_precision_critical_columns()
+        for col, col_type in list(self.typeMap.items()):
+            if len(col_type) != 1:
+                continue
+            dtype = numpy.dtype(col_type[0])
+            if col in self.columnPrecision:
+                new_dtype = numpy.dtype(self.columnPrecision[col])
+                if col in critical and not numpy.can_cast(dtype, new_dtype, casting='safe'):
+                    raise ValueError("Cannot return the precision-critical column %s as %s"
+                                     % (col, str(new_dtype)))
+            elif self.compactNumerics and col not in critical and \
+                 dtype.kind in 'fi' and dtype.itemsize > 4:
+                new_dtype = numpy.dtype('%s4' % dtype.kind)
+            else:
+                continue
+            self.typeMap[col] = (new_dtype.type,)
 
     def _make_default_columns(self):
         if self.columns:
@@ -735,21 +2281,39 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
         else:
             self.columns = []
             colnames = []
-        for col in self.table.c.keys():
-            dbtypestr = self.table.c[col].type.__visit_name__
-            dbtypestr = dbtypestr.upper()
+        # the type of the default row of each database column of string type
+        string_types = {}
+        for col, dbtypestr, length in self._get_db_columns():
+            default_row = None
+            if dbtypestr in self.dbTypeMap:
+                default_row = (col, col)+self.dbTypeMap[dbtypestr]
+                if default_row[2] is str:
+                    if self.sizeStrings:
+                        default_row = (col, col, str, length if length else 1)
+                    string_types[col] = default_row[2:]
             if col in colnames:
                 if self.verbose: #Warn for possible column redefinition
                     warnings.warn("Database column, %s, overridden in self.columns... "%(col)+
                                   "Skipping default assignment.")
-            elif dbtypestr in self.dbTypeMap:
-                self.columns.append((col, col)+self.dbTypeMap[dbtypestr])
+            elif default_row is not None:
+                self.columns.append(default_row)
             else:
                 if self.verbose:
                     warnings.warn("Can't create default column for %s.  There is no mapping "%(col)+
                                   "for type %s.  Modify the dbTypeMap, or make a custom columns "%(dbtypestr)+
                                   "list.")
 
+        # the default columns of string types (see sizeStrings and stringDtype),
+        # keyed on the names under which they are returned:  a column defined
+        # exactly as the default row of a database column is one, whatever its
+        # name (CompoundCatalogDBObject prefixes the names of the columns it
+        # copies from other CatalogDBObjects)
+        self._defaultStringColumns = set()
+        for row in self.columns:
+            source = row[0] if row[1] is None else row[1]
+            if source in string_types and tuple(row[2:]) == string_types[source]:
+                self._defaultStringColumns.add(row[0])
+
     def _get_column_query(self, colnames=None):
         """Given a list of valid column names, return the query object"""
         if colnames is None:
@@ -788,32 +2352,194 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
 
         return query
 
-    def filter(self, query, bounds):
-        """Filter the query by the associated metadata"""
-        if bounds is not None:
-            on_clause = bounds.to_SQL(self.raColName,self.decColName)
-            query = query.filter(text(on_clause))
+    def _get_filtered_query(self, colnames=None, obs_metadata=None, constraint=None, exact=True):
+        """
+        Return the query for colnames, restricted to the rows
+        within obs_metadata.bounds and satisfying constraint
+        (see filter() for the meaning of exact)
+        """
+        query = self._get_column_query(colnames)
+
+        if obs_metadata is not None:
+            query = self.filter(query, obs_metadata.bounds, exact=exact)
+
+        if constraint is not None:
+            query = query.filter(text(constraint))
+
         return query
 
-    def _convert_results_to_numpy_recarray_catalogDBObj(self, results):
-        """Post-process the query results to put them
-        in a structured array.
+    def filter(self, query, bounds, exact=True):
+        """Filter the query by the associated metadata
 
-        **Parameters**
+        Circular bounds are preceded by a box in RA and Dec around them (see
+        _bounding_box_SQL), which the database can answer from indexes on
+        raColName and decColName.  If exact is False, only that box is applied,
+        and the rows must then be tested with _bounds_mask (as query_columns does).
+        """
+        if bounds is not None:
+            query = query.filter(text(self._bounds_SQL(bounds, exact=exact)))
+        return query
 
-            * results : a result set as returned by execution of the query
+    def _bounds_SQL(self, bounds, exact=True):
+        """
+        Return the SQL predicate with which filter() restricts a query to bounds
+        """
+        clauses = []
+        index_clause = self._spatial_index_SQL(bounds)
+        if index_clause is not None:
+            clauses.append(index_clause)
+        box_clause = self._bounding_box_SQL(bounds)
+        if box_clause is not None:
+            clauses.append(box_clause)
+        if exact or box_clause is None:
+            on_clause = self._unit_vector_SQL(bounds)
+            if on_clause is None:
+                on_clause = bounds.to_SQL(self.raColName,self.decColName)
+            clauses.append('(%s)' % on_clause)
+        return ' AND '.join(clauses)
+
+    def _bounding_box_SQL(self, bounds):
+        """
+        Return the SQL selecting the rows in a box in RA and Dec containing
+        circular bounds, or None if the bounds are not a circle (or the circle
+        covers every declination).  RA is allowed to run from 0 to 360 or from
+        -180 to 180 degrees; the box is split where it crosses RA = 0 or 180,
+        and loses its RA limits if the circle contains a pole.
+        """
+        if getattr(bounds, 'boundType', None) != 'circle':
+            return None
+
+        # widen the box slightly, so that rounding cannot exclude rows on its edges
+        margin = 1.0e-9
+        dec_min = numpy.degrees(bounds.DEC - bounds.radius) - margin
+        dec_max = numpy.degrees(bounds.DEC + bounds.radius) + margin
+        if dec_min <= -90.0 and dec_max >= 90.0:
+            return None
+        on_clause = '%s BETWEEN %.17g AND %.17g' % (self.decColName, max(dec_min, -90.0),
+                                                    min(dec_max, 90.0))
+        if dec_min <= -90.0 or dec_max >= 90.0:
+            return on_clause
+
+        half_width = numpy.degrees(numpy.arcsin(numpy.sin(bounds.radius)/numpy.cos(bounds.DEC))) + margin
+        ra_min = numpy.degrees(bounds.RA) - half_width
+        ra_max = numpy.degrees(bounds.RA) + half_width
+        ra_ranges = [(ra_min + offset, ra_max + offset) for offset in (-360.0, 0.0, 360.0)
+                     if ra_max + offset >= -180.0 and ra_min + offset <= 360.0]
+        return '%s AND (%s)' % (on_clause,
+                                ' OR '.join(['%s BETWEEN %.17g AND %.17g' % (self.raColName, low, high)
+                                             for low, high in ra_ranges]))
+
+    def _get_mask_bounds(self, obs_metadata):
+        """
+        Return the bounds of obs_metadata if they are to be tested on the rows
+        returned by the database (see _bounds_mask), which need then only be
+        restricted to the box around the bounds (see filter()).  That is the
+        case for circles, unless the table has unit vector columns, with which
+        the database tests circles cheaply (see _unit_vector_SQL).  Otherwise
+        return None: the bounds are tested by the database.
+        """
+        if obs_metadata is None:
+            return None
+        bounds = obs_metadata.bounds
+        if self._bounding_box_SQL(bounds) is None or self._unit_vector_SQL(bounds) is not None:
+            return None
+        return bounds
+
+    def _add_bounds_columns(self, query):
+        """
+        Return query with raColName and decColName appended (as the last two
+        columns, labelled with _boundsColumnLabels), for _bounds_mask
+        """
+        return query.add_columns(expression.literal_column(self.raColName).label(self._boundsColumnLabels[0]),
+                                 expression.literal_column(self.decColName).label(self._boundsColumnLabels[1]))
 
-        **Returns**
+    def _bounds_mask(self, rows, bounds):
+        """
+        Return a numpy array of bools marking the rows (whose last two columns
+        are RA and Dec in degrees, see _add_bounds_columns) within bounds (see
+        _coordinates_mask).  For circles, this is the angular distance test of
+        bounds.to_SQL.
+        """
+        ra = numpy.radians(numpy.array([row[-2] for row in rows], dtype=float))
+        dec = numpy.radians(numpy.array([row[-1] for row in rows], dtype=float))
+        return self._coordinates_mask(ra, dec, bounds)
 
-            * _final_pass(retresults) : the result of calling the _final_pass method on a
-              structured array constructed from the query data.
+    def _coordinates_mask(self, ra, dec, bounds):
+        """
+        Return a numpy array of bools marking the points (ra and dec are numpy
+        arrays in radians) within circular or box bounds.  The RA range of a box
+        runs from RAminDeg up to RAmaxDeg, through RA = 0 if RAminDeg > RAmaxDeg.
+        """
+        if getattr(bounds, 'boundType', None) == 'box':
+            ra_deg = numpy.degrees(ra)
+            dec_deg = numpy.degrees(dec)
+            ra_width = (bounds.RAmaxDeg - bounds.RAminDeg) % 360.0
+            with numpy.errstate(invalid='ignore'):
+                return (((ra_deg - bounds.RAminDeg) % 360.0 <= ra_width) &
+                        (dec_deg >= bounds.DECminDeg) & (dec_deg <= bounds.DECmaxDeg))
+
+        with numpy.errstate(invalid='ignore'):
+            distance = 2.0*numpy.arcsin(numpy.sqrt(numpy.sin(0.5*(dec - bounds.DEC))**2 +
+                                                   numpy.cos(dec)*numpy.cos(bounds.DEC) *
+                                                   numpy.sin(0.5*(ra - bounds.RA))**2))
+            return distance < bounds.radius
+
+    def _spatial_index_SQL(self, bounds):
         """
+        Return the predicate of self.spatialIndex selecting the rows near
+        bounds, or None if there is no index (or it cannot help with bounds)
+        """
+        if self.spatialIndex is None:
+            return None
+        if not self.spatialIndex.exists(self.connection, self.tableid):
+            return None
+        return self.spatialIndex.to_SQL(bounds, self.tableid)
 
-        if len(results) > 0:
-            cols = [str(k) for k in results[0].keys()]
-        else:
-            return results
+    def _has_unit_vector_columns(self):
+        """
+        Return True if the table has the columns named in self.unitVectorColNames
+        """
+        if self.unitVectorColNames is None:
+            return False
+        return all([name in self.table.c for name in self.unitVectorColNames])
 
+    def _unit_vector_SQL(self, bounds):
+        """
+        Return the SQL selecting the rows within circular bounds by taking the
+        dot product of their unit vectors (see add_unit_vector_columns) with the
+        unit vector at the center of the bounds, or None if that is not possible
+        (the bounds are not a circle, or the table has no unit vector columns).
+        Only arithmetic is evaluated per row, rather than the Haversine formula.
+        Rows are also restricted to the band of declination covered by the
+        bounds, so that an index on decColName can be used.
+        """
+        if getattr(bounds, 'boundType', None) != 'circle':
+            return None
+        if not self._has_unit_vector_columns():
+            return None
+
+        ra = bounds.RA
+        dec = bounds.DEC
+        radius = bounds.radius
+        x_name, y_name, z_name = self.unitVectorColNames
+        on_clause = ('%s*%.17g + %s*%.17g + %s*%.17g >= %.17g' %
+                     (x_name, numpy.cos(dec)*numpy.cos(ra),
+                      y_name, numpy.cos(dec)*numpy.sin(ra),
+                      z_name, numpy.sin(dec), numpy.cos(radius)))
+
+        dec_min = numpy.degrees(dec - radius)
+        dec_max = numpy.degrees(dec + radius)
+        if dec_min > -90.0 or dec_max < 90.0:
+            on_clause = ('%s BETWEEN %.17g AND %.17g AND ' %
+                         (self.decColName, max(dec_min, -90.0), min(dec_max, 90.0))) + on_clause
+        return on_clause
+
+    def _get_dtype(self, cols):
+        """
+        Return the numpy dtype of the structured array holding
+        the columns cols (a list of column names in self.typeMap)
+        """
+        string_columns = getattr(self, '_defaultStringColumns', ())
         if sys.version_info.major == 2:
             dt_list = []
             for k in cols:
@@ -827,27 +2553,74 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
                         sub_list.append(el)
                 dt_list.append(tuple(sub_list))
 
-            dtype = numpy.dtype(dt_list)
+            return numpy.dtype(dt_list)
 
-        else:
-            dtype = numpy.dtype([(k,)+self.typeMap[k] for k in cols])
+        return numpy.dtype([(k, self.stringDtype)+self.typeMap[k][1:] if k in string_columns
+                            else (k,)+self.typeMap[k] for k in cols])
 
-        if len(set(cols)&set(self.dbDefaultValues)) > 0:
+    def _get_conversion_plan(self, cols):
+        """
+        Return the ConversionPlan turning rows whose leading columns are cols
+        (a list of column names in self.typeMap) into a structured array, with
+        NULL (and zero, and empty) values in the columns with dbDefaultValues
+        replaced by the defaults, (if self.sizeStrings) the default string
+        columns widened to fit their values, and the categoricalColumns
+        dictionary-encoded
+        """
+        defaults = dict((str_cast(colName), self.dbDefaultValues[colName])
+                        for colName in cols if colName in self.dbDefaultValues)
+        sized = None
+        if self.sizeStrings:
+            string_columns = getattr(self, '_defaultStringColumns', ())
+            sized = [str_cast(colName) for colName in cols if colName in string_columns]
+        categorical = [str_cast(colName) for colName in cols if colName in self.categoricalColumns]
+        return ConversionPlan(self._get_dtype(cols), defaults=defaults, sized=sized,
+                              categorical=categorical)
+
+    def _overrides_final_pass(self):
+        """
+        Return True if a subclass of CatalogDBObject has overridden _final_pass
+        """
+        for cls in type(self).__mro__:
+            if cls is CatalogDBObject:
+                return False
+            if '_final_pass' in vars(cls):
+                return True
+        return False
+
+    def _get_query_conversion_plan(self, query):
+        """
+        Return the ConversionPlan for the rows of query (a sqlalchemy Query
+        made by _get_column_query), which query_columns works out once and
+        then applies to every chunk of the results
+        """
+        return self._get_conversion_plan([str(cc['name']) for cc in query.column_descriptions])
+
+    def _convert_results_to_numpy_recarray_catalogDBObj(self, results, plan=None):
+        """Post-process the query results to put them
+        in a structured array.
 
-            results_array = []
+        **Parameters**
 
-            for result in results:
-                results_array.append(tuple(result[colName]
-                                           if result[colName] or
-                                           colName not in self.dbDefaultValues
-                                           else self.dbDefaultValues[colName]
-                                           for colName in cols))
+            * results : a result set as returned by execution of the query
+            * plan : the ConversionPlan for the query (optional; by default it is
+              worked out from the columns of the first row)
 
-        else:
-            results_array = [tuple(rr) for rr in results]
+        **Returns**
 
-        retresults = numpy.rec.fromrecords(results_array, dtype=dtype)
-        return retresults
+            * a structured array constructed from the query data.  If there
+              are no results, that is a zero-length array (if plan is given)
+              or results itself.
+        """
+
+        if plan is None:
+            if len(results) == 0:
+                return results
+            cols = [str(k) for k in results[0].keys()
+                    if k not in self._boundsColumnLabels]
+            plan = self._get_conversion_plan(cols)
+
+        return plan.convert(results)
 
     def _postprocess_results(self, results):
         if not isinstance(results, numpy.recarray):
@@ -857,7 +2630,10 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
         return self._final_pass(retresults)
 
     def query_columns(self, colnames=None, chunk_size=None,
-                      obs_metadata=None, constraint=None, limit=None):
+                      obs_metadata=None, constraint=None, limit=None,
+                      prefetch=None, chunk_bytes=None, keyset=False,
+                      resume_from=None, partitions=None, ordered=True, stats=None,
+                      output=None):
         """Execute a query
 
         **Parameters**
@@ -869,7 +2645,9 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
             * chunk_size : int (optional)
               if specified, then return an iterator object to query the database,
               each time returning the next `chunk_size` elements.  If not
-              specified, all matching results will be returned.
+              specified, all matching results will be returned.  If specified,
+              rows are streamed from the database so that only `chunk_size`
+              rows are held in memory at a time.
             * obs_metadata : object (optional)
               an observation metadata object which has a "filter" method, which
               will add a filter string to the query.
@@ -877,6 +2655,53 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
               a string which is interpreted as SQL and used as a predicate on the query
             * limit : int (optional)
               limits the number of rows returned by the query
+            * prefetch : int (optional)
+              if specified, a background thread fetches and converts up to
+              `prefetch` chunks ahead of the consumer, overlapping database
+              I/O with whatever is done to each chunk.  The thread is shut
+              down when the iterator is exhausted or closed.
+            * chunk_bytes : int or str (optional)
+              a memory budget per chunk (e.g. 268435456 or '256MB') to use
+              instead of chunk_size.  The number of rows per chunk is derived
+              from the size of the output rows (and any per-row overhead the
+              consumer reports to the iterator with set_row_overhead) and is
+              adjusted as chunks are returned.
+            * keyset : bool (optional)
+              if True, page through the results in order of the id column
+              (see `idColKey`), issuing a separate query for each chunk rather
+              than holding one cursor open.  Requires chunk_size or chunk_bytes.
+              The returned KeysetChunkIterator has a JSON-serializable `position`
+              which can be passed back as `resume_from`.
+            * resume_from : dict (optional)
+              the `position` of a previous keyset query with the same arguments;
+              rows up to and including that position are skipped.  Implies keyset.
+            * partitions : int (optional)
+              if specified, split the query into this many ranges of the id
+              column (or of the sqlite rowid, if the id column is not an integer)
+              and run each range on its own database connection in a background
+              thread.  Requires chunk_size or chunk_bytes.  Up to `prefetch`
+              (default 2) chunks are fetched ahead per partition.  Not supported
+              for in-memory sqlite databases.
+            * ordered : bool (optional)
+              if partitions is specified, whether to return chunks in order of
+              the partitions (default True) or as soon as they are fetched.
+            * stats : QueryStats (optional)
+              if specified, the SQL of the query (and, optionally, its query plan),
+              the time taken to execute it, and the time spent fetching, converting
+              and in _final_pass for each chunk are recorded in stats.  Not supported
+              for keyset-paginated or partitioned queries.
+            * output : str (optional)
+              'arrow' to return the chunks as pyarrow RecordBatches (see
+              ArrowChunkIterator in arrowOutput.py, which needs pyarrow)
+              rather than recarrays.  The batches are read by an ADBC driver
+              where one is installed for the database, or else built from
+              the rows of the DB-API cursor.  Not supported with prefetch,
+              chunk_bytes, keyset, resume_from, partitions or stats, or for
+              classes which override _final_pass; the query_cache is not used.
+
+        If `query_cache` is set to a QueryCache, the results of queries that
+        are not keyset-paginated or partitioned (and return none of the
+        `categoricalColumns`) are read from (and added to) the cache.
 
         **Returns**
 
@@ -886,20 +2711,156 @@ class CatalogDBObject(with_metaclass(CatalogDBObjectMeta, DBObject)):
               then result is an iterator over lists of the given size.
 
         """
-        query = self._get_column_query(colnames)
+        # Circular bounds are tested on the rows returned by the database (so
+        # that the query itself only involves indexable ranges of RA and Dec;
+        # see _get_mask_bounds), unless rows are limited or paged by the database
+        bounds = None
+        if limit is None and partitions is None and not keyset and resume_from is None:
+            bounds = self._get_mask_bounds(obs_metadata)
+
+        query = self._get_filtered_query(colnames, obs_metadata=obs_metadata,
+                                         constraint=constraint, exact=bounds is None)
+
+        plan = self._get_query_conversion_plan(query)
+
+        row_bytes = None
+        if chunk_bytes is not None:
+            row_bytes = plan.dtype.itemsize
+
+        if stats is not None and (partitions is not None or keyset or resume_from is not None):
+            raise ValueError("Cannot record stats for keyset-paginated or partitioned queries")
+
+        if output not in (None, 'arrow'):
+            raise ValueError("output must be None or 'arrow'; you gave %s" % str(output))
+
+        if output == 'arrow':
+            if (prefetch is not None or chunk_bytes is not None or keyset or
+                    resume_from is not None or partitions is not None or stats is not None):
+                raise ValueError("Cannot combine output='arrow' with prefetch, chunk_bytes, "
+                                 "keyset, resume_from, partitions or stats")
+            if self._overrides_final_pass():
+                raise ValueError("%s overrides _final_pass, which only works on recarrays; "
+                                 "cannot return its results as Arrow" % type(self).__name__)
+            from .arrowOutput import ArrowChunkIterator
+            if limit is not None:
+                query = query.limit(limit)
+            return ArrowChunkIterator(self, query, chunk_size, bounds=bounds, plan=plan,
+                                      use_adbc=self.useADBC)
+
+        if partitions is not None:
+            if keyset or resume_from is not None:
+                raise ValueError("Cannot combine partitions with keyset pagination")
+            id_column = self.table.c[self.columnMap[self.idColKey]]
+            queue_depth = 2 if prefetch is None else prefetch
+            return PartitionedChunkIterator(self, query, id_column, partitions, chunk_size,
+                                            ordered=ordered, queue_depth=queue_depth,
+                                            limit=limit, chunk_bytes=chunk_bytes,
+                                            row_bytes=row_bytes, plan=plan)
+
+        if keyset or resume_from is not None:
+            if prefetch is not None:
+                raise ValueError("Cannot prefetch chunks of a keyset query")
+            id_column = self.table.c[self.columnMap[self.idColKey]]
+            return KeysetChunkIterator(self, query, id_column, chunk_size,
+                                       limit=limit, resume_from=resume_from,
+                                       chunk_bytes=chunk_bytes, row_bytes=row_bytes,
+                                       plan=plan)
 
-        if obs_metadata is not None:
-            query = self.filter(query, obs_metadata.bounds)
+        if limit is not None:
+            query = query.limit(limit)
+
+        # the vocabularies of categorical columns are not saved in the cache
+        if self.query_cache is not None and len(plan.categorical) == 0:
+            return self.query_cache.query_columns(self, query, chunk_size=chunk_size,
+                                                  obs_metadata=obs_metadata,
+                                                  constraint=constraint, limit=limit,
+                                                  prefetch=prefetch, chunk_bytes=chunk_bytes,
+                                                  row_bytes=row_bytes, bounds=bounds, stats=stats,
+                                                  plan=plan)
+
+        return ChunkIterator(self, query, chunk_size, prefetch=prefetch,
+                             chunk_bytes=chunk_bytes, row_bytes=row_bytes, bounds=bounds,
+                             stats=stats, plan=plan)
+
+    def query_columns_multi(self, obs_metadata_list, colnames=None, chunk_size=None,
+                            constraint=None, prefetch=None):
+        """Execute one query for several (e.g. overlapping) pointings
+
+        Rather than running query_columns once per pointing, which reads the
+        objects in the overlaps of the pointings once per pointing, the database
+        is queried once for the union of their bounds.  Every object is fetched
+        once; its position is then tested (in numpy) against the bounds of each
+        pointing.
 
+        **Parameters**
+
+            * obs_metadata_list : list
+              a list of ObservationMetaData with circular or box bounds
+            * colnames, chunk_size, constraint and prefetch are as in query_columns;
+              chunk_size is the number of rows fetched from the database at a time
+
+        **Returns**
+
+            * result : MultiBoundsChunkIterator
+              an iterator over (i_obs, chunk) pairs, where chunk is a recarray of the
+              rows (as returned by query_columns) within obs_metadata_list[i_obs].
+              The chunks of one pointing are interleaved with those of the others;
+              group them by i_obs to get the results of each pointing.
+        """
+        bounds_list = [obs_metadata.bounds for obs_metadata in obs_metadata_list]
+        if len(bounds_list) == 0:
+            raise ValueError("query_columns_multi needs at least one ObservationMetaData")
+        for bounds in bounds_list:
+            if getattr(bounds, 'boundType', None) not in ('circle', 'box'):
+                raise ValueError("query_columns_multi only supports circle and box bounds; "
+                                 "you gave %s" % str(bounds))
+
+        query = self._get_column_query(colnames)
+        query = query.filter(text('(%s)' % ' OR '.join(['(%s)' % self._bounds_SQL(bounds, exact=False)
+                                                        for bounds in bounds_list])))
         if constraint is not None:
             query = query.filter(text(constraint))
 
+        return MultiBoundsChunkIterator(self, query, chunk_size, bounds_list, prefetch=prefetch,
+                                        plan=self._get_query_conversion_plan(query))
+
+    def query_columns_async(self, colnames=None, chunk_size=None,
+                            obs_metadata=None, constraint=None, limit=None):
+        """Execute a query on sqlalchemy's asyncio engine
+
+        The arguments are as in query_columns.  Returns an AsyncChunkIterator,
+        to be consumed in a coroutine with
+
+            async for chunk in dbobj.query_columns_async(...):
+
+        Each chunk is a recarray, as returned by query_columns.  The query is
+        run on an asyncio engine made for this object's database and the running
+        event loop, which needs an asyncio driver (e.g. aiosqlite for sqlite).
+        At most async_concurrency queries on the database are open at once;
+        others wait for one of them to finish (or be closed with aclose()).
+        A loop which may stop before the last chunk should be run in
+
+            async with dbobj.query_columns_async(...) as chunks:
+
+        so that its connection is released when the loop is left.
+        Not supported for in-memory sqlite databases.
+        """
+        from .asyncQuery import AsyncChunkIterator
+
+        bounds = None
+        if limit is None:
+            bounds = self._get_mask_bounds(obs_metadata)
+
+        query = self._get_filtered_query(colnames, obs_metadata=obs_metadata,
+                                         constraint=constraint, exact=bounds is None)
+        plan = self._get_query_conversion_plan(query)
         if limit is not None:
             query = query.limit(limit)
 
-        return ChunkIterator(self, query, chunk_size)
+        return AsyncChunkIterator(self, query, chunk_size, bounds=bounds, plan=plan)
 
 sims_clean_up.targets.append(CatalogDBObject._connection_cache)
+sims_clean_up.targets.append(CatalogDBObject.schema_cache._entries)
 
 class fileDBObject(CatalogDBObject):
     ''' Class to read a file into a database and then query it'''
@@ -921,6 +2882,8 @@ class fileDBObject(CatalogDBObject):
         @param numGuess: The number of lines to use in guessing the dtype from the file.
         @param delimiter: The delimiter to use when parsing the file default is white space.
         @param idColKey: The name of the column that uniquely identifies each row in the database
+
+        If spatialIndex is set, it is built on the new table.
         """
         self.verbose = verbose
 
@@ -946,6 +2909,9 @@ class fileDBObject(CatalogDBObject):
             self.tableid = loadData(dataLocatorString, dtype, delimiter, runtable, self.idColKey,
                                     self.connection.engine, self.connection.metadata, numGuess,
                                     indexCols=self.indexCols, **kwargs)
+            if self.spatialIndex is not None:
+                self.spatialIndex.build(self.connection, self.tableid, self.raColName,
+                                        self.decColName, self.idColKey)
             self._get_table()
         else:
             raise ValueError("Could not locate file %s."%(dataLocatorString))
@@ -0,0 +1,693 @@
+"""
+An on-disk cache of the results of CatalogDBObject.query_columns, so that
+regenerating a catalog for the same pointing does not have to query the
+database again.
+"""
+from builtins import str
+from builtins import zip
+from builtins import object
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+import numpy
+
+try:
+    import fcntl
+except ImportError:
+    # no locking between processes (e.g. on Windows)
+    fcntl = None
+
+from .utils import parse_byte_budget
+from .dbConnection import ChunkIterator, str_cast
+
+__all__ = ["QueryCache", "CachedChunkIterator"]
+
+
+def _select_fields(chunk, names):
+    """
+    Return a recarray containing only the fields names of chunk (in that order)
+    """
+    if names is None or list(chunk.dtype.names) == list(names):
+        return chunk
+    field_names = dict((name, name) for name in chunk.dtype.names)
+    names = [field_names[name] for name in names]
+    output = numpy.recarray(chunk.shape, dtype=[(name, chunk.dtype[name]) for name in names])
+    for name in names:
+        output[name] = chunk[name]
+    return output
+
+
+class CachedChunkIterator(ChunkIterator):
+    """
+    Iterator over the chunks of a query result stored in a QueryCache.
+
+    The cached chunks are memory-mapped (copy-on-write, so _final_pass
+    may modify them freely) and re-chunked to the requested chunk_size.
+    If the cached result has more columns than were asked for, only the
+    requested fields are copied out of each chunk.  The cached result is
+    pinned (so that the cache does not delete it) until every chunk has
+    been loaded, or the iterator is closed.
+    """
+    def __init__(self, dbobj, file_names, chunk_size, chunk_bytes=None, row_bytes=None,
+                 fields=None, pin=None):
+        """
+        @param [in] dbobj is the CatalogDBObject whose query was cached
+
+        @param [in] file_names is the list of .npy files holding the cached chunks
+
+        @param [in] fields is an optional list of the names of the fields to
+        return (in order); by default, every cached field is returned
+
+        @param [in] chunk_size is the number of rows to return per chunk
+        (None means return all of the rows as a single chunk)
+
+        @param [in] chunk_bytes and row_bytes are as in ChunkIterator
+
+        @param [in] pin is the open pin file of the cached result (see
+        QueryCache._pin), which is closed once it is no longer needed
+        """
+        self._pin = pin
+        self._init_state(dbobj, chunk_size, chunk_bytes=chunk_bytes, row_bytes=row_bytes)
+
+        self._file_names = list(file_names)
+        self._fields = fields
+        self._pending = []
+        self._n_pending = 0
+
+    def _load_chunk(self, file_name):
+        return _select_fields(numpy.load(file_name, mmap_mode='c'), self._fields)
+
+    def __next__(self):
+        while self._file_names and (self.chunk_size is None or
+                                    self._n_pending < self.chunk_size):
+            chunk = self._load_chunk(self._file_names.pop(0))
+            self._pending.append(chunk)
+            self._n_pending += len(chunk)
+        if not self._file_names:
+            # the memory maps stay valid if the files are deleted
+            self._unpin()
+
+        if self._n_pending == 0:
+            raise StopIteration
+
+        n_rows = self._n_pending
+        if self.chunk_size is not None:
+            n_rows = min(n_rows, self.chunk_size)
+
+        if len(self._pending[0]) == n_rows:
+            chunk = self._pending.pop(0)
+        else:
+            # string fields may have been widened from one cached chunk to
+            # the next (see ConversionPlan); the last chunk is the widest
+            dtype = self._pending[-1].dtype
+            pending = numpy.concatenate([chunk.astype(dtype, copy=False)
+                                         for chunk in self._pending])
+            chunk = pending[:n_rows]
+            self._pending = [pending[n_rows:]] if n_rows < len(pending) else []
+        self._n_pending -= n_rows
+
+        return self._postprocess_results(chunk.view(numpy.recarray))
+
+    def _unpin(self):
+        if self._pin is not None:
+            self._pin.close()
+            self._pin = None
+
+    def close(self):
+        """
+        Stop iterating, releasing the cached result
+        """
+        self._unpin()
+        ChunkIterator.close(self)
+
+
+class _CacheWriter(object):
+    """
+    Writes the chunks of one query result into a new QueryCache entry.
+    The entry only becomes visible to the cache when commit() is called.
+    """
+    def __init__(self, cache, key, description, validity):
+        self._cache = cache
+        self._key = key
+        self._description = description
+        self._validity = validity
+        # pinned, so that QueryCache._sweep leaves it alone until it is committed
+        with cache._locked():
+            self._dir = tempfile.mkdtemp(dir=cache.cache_dir, prefix='entry-')
+            self._pin = cache._pin(self._dir)
+        self._file_names = []
+        self._n_rows = 0
+        self._nbytes = 0
+
+    def add_chunk(self, chunk):
+        if self._dir is None:
+            return
+        if self._nbytes + chunk.nbytes > self._cache.byte_budget:
+            # this result will never fit in the cache
+            self.abort()
+            return
+        file_name = 'chunk_%06d.npy' % len(self._file_names)
+        numpy.save(os.path.join(self._dir, file_name), numpy.asarray(chunk))
+        self._file_names.append(file_name)
+        self._n_rows += len(chunk)
+        self._nbytes += chunk.nbytes
+
+    def commit(self):
+        if self._dir is None:
+            return
+        entry = {'dir': os.path.basename(self._dir),
+                 'filter_key': self._cache._hash(self._description['filter']),
+                 'files': self._file_names,
+                 'n_rows': self._n_rows,
+                 'nbytes': self._nbytes,
+                 'validity': self._validity}
+        entry.update(self._description)
+        self._cache._add_entry(self._key, entry)
+        self._dir = None
+        self._unpin()
+
+    def abort(self):
+        if self._dir is not None:
+            self._unpin()
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def _unpin(self):
+        if self._pin is not None:
+            self._pin.close()
+            self._pin = None
+
+
+class QueryCache(object):
+    """
+    An on-disk cache of query_columns results.
+
+    To use it, assign an instance to the query_cache attribute of a
+    CatalogDBObject (or of a CatalogDBObject class), e.g.
+
+        dbobj.query_cache = QueryCache('/path/to/cache', byte_budget='10GB')
+
+    Results are keyed on the database connection (driver, host, port and
+    database), the table, the SQL (and dtype) of the requested columns, the
+    SQL of obs_metadata.bounds, the constraint, the limit and the
+    CatalogDBObject's dbDefaultValues.  Each result is stored as a directory
+    of .npy files (one per chunk, as converted to a recarray before
+    _final_pass is applied), which are memory-mapped when the result is
+    read back.  A result is only added to the cache once the query has been
+    iterated over completely.
+
+    A query is also served from any cached result with the same rows (i.e.
+    the same connection, table, bounds, constraint, limit and defaults) and
+    a superset of the requested columns, by copying the requested fields out
+    of the cached chunks.  If widen is True, a cached result with the same
+    rows and some of the requested columns (including the id column) is
+    widened by querying just the missing columns (plus the id column) and
+    joining them onto the cached rows by id; the widened result replaces the
+    original in the cache.  Widening holds the missing columns for every row
+    in memory at once, and is not done for queries with a limit.
+
+    Once the total size of the cache exceeds byte_budget, the least recently
+    used results are deleted.
+
+    Cached results are discarded when they are found to be out of date,
+    as decided by comparing
+
+        - the user-supplied schema_version
+        - the modification time and size of the database file (sqlite only)
+        - the return value of the user-supplied validity_function, which
+          is called with the CatalogDBObject being queried (and must return
+          something JSON-serializable)
+
+    with the values recorded when the result was cached.  Call clear() to
+    discard everything.
+
+    Queries against in-memory sqlite databases are never cached.
+
+    Several processes may share a cache_dir: the index is only read and
+    written under an exclusive lock (flock) on a lock file in cache_dir,
+    and each new version of the index replaces the old one atomically.
+    A result is pinned by a shared flock on a file in its directory while
+    it is being read; a pinned result that is evicted (or cleared) is
+    removed from the index at once, but its directory is only deleted once
+    it is no longer pinned.
+    """
+
+    _index_name = 'index.json'
+    _lock_name = 'index.lock'
+    _pin_name = 'pin.lock'
+
+    def __init__(self, cache_dir, byte_budget='1GB', schema_version=None,
+                 validity_function=None, widen=True):
+        """
+        @param [in] cache_dir is the directory in which to store the cache
+        (it is created if it does not exist)
+
+        @param [in] byte_budget is the maximum total size of the cached results,
+        either an int number of bytes or a string like '10GB'
+
+        @param [in] schema_version is an optional JSON-serializable value;
+        results cached under a different schema_version are discarded
+
+        @param [in] validity_function is an optional function of a CatalogDBObject
+        returning a JSON-serializable value; results cached when it returned
+        a different value are discarded
+
+        @param [in] widen is a boolean controlling whether cached results are
+        widened with missing columns, rather than re-querying every column
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.byte_budget = parse_byte_budget(byte_budget)
+        self.schema_version = schema_version
+        self.validity_function = validity_function
+        self.widen = widen
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+
+    @property
+    def _index_file(self):
+        return os.path.join(self.cache_dir, self._index_name)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the lock on the index: self._lock between the threads of this
+        process and, where fcntl is available, an exclusive flock on the lock
+        file between processes.  It may be taken again by the thread holding it.
+        """
+        with self._lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                self._lock_file = open(os.path.join(self.cache_dir, self._lock_name), 'a')
+                try:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+                except:
+                    self._lock_file.close()
+                    self._lock_file = None
+                    raise
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    # closing the file releases the flock
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def _load_index(self):
+        if not os.path.exists(self._index_file):
+            return {}
+        try:
+            with open(self._index_file, 'r') as input_file:
+                return json.load(input_file)
+        except ValueError:
+            # a corrupt index; start again
+            return {}
+
+    def _save_index(self, index):
+        # readers see either the old or the new index, never part of one
+        fd, temp_name = tempfile.mkstemp(dir=self.cache_dir, prefix='index-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as output_file:
+                json.dump(index, output_file)
+            os.replace(temp_name, self._index_file)
+        except:
+            if os.path.exists(temp_name):
+                os.unlink(temp_name)
+            raise
+
+    def _pin(self, entry_dir):
+        """
+        Pin the cached result in entry_dir (which must be done with the index
+        locked) by taking a shared flock on its pin file.  Returns the open pin
+        file, which unpins the result when closed (or None if fcntl is not
+        available).
+        """
+        if fcntl is None:
+            return None
+        pin = open(os.path.join(entry_dir, self._pin_name), 'a')
+        try:
+            fcntl.flock(pin.fileno(), fcntl.LOCK_SH)
+        except:
+            pin.close()
+            raise
+        return pin
+
+    def _delete_dir(self, entry_dir):
+        """
+        Delete the result directory entry_dir (with the index locked),
+        unless it is pinned, in which case it is left for _sweep
+        """
+        if fcntl is None:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return
+        try:
+            pin = open(os.path.join(entry_dir, self._pin_name), 'a')
+        except (IOError, OSError):
+            # already deleted
+            return
+        try:
+            try:
+                fcntl.flock(pin.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        finally:
+            pin.close()
+
+    def _sweep(self, index):
+        """
+        Delete the directories (with the index locked) that no longer belong
+        to an entry of index, and are no longer pinned
+        """
+        if fcntl is None:
+            # nothing is pinned, so _delete_dir has not left anything behind
+            return
+        entry_dirs = set(index[kk]['dir'] for kk in index)
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('entry-') and name not in entry_dirs:
+                self._delete_dir(os.path.join(self.cache_dir, name))
+
+    def _remove_entry(self, index, key):
+        entry = index.pop(key)
+        self._delete_dir(os.path.join(self.cache_dir, entry['dir']))
+
+    def _add_entry(self, key, entry):
+        with self._locked():
+            index = self._load_index()
+            if key in index:
+                self._remove_entry(index, key)
+            entry['last_used'] = time.time()
+            index[key] = entry
+
+            total = sum(index[kk]['nbytes'] for kk in index)
+            for old_key in sorted(index, key=lambda kk: index[kk]['last_used']):
+                if total <= self.byte_budget:
+                    break
+                total -= index[old_key]['nbytes']
+                self._remove_entry(index, old_key)
+
+            self._save_index(index)
+            self._sweep(index)
+
+    @property
+    def nbytes(self):
+        """
+        The total size of the cached results in bytes
+        """
+        with self._locked():
+            index = self._load_index()
+        return sum(index[kk]['nbytes'] for kk in index)
+
+    def clear(self):
+        """
+        Discard every cached result
+        """
+        with self._locked():
+            index = self._load_index()
+            for key in list(index):
+                self._remove_entry(index, key)
+            self._save_index(index)
+            # also remove any results that were never committed (results
+            # still being read or written are left alone)
+            for name in os.listdir(self.cache_dir):
+                if name.startswith('entry-'):
+                    self._delete_dir(os.path.join(self.cache_dir, name))
+
+    def _connection_description(self, dbobj):
+        """
+        Return a list describing the database behind dbobj's connection
+        (or None if its results cannot be cached)
+        """
+        connection = dbobj.connection
+        database = connection.database
+        if 'sqlite' in connection.driver:
+            if database in (None, '', ':memory:'):
+                return None
+            database = os.path.abspath(database)
+        return [str(connection.driver), str(connection.host),
+                str(connection.port), str(database)]
+
+    def _validity(self, dbobj):
+        """
+        Return the JSON-serializable record used to decide whether
+        a cached result is out of date
+        """
+        validity = {'schema_version': self.schema_version}
+        connection = dbobj.connection
+        if 'sqlite' in connection.driver and os.path.exists(connection.database):
+            file_stats = os.stat(connection.database)
+            validity['mtime'] = file_stats.st_mtime
+            validity['size'] = file_stats.st_size
+        if self.validity_function is not None:
+            validity['user'] = self.validity_function(dbobj)
+        # round-trip through JSON so that this compares equal to what is stored
+        return json.loads(json.dumps(validity))
+
+    def _describe_query(self, dbobj, query, obs_metadata, constraint, limit):
+        """
+        Return a JSON-serializable description of the rows selected by query
+        (the 'filter') and of the columns (name, SQL and dtype) it returns,
+        or None if the query cannot be cached
+        """
+        connection = self._connection_description(dbobj)
+        if connection is None:
+            return None
+
+        bounds_sql = None
+        if obs_metadata is not None and obs_metadata.bounds is not None:
+            bounds_sql = obs_metadata.bounds.to_SQL(dbobj.raColName, dbobj.decColName)
+
+        default_values = sorted([str(kk), repr(dbobj.dbDefaultValues[kk])]
+                                for kk in dbobj.dbDefaultValues)
+
+        row_filter = {'connection': connection,
+                      'tableid': str(dbobj.tableid),
+                      'bounds': bounds_sql,
+                      'constraint': constraint,
+                      'limit': limit,
+                      'default_values': default_values}
+
+        names = [str(cc['name']) for cc in query.column_descriptions]
+        dtype = dbobj._get_dtype(names)
+        columns = []
+        for cc, name in zip(query.column_descriptions, names):
+            column_sql = str(cc['expr'].element.compile(compile_kwargs={'literal_binds': True}))
+            columns.append([name, column_sql, dtype[name].str])
+
+        return {'filter': row_filter, 'columns': columns}
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _lookup(self, key, validity):
+        """
+        Return the list of chunk files of the valid cached result stored under
+        key (marking it as recently used) and its pin (see _pin), or None if
+        there is no such result
+        """
+        with self._locked():
+            index = self._load_index()
+            if key not in index:
+                return None
+            entry = index[key]
+            entry_dir = os.path.join(self.cache_dir, entry['dir'])
+            if entry['validity'] != validity or not os.path.isdir(entry_dir):
+                self._remove_entry(index, key)
+                self._save_index(index)
+                return None
+            entry['last_used'] = time.time()
+            self._save_index(index)
+            pin = self._pin(entry_dir)
+        return [os.path.join(entry_dir, file_name) for file_name in entry['files']], pin
+
+    def _find_related(self, description, validity):
+        """
+        Look for valid cached results with the same rows as the query
+        described by description.
+
+        Returns a tuple.  The first element is the list of chunk files and
+        the pin (see _pin) of the smallest such result containing all of the
+        requested columns (which is marked as recently used), or None.  The second element
+        is (key, entry) for the result sharing the most columns with the
+        query (including its id column), or None.
+        """
+        filter_key = self._hash(description['filter'])
+        columns = [tuple(cc) for cc in description['columns']]
+
+        superset = None
+        partial = None
+        n_shared_max = 0
+        with self._locked():
+            index = self._load_index()
+            stale = []
+            for key in index:
+                entry = index[key]
+                if entry.get('filter_key') != filter_key:
+                    continue
+                if (entry['validity'] != validity or
+                        not os.path.isdir(os.path.join(self.cache_dir, entry['dir']))):
+                    stale.append(key)
+                    continue
+                entry_columns = set(tuple(cc) for cc in entry['columns'])
+                if columns[0] not in entry_columns:
+                    continue
+                n_shared = len([cc for cc in columns if cc in entry_columns])
+                if n_shared == len(columns):
+                    if superset is None or entry['nbytes'] < index[superset]['nbytes']:
+                        superset = key
+                elif n_shared > n_shared_max:
+                    n_shared_max = n_shared
+                    partial = key
+
+            for key in stale:
+                self._remove_entry(index, key)
+
+            superset_files = None
+            if superset is not None:
+                entry = index[superset]
+                entry['last_used'] = time.time()
+                entry_dir = os.path.join(self.cache_dir, entry['dir'])
+                superset_files = ([os.path.join(entry_dir, file_name)
+                                   for file_name in entry['files']],
+                                  self._pin(entry_dir))
+            if superset is not None or len(stale) > 0:
+                self._save_index(index)
+
+        if partial is not None:
+            partial = (partial, index[partial])
+        return superset_files, partial
+
+    def _widen(self, dbobj, key, entry, description, validity, obs_metadata, constraint):
+        """
+        Add the columns of the query described by description that are missing
+        from the cached result entry (stored under key) by querying only those
+        columns, and joining them onto the cached rows by the id column.
+
+        The widened result replaces entry in the cache.  Returns the list of its
+        chunk files and its pin, as _lookup does (or None if the widened result
+        could not be cached).
+        """
+        entry_columns = set(tuple(cc) for cc in entry['columns'])
+        missing = [cc for cc in description['columns'] if tuple(cc) not in entry_columns]
+        id_name = description['columns'][0][0]
+
+        # the bounds are applied as in dbobj.query_columns
+        bounds = dbobj._get_mask_bounds(obs_metadata)
+        query = dbobj._get_filtered_query([cc[0] for cc in missing],
+                                          obs_metadata=obs_metadata, constraint=constraint,
+                                          exact=bounds is None)
+        if bounds is not None:
+            query = dbobj._add_bounds_columns(query)
+        rows = dbobj.connection.session.execute(query.statement).fetchall()
+        if bounds is not None and len(rows) > 0:
+            rows = [rows[ii] for ii in numpy.flatnonzero(dbobj._bounds_mask(rows, bounds))]
+        if len(rows) != entry['n_rows']:
+            return None
+
+        widened_description = {'filter': description['filter'],
+                               'columns': entry['columns'] + missing}
+        widened_key = self._hash(widened_description)
+        cache_writer = _CacheWriter(self, widened_key, widened_description, validity)
+
+        entry_dir = os.path.join(self.cache_dir, entry['dir'])
+        with self._locked():
+            index = self._load_index()
+            if key not in index or index[key]['dir'] != entry['dir']:
+                # evicted since _find_related
+                cache_writer.abort()
+                return None
+            pin = self._pin(entry_dir)
+
+        if len(rows) > 0:
+            new_columns = dbobj._convert_results_to_numpy_recarray_catalogDBObj(rows)
+            new_ids = new_columns[new_columns.dtype.names[0]]
+            sorter = numpy.argsort(new_ids, kind='mergesort')
+            sorted_ids = new_ids[sorter]
+
+        try:
+            for file_name in entry['files']:
+                chunk = numpy.load(os.path.join(entry_dir, file_name), mmap_mode='r')
+                chunk_ids = chunk[id_name]
+                dexes = numpy.searchsorted(sorted_ids, chunk_ids).clip(0, len(sorted_ids)-1)
+                if not numpy.array_equal(sorted_ids[dexes], chunk_ids):
+                    # the rows have changed since they were cached
+                    cache_writer.abort()
+                    return None
+                dexes = sorter[dexes]
+
+                widened = numpy.recarray(chunk.shape,
+                                         dtype=chunk.dtype.descr +
+                                         [(str_cast(cc[0]), new_columns.dtype[str_cast(cc[0])])
+                                          for cc in missing])
+                for name in chunk.dtype.names:
+                    widened[name] = chunk[name]
+                for cc in missing:
+                    widened[cc[0]] = new_columns[cc[0]][dexes]
+                cache_writer.add_chunk(widened)
+        finally:
+            if pin is not None:
+                pin.close()
+
+        cache_writer.commit()
+
+        with self._locked():
+            index = self._load_index()
+            if key in index:
+                self._remove_entry(index, key)
+                self._save_index(index)
+
+        return self._lookup(widened_key, validity)
+
+    def query_columns(self, dbobj, query, chunk_size=None, obs_metadata=None,
+                      constraint=None, limit=None, prefetch=None,
+                      chunk_bytes=None, row_bytes=None, bounds=None, stats=None, plan=None):
+        """
+        Return an iterator over the results of query (built by
+        dbobj.query_columns from the other arguments), reading them from
+        the cache if possible, and otherwise querying the database and
+        adding the results to the cache.
+
+        The arguments are as in CatalogDBObject.query_columns
+        (query must already have limit applied), except for bounds and
+        plan, which are passed on to ChunkIterator.  stats is only filled
+        in if the database is queried.
+        """
+        description = self._describe_query(dbobj, query, obs_metadata, constraint, limit)
+        if description is None:
+            return ChunkIterator(dbobj, query, chunk_size, prefetch=prefetch,
+                                 chunk_bytes=chunk_bytes, row_bytes=row_bytes, bounds=bounds,
+                                 stats=stats, plan=plan)
+
+        key = self._hash(description)
+        validity = self._validity(dbobj)
+        cached = self._lookup(key, validity)
+        if cached is not None:
+            return CachedChunkIterator(dbobj, cached[0], chunk_size,
+                                       chunk_bytes=chunk_bytes, row_bytes=row_bytes,
+                                       pin=cached[1])
+
+        names = [cc[0] for cc in description['columns']]
+        cached, partial = self._find_related(description, validity)
+
+        if cached is None and partial is not None and self.widen and limit is None:
+            cached = self._widen(dbobj, partial[0], partial[1], description, validity,
+                                 obs_metadata, constraint)
+
+        if cached is not None:
+            return CachedChunkIterator(dbobj, cached[0], chunk_size,
+                                       chunk_bytes=chunk_bytes, row_bytes=row_bytes,
+                                       fields=names, pin=cached[1])
+
+        cache_writer = _CacheWriter(self, key, description, validity)
+        return ChunkIterator(dbobj, query, chunk_size, prefetch=prefetch,
+                             chunk_bytes=chunk_bytes, row_bytes=row_bytes,
+                             cache_writer=cache_writer, bounds=bounds, stats=stats, plan=plan)
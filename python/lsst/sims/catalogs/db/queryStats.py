@@ -0,0 +1,159 @@
+"""
+Per-chunk timings of the queries run through a ChunkIterator, so that a slow
+catalog can be traced to the database, to the conversion of rows into
+recarrays, or to _final_pass.
+"""
+from builtins import str
+from builtins import object
+import warnings
+from collections import namedtuple
+from timeit import default_timer
+
+from sqlalchemy import text
+
+__all__ = ["QueryStats", "ChunkStats", "explain_query"]
+
+
+ChunkStats = namedtuple('ChunkStats', ['n_rows', 'nbytes', 'fetch_time',
+                                       'convert_time', 'final_pass_time'])
+ChunkStats.__doc__ = """
+The statistics of one chunk returned by a ChunkIterator:  the number of
+rows and bytes in the chunk, the seconds spent waiting for the database
+to return its rows (fetch_time), converting the rows into a recarray
+(convert_time) and in the _final_pass of the DBObject (final_pass_time).
+"""
+
+
+def _compile_query(query, dialect):
+    """
+    Return the SQL text of query (a sqlalchemy Query or statement, or a string)
+    as it is sent to the database, with bound parameters rendered inline where
+    possible.  The second element of the returned tuple is False if the
+    parameters could not be rendered (so the text cannot be run as it is).
+    """
+    if hasattr(query, 'statement'):
+        query = query.statement
+    if not hasattr(query, 'compile'):
+        return str(query), True
+    try:
+        return str(query.compile(dialect=dialect, compile_kwargs={'literal_binds': True})), True
+    except Exception:
+        return str(query.compile(dialect=dialect)), False
+
+
+def explain_query(connection, sql):
+    """
+    Ask the database how it would run a query.
+
+    @param [in] connection is the DBConnection of the database
+
+    @param [in] sql is the text of the query
+
+    @param [out] a list of tuples:  the rows of EXPLAIN QUERY PLAN for sqlite,
+    or of EXPLAIN for other databases
+    """
+    if connection.engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    with connection.engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(text(prefix + sql)).fetchall()]
+
+
+class QueryStats(object):
+    """
+    Collects the statistics of a query run by a ChunkIterator.  Pass one as
+    stats to CatalogDBObject.query_columns (or ChunkIterator); it is filled in
+    as the chunks are fetched, and is also available as the iterator's stats
+    attribute.
+
+    Attributes
+    ----------
+    sql is the text of the query sent to the database
+
+    query_plan is the output of explain_query for the query (if explain is True)
+
+    execute_time is the number of seconds between sending the query to the
+    database and the database being ready to return rows
+
+    chunks is a list of the ChunkStats of each chunk returned so far
+
+    With prefetch, the chunks are fetched (and their stats recorded) in a
+    background thread, ahead of the consumer.
+    """
+    def __init__(self, explain=False, callback=None):
+        """
+        @param [in] explain is a boolean; if True, the query plan of the query
+        is recorded (see explain_query) before the query is run
+
+        @param [in] callback is an optional function, called with each ChunkStats
+        as it is recorded (in the thread that fetched the chunk)
+        """
+        self.explain = explain
+        self.callback = callback
+        self.sql = None
+        self.query_plan = None
+        self.execute_time = None
+        self.chunks = []
+
+    def set_query(self, connection, query):
+        """
+        Record the SQL text (and, if self.explain, the query plan)
+        of query, which is about to be run on connection
+        """
+        self.sql, is_literal = _compile_query(query, connection.engine.dialect)
+        if self.explain:
+            if not is_literal:
+                warnings.warn("Cannot explain a query whose parameters cannot be "
+                              "rendered as SQL literals")
+                return
+            try:
+                self.query_plan = explain_query(connection, self.sql)
+            except Exception as ee:
+                warnings.warn("Could not explain the query: %s" % str(ee))
+
+    def timer(self):
+        """
+        The clock used for all of the timings
+        """
+        return default_timer()
+
+    def add_chunk(self, chunk_stats):
+        """
+        Record the ChunkStats of a chunk
+        """
+        self.chunks.append(chunk_stats)
+        if self.callback is not None:
+            self.callback(chunk_stats)
+
+    @property
+    def n_rows(self):
+        return sum([chunk.n_rows for chunk in self.chunks])
+
+    @property
+    def nbytes(self):
+        return sum([chunk.nbytes for chunk in self.chunks])
+
+    @property
+    def fetch_time(self):
+        return sum([chunk.fetch_time for chunk in self.chunks])
+
+    @property
+    def convert_time(self):
+        return sum([chunk.convert_time for chunk in self.chunks])
+
+    @property
+    def final_pass_time(self):
+        return sum([chunk.final_pass_time for chunk in self.chunks])
+
+    def __str__(self):
+        lines = ['%d chunks, %d rows, %d bytes' % (len(self.chunks), self.n_rows, self.nbytes)]
+        if self.execute_time is not None:
+            lines.append('execute: %.6f s' % self.execute_time)
+        lines.append('fetch: %.6f s; convert: %.6f s; _final_pass: %.6f s'
+                     % (self.fetch_time, self.convert_time, self.final_pass_time))
+        if self.sql is not None:
+            lines.append('SQL: %s' % self.sql)
+        if self.query_plan is not None:
+            lines.extend(['plan: %s' % str(row) for row in self.query_plan])
+        return '\n'.join(lines)
@@ -0,0 +1,339 @@
+"""
+Routines for converting the rows returned by a database query into
+numpy recarrays one column at a time, rather than one row at a time.
+"""
+from builtins import map
+from builtins import range
+import itertools
+import operator
+import threading
+import numpy
+
+from .categorical import categorical_dtype
+
+__all__ = ["rows_to_recarray", "ConversionPlan"]
+
+
+def _group_columns(dtype, exclude=()):
+    """
+    Sort the fields of a numpy dtype into groups that can be filled together.
+
+    Fields with the same numeric (or boolean) dtype are grouped together so
+    that they can be read out of the rows in one pass.  Every other field
+    (strings, mostly) is put into a group by itself.
+
+    Parameters
+    ----------
+    dtype is a structured numpy dtype
+
+    exclude is a collection of the names of fields to leave out of the groups
+
+    Returns
+    -------
+    A list of tuples (block_dtype, indices).  block_dtype is the dtype shared
+    by the fields in the group (None for the non-numeric singletons); indices
+    is the list of the positions of the grouped fields in dtype.names
+    """
+    groups = []
+    numeric_groups = {}
+    for i_field, name in enumerate(dtype.names):
+        if name in exclude:
+            continue
+        field_dtype = dtype[name]
+        if field_dtype.kind in 'biuf' and field_dtype.shape == ():
+            if field_dtype not in numeric_groups:
+                numeric_groups[field_dtype] = []
+                groups.append((field_dtype, numeric_groups[field_dtype]))
+            numeric_groups[field_dtype].append(i_field)
+        else:
+            groups.append((None, [i_field]))
+    return groups
+
+
+def _column_with_default(column, field_dtype, default):
+    """
+    Return a numpy array of the values in the list column (of type field_dtype),
+    with the values that evaluate to False replaced by default
+    """
+    if field_dtype.kind == 'f' and field_dtype.shape == ():
+        # NULLs become NaN; only those NaNs need to be told apart from real
+        # NaNs (which, evaluating to True, are kept)
+        values = numpy.array(column, dtype=field_dtype)
+        falsy = values == 0
+        nan_indices = numpy.flatnonzero(numpy.isnan(values))
+        falsy[nan_indices] = [column[ii] is None for ii in nan_indices]
+    else:
+        values = numpy.empty(len(column), dtype=object)
+        values[:] = column
+        falsy = numpy.logical_not(values.astype(bool))
+    values[falsy] = default
+    return values
+
+
+class ConversionPlan(object):
+    """
+    The steps of converting database rows into a numpy recarray, worked out
+    once for a given output dtype (and layout of the rows), so that they can
+    be applied to every chunk of the results of a query.
+
+    The output is preallocated and filled one group of columns at a time:
+    numeric columns sharing a dtype are streamed out of the rows into a single
+    numpy.fromiter call and scattered into their fields; other columns are
+    filled one column at a time.  Columns with defaults are read into arrays
+    of objects; the values in them that evaluate to False (NULL, zero or empty
+    strings) are found with one vectorized truth test per column and replaced
+    by the default, and the result is cast into the field.
+
+    The result of convert(rows) is identical to
+
+        numpy.rec.fromrecords([tuple(row[ii] for ii in indices) for row in rows],
+                              dtype=dtype)
+
+    with each value v of a column with a default replaced by
+
+        v if v else defaults[name]
+
+    and, in cases numpy.fromiter cannot handle (e.g. a NULL in an integer
+    column), that is what is actually returned (so that errors are also
+    raised exactly as before).
+
+    The width of a 'sized' string field in dtype is only a minimum:  each chunk
+    is converted with the field wide enough for its longest value, and the
+    plan's dtype keeps the widest width seen so far (so that it never narrows
+    from one chunk to the next).  The widths of the chunks of a query may
+    therefore differ, but never their kinds:  a sized bytes ('S') field that
+    meets a value which is not ASCII raises a ValueError.
+
+    A 'categorical' field is returned dictionary-encoded:  as the int32 codes
+    of its values in a vocabulary which is shared by every chunk converted by
+    the plan (and grows as new values appear), and which is recorded in the
+    metadata of the field's dtype (see categorical.py).  A plan may be shared by
+    threads converting chunks of the same query (e.g. the partitions of a
+    PartitionedChunkIterator).
+    """
+
+    def __init__(self, dtype, indices=None, defaults=None, sized=None, categorical=None):
+        """
+        Parameters
+        ----------
+        dtype is the numpy dtype of the output
+
+        indices is an optional list of the positions in each row of the fields
+        of dtype (by default, the fields are the leading columns of the rows;
+        any other columns are ignored)
+
+        defaults is an optional dict mapping field names to the values that
+        replace NULL, zero or empty values in those fields
+
+        sized is an optional collection of the names of the string fields
+        whose widths are to be fitted to the values converted
+
+        categorical is an optional collection of the names of the fields to
+        dictionary-encode (their types in dtype are replaced by int32 codes)
+        """
+        self.categorical = set(categorical) if categorical else set()
+        # the vocabulary of each categorical field, and a dict
+        # mapping each value in it to its code
+        self.vocabularies = {}
+        self._codes = {}
+        dtype = numpy.dtype(dtype)
+        fields = []
+        for name in dtype.names:
+            if name in self.categorical:
+                self.vocabularies[name] = []
+                self._codes[name] = {}
+                fields.append((name, categorical_dtype(self.vocabularies[name])))
+            else:
+                fields.append((name, dtype[name]))
+        self.dtype = numpy.dtype(fields)
+        names = self.dtype.names
+        if indices is None:
+            indices = list(range(len(names)))
+        if len(indices) != len(names):
+            raise ValueError("Need one row index per field of %s; got %s" % (str(self.dtype), str(indices)))
+        self.indices = list(indices)
+        self.defaults = dict(defaults) if defaults else {}
+        self.sized = set(sized).difference(self.categorical) if sized else set()
+
+        # (block_dtype, field names, row indices, getter) for each group of fields
+        self._blocks = []
+        exclude = self.sized.union(self.categorical, self.defaults)
+        for block_dtype, fields in _group_columns(self.dtype, exclude=exclude):
+            row_indices = [self.indices[i_field] for i_field in fields]
+            getter = None
+            if len(row_indices) > 1:
+                getter = operator.itemgetter(*row_indices)
+            self._blocks.append((block_dtype, [names[i_field] for i_field in fields],
+                                 row_indices, getter))
+
+        # (field index, default) for each field with a default
+        self._defaults = [(i_field, self.defaults[name]) for i_field, name in enumerate(names)
+                          if name in self.defaults and name not in self.sized and
+                          name not in self.categorical]
+
+        # the indices of the sized and of the categorical fields
+        self._sized = [i_field for i_field, name in enumerate(names) if name in self.sized]
+        self._categorical = [i_field for i_field, name in enumerate(names)
+                             if name in self.categorical]
+
+        # guards the widening of self.dtype and the growth of the vocabularies
+        self._lock = threading.Lock()
+
+    def empty(self):
+        """
+        Return a zero-length recarray of the output dtype
+        """
+        return numpy.recarray((0,), dtype=self.dtype)
+
+    def convert(self, rows):
+        """
+        Convert a list of rows (tuples or sqlalchemy Rows) into a numpy recarray
+        """
+        n_rows = len(rows)
+        dtype, columns = self._sized_columns(rows)
+        columns += self._categorical_columns(rows)
+        output = numpy.recarray((n_rows,), dtype=dtype)
+        names = dtype.names
+        for i_field, values in columns:
+            output[names[i_field]] = values
+
+        try:
+            for block_dtype, field_names, row_indices, getter in self._blocks:
+                if block_dtype is None:
+                    i_col = row_indices[0]
+                    output[field_names[0]] = [row[i_col] for row in rows]
+                elif getter is None:
+                    i_col = row_indices[0]
+                    output[field_names[0]] = numpy.fromiter((row[i_col] for row in rows),
+                                                            dtype=block_dtype, count=n_rows)
+                else:
+                    n_block = len(field_names)
+                    block = numpy.fromiter(itertools.chain.from_iterable(map(getter, rows)),
+                                           dtype=block_dtype,
+                                           count=n_rows*n_block).reshape(n_rows, n_block)
+                    for i_block in range(n_block):
+                        output[field_names[i_block]] = block[:, i_block]
+
+            for i_field, default in self._defaults:
+                i_col = self.indices[i_field]
+                output[names[i_field]] = _column_with_default([row[i_col] for row in rows],
+                                                              dtype[i_field], default)
+        except (TypeError, ValueError, OverflowError):
+            output = numpy.rec.fromrecords(self._records(rows), dtype=dtype)
+            for i_field, values in columns:
+                output[names[i_field]] = values
+
+        return output
+
+    def _sized_columns(self, rows):
+        """
+        Return the dtype of the output for rows, and a list of (field index,
+        array of values) tuples holding the sized fields of rows (with the
+        defaults applied), widening the fields in self.dtype as needed to hold them
+        """
+        dtype = self.dtype
+        columns = []
+        widened = {}
+        for i_field in self._sized:
+            name = dtype.names[i_field]
+            field_dtype = dtype[i_field]
+            i_col = self.indices[i_field]
+            column = [row[i_col] for row in rows]
+            if name in self.defaults:
+                column = _column_with_default(column, field_dtype, self.defaults[name])
+            try:
+                values = numpy.array(column, dtype=field_dtype.kind)
+            except UnicodeEncodeError:
+                raise ValueError("The bytes field %s cannot hold a value that is not ASCII; "
+                                 "convert it as unicode ('U') instead" % name)
+            columns.append((i_field, values))
+            if values.itemsize > field_dtype.itemsize:
+                widened[name] = numpy.promote_types(field_dtype, values.dtype)
+
+        if len(widened) > 0:
+            with self._lock:
+                # another thread may have widened self.dtype since it was read
+                self.dtype = numpy.dtype([(name, numpy.promote_types(self.dtype[name], widened[name])
+                                           if name in widened else self.dtype[name])
+                                          for name in self.dtype.names])
+                dtype = self.dtype
+        return dtype, columns
+
+    def _categorical_columns(self, rows):
+        """
+        Return a list of (field index, array of codes) tuples holding the
+        categorical fields of rows (with the defaults applied), adding any
+        new values to the vocabularies
+        """
+        columns = []
+        for i_field in self._categorical:
+            name = self.dtype.names[i_field]
+            i_col = self.indices[i_field]
+            column = [row[i_col] for row in rows]
+            if name in self.defaults:
+                column = _column_with_default(column, self.dtype[i_field], self.defaults[name])
+            codes = self._codes[name]
+            new_values = set(column).difference(codes)
+            if len(new_values) > 0:
+                with self._lock:
+                    vocabulary = self.vocabularies[name]
+                    for value in sorted(new_values, key=str):
+                        if value not in codes:
+                            codes[value] = len(vocabulary)
+                            vocabulary.append(value)
+            columns.append((i_field, numpy.fromiter(map(codes.__getitem__, column),
+                                                    dtype=numpy.int32, count=len(column))))
+        return columns
+
+    def _records(self, rows):
+        """
+        Return the rows as tuples of the values of the fields of the output,
+        with the defaults applied (and the categorical fields left as zeros,
+        to be filled in afterwards)
+        """
+        indices = self.indices
+        if len(self._defaults) == 0 and len(self._categorical) == 0:
+            return [tuple([row[i_col] for i_col in indices]) for row in rows]
+        records = []
+        for row in rows:
+            values = [row[i_col] for i_col in indices]
+            for i_field, default in self._defaults:
+                if not values[i_field]:
+                    values[i_field] = default
+            for i_field in self._categorical:
+                values[i_field] = 0
+            records.append(tuple(values))
+        return records
+
+
+def rows_to_recarray(rows, dtype, defaults=None):
+    """
+    Convert a list of database rows into a numpy recarray.
+
+    numpy.rec.fromrecords requires every row to be copied into a tuple
+    before numpy walks over it again, field by field.  Here the rows are
+    converted one column at a time (see ConversionPlan); the result is
+    identical to
+
+        numpy.rec.fromrecords([tuple(row) for row in rows], dtype=dtype)
+
+    with, if defaults is given, each value v in a field named in defaults
+    replaced by
+
+        v if v else defaults[name]
+
+    Parameters
+    ----------
+    rows is a list of rows (tuples or sqlalchemy Rows) returned by a query;
+    any columns beyond those in dtype are ignored
+
+    dtype is the numpy dtype of the output (one field per leading column of the rows)
+
+    defaults is an optional dict mapping field names to the values that
+    replace NULL, zero or empty values in those fields
+
+    Returns
+    -------
+    A numpy recarray
+    """
+    return ConversionPlan(dtype, defaults=defaults).convert(rows)
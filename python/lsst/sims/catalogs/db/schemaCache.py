@@ -0,0 +1,211 @@
+"""
+A cache of the schemas of the tables CatalogDBObjects read, so that
+instantiating a CatalogDBObject does not have to reflect its table
+from the database.
+"""
+from builtins import str
+from builtins import object
+import os
+import json
+import threading
+import contextlib
+from sqlalchemy import inspect
+
+try:
+    import fcntl
+except ImportError:
+    # no locking between processes (e.g. on Windows)
+    fcntl = None
+
+__all__ = ["SchemaCache"]
+
+
+class SchemaCache(object):
+    """
+    A cache of the columns (name, type and length) of database tables, keyed on the
+    connection and the name of the table.  CatalogDBObject builds its default
+    columns from it (see CatalogDBObject.schema_cache), so only the first
+    CatalogDBObject to read a table pays for a round trip to the database.
+
+    Entries are held in memory and, if cache_file is given, in a JSON file
+    shared by every process that uses the same cache_file (which is only
+    updated under an exclusive lock (flock) on cache_file + '.lock').
+    Entries for sqlite databases are discarded when the database file
+    changes.  Nothing tells when the schema of any other database changes,
+    so its entries are kept until invalidate() is called or schema_version
+    is changed, and they are only written to cache_file if schema_version
+    is given; otherwise they last as long as the process.  Call invalidate()
+    after altering such a table.  Tables in in-memory sqlite databases are
+    never cached.
+    """
+
+    def __init__(self, cache_file=None, schema_version=None):
+        """
+        @param [in] cache_file is the optional name of the JSON file in
+        which to store the cache
+
+        @param [in] schema_version is an optional JSON-serializable value
+        recorded with every entry.  Changing it invalidates the entries
+        made with any other value.
+        """
+        self.cache_file = cache_file
+        self.schema_version = schema_version
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _key(self, connection, tableid):
+        """
+        Return the key of tableid on connection (or None if it cannot be cached)
+        """
+        database = connection.database
+        if 'sqlite' in connection.driver:
+            if database in (None, '', ':memory:'):
+                return None
+            database = os.path.abspath(database)
+        return json.dumps([str(connection.driver), str(connection.host),
+                           str(connection.port), str(database), str(tableid)])
+
+    def _validity(self, connection):
+        """
+        Return the JSON-serializable record used to decide
+        whether an entry is out of date
+        """
+        validity = {'schema_version': self.schema_version}
+        if 'sqlite' in connection.driver and os.path.exists(connection.database):
+            file_stats = os.stat(connection.database)
+            validity['mtime'] = file_stats.st_mtime
+            validity['size'] = file_stats.st_size
+        # round-trip through JSON so that this compares equal to what is stored
+        return json.loads(json.dumps(validity))
+
+    def _load(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r') as input_file:
+                return json.load(input_file)
+        except ValueError:
+            # a corrupt cache; start again
+            return {}
+
+    @contextlib.contextmanager
+    def _file_locked(self):
+        """
+        Hold an exclusive flock on cache_file + '.lock' (where fcntl is available),
+        so that processes updating cache_file at once do not lose each other's entries
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self.cache_file + '.lock', 'a') as lock_file:
+            # closing the file releases the flock
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _save(self, key):
+        """
+        Write self._entries[key] (or its removal, if it is not there) to
+        cache_file, merging with whatever other processes have written
+        """
+        if self.cache_file is None:
+            return
+        with self._file_locked():
+            entries = self._load()
+            if key is None:
+                entries = dict(self._entries)
+            elif key in self._entries:
+                entries[key] = self._entries[key]
+            else:
+                entries.pop(key, None)
+            temp_name = self.cache_file + '.%d.tmp' % os.getpid()
+            with open(temp_name, 'w') as output_file:
+                json.dump(entries, output_file)
+            os.rename(temp_name, self.cache_file)
+
+    def _reflect(self, connection, tableid):
+        """
+        Read the names, types and lengths of the columns of tableid from the database
+        """
+        return [(str(column['name']), str(column['type'].__visit_name__.upper()),
+                 getattr(column['type'], 'length', None))
+                for column in inspect(connection.engine).get_columns(tableid)]
+
+    def get_columns(self, connection, tableid, lengths=False):
+        """
+        Return a list of (name, type) tuples describing the columns of the
+        table tableid, where type is the upper-case name of the SQL type of
+        the column (as used in CatalogDBObject.dbTypeMap).
+
+        @param [in] connection is the DBConnection to the table's database
+
+        @param [in] tableid is the name of the table
+
+        @param [in] lengths is a boolean; if True, the tuples are
+        (name, type, length), where length is the declared length of
+        the column (e.g. 40 for VARCHAR(40)), or None if it has none
+        """
+        columns = self._get_columns(connection, tableid)
+        if lengths:
+            return columns
+        return [column[:2] for column in columns]
+
+    def _get_columns(self, connection, tableid):
+        """
+        Return the (name, type, length) tuples of the columns of tableid,
+        from the cache if possible
+        """
+        key = self._key(connection, tableid)
+        if key is None:
+            return self._reflect(connection, tableid)
+
+        validity = self._validity(connection)
+        with self._lock:
+            if not self._loaded:
+                self._entries.update(self._load())
+                self._loaded = True
+            entry = self._entries.get(key)
+        # entries written before lengths were recorded hold (name, type) pairs
+        if (entry is not None and entry['validity'] == validity and
+                all(len(column) == 3 for column in entry['columns'])):
+            return [tuple(column) for column in entry['columns']]
+
+        columns = self._reflect(connection, tableid)
+        with self._lock:
+            self._entries[key] = {'validity': validity, 'columns': columns}
+            # without a database file or schema_version to check, a cached
+            # schema could outlive changes to the table in other processes
+            if 'mtime' in validity or self.schema_version is not None:
+                self._save(key)
+        return columns
+
+    def invalidate(self, connection=None, tableid=None):
+        """
+        Discard the cached schemas of the table tableid on connection.
+        If tableid is None, discard every table on connection; if connection
+        is also None, discard everything.
+        """
+        with self._lock:
+            self._loaded = False
+            self._entries.update(self._load())
+            if connection is None and tableid is None:
+                self._entries.clear()
+                self._save(None)
+                return
+
+            for key in list(self._entries.keys()):
+                description = json.loads(key)
+                if connection is not None:
+                    connection_key = self._key(connection, description[-1])
+                    if connection_key is None or json.loads(connection_key)[:-1] != description[:-1]:
+                        continue
+                if tableid is not None and description[-1] != str(tableid):
+                    continue
+                self._entries.pop(key)
+                self._save(key)
+
+    def clear(self):
+        """
+        Discard every cached schema
+        """
+        self.invalidate()
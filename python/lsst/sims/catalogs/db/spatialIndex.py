@@ -0,0 +1,363 @@
+"""
+Spatial indexes that let CatalogDBObject.filter select the rows near
+a field of view without scanning the whole table.
+
+A SpatialIndex is built once on a table (fileDBObject builds it when it
+loads a file) and assigned to CatalogDBObject.spatialIndex.  filter()
+then prepends the index's coarse predicate to the exact test of the
+bounds, so the database reads only the rows in the index's cells.
+"""
+from builtins import str
+from builtins import range
+from builtins import object
+import abc
+import numpy as np
+from future.utils import with_metaclass
+from sqlalchemy import text, select, types as satypes, MetaData, Table, Column
+
+__all__ = ["SpatialIndex", "HtmIndex", "RTreeIndex", "findHtmid"]
+
+
+# The corners of the eight level-0 trixels of the Hierarchical
+# Triangular Mesh, in the order of their ids (8 through 15);
+# see Szalay et al. (2007) arXiv:cs/0701164
+_htm_vertices = np.array([[0.0, 0.0, 1.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0],
+                          [-1.0, 0.0, 0.0], [0.0, -1.0, 0.0], [0.0, 0.0, -1.0]])
+
+_htm_roots = np.array([_htm_vertices[[1, 5, 2]], _htm_vertices[[2, 5, 3]],
+                       _htm_vertices[[3, 5, 4]], _htm_vertices[[4, 5, 1]],
+                       _htm_vertices[[1, 0, 4]], _htm_vertices[[4, 0, 3]],
+                       _htm_vertices[[3, 0, 2]], _htm_vertices[[2, 0, 1]]])
+
+
+def _unit_vectors(ra, dec):
+    """
+    Return an (N, 3) array of the unit vectors pointing at
+    ra, dec (numpy arrays in degrees)
+    """
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).transpose()
+
+
+def _normalize(vectors):
+    return vectors/np.sqrt((vectors**2).sum(axis=-1))[..., None]
+
+
+def _children(corners):
+    """
+    Return the corners of the four children of the trixels whose
+    corners are corners (an array of shape (..., 3, 3)); the result
+    has shape (..., 4, 3, 3), with child ii having id 4*parent + ii
+    """
+    c0 = corners[..., 0, :]
+    c1 = corners[..., 1, :]
+    c2 = corners[..., 2, :]
+    w0 = _normalize(c1 + c2)
+    w1 = _normalize(c0 + c2)
+    w2 = _normalize(c0 + c1)
+    return np.stack([np.stack([c0, w2, w1], axis=-2),
+                     np.stack([c1, w0, w2], axis=-2),
+                     np.stack([c2, w1, w0], axis=-2),
+                     np.stack([w0, w1, w2], axis=-2)], axis=-3)
+
+
+def _containment(corners, points):
+    """
+    Return the smallest of the (signed) distances of points from the three
+    edges of the trixels whose corners are corners (shape (n_trixels, 3, 3),
+    or (N, n_trixels, 3, 3) to give each point its own trixels);
+    the trixel containing each point has the largest (non-negative) value
+    """
+    points = points[:, None, :]
+    distances = [(np.cross(corners[..., ii, :], corners[..., (ii+1) % 3, :])*points).sum(axis=-1)
+                 for ii in range(3)]
+    return np.minimum(np.minimum(distances[0], distances[1]), distances[2])
+
+
+def findHtmid(ra, dec, level):
+    """
+    Return the ids of the trixels of the Hierarchical Triangular Mesh
+    containing the points ra, dec.
+
+    @param [in] ra is a numpy array of RA in degrees
+
+    @param [in] dec is a numpy array of Dec in degrees
+
+    @param [in] level is the level of the mesh (0 is the eight root trixels;
+    each level divides every trixel into four)
+
+    @param [out] a numpy array of int64 ids
+    """
+    points = _unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+    best = np.argmax(_containment(_htm_roots, points), axis=1)
+    htmid = best.astype(np.int64) + 8
+    corners = _htm_roots[best]
+    everything = np.arange(len(points))
+    for _ in range(level):
+        children = _children(corners)
+        best = np.argmax(_containment(children, points), axis=1)
+        htmid = 4*htmid + best
+        corners = children[everything, best]
+    return htmid
+
+
+class SpatialIndex(with_metaclass(abc.ABCMeta, object)):
+    """
+    The abstract base class of the spatial indexes of a table.  Subclasses build
+    the index and turn bounds (from lsst.sims.utils) into a SQL predicate selecting
+    a superset of the rows within the bounds; CatalogDBObject.filter still
+    applies the exact test to those rows.
+    """
+
+    @abc.abstractmethod
+    def build(self, connection, tableid, raColName, decColName, idColKey):
+        """
+        Build the index on the table tableid
+
+        @param [in] connection is the DBConnection to the table's database
+
+        @param [in] tableid is the name of the table
+
+        @param [in] raColName and decColName are the names of the
+        columns holding RA and Dec in degrees
+
+        @param [in] idColKey is the name of a column that uniquely identifies each row
+        """
+
+    @abc.abstractmethod
+    def exists(self, connection, tableid):
+        """
+        Return True if the index has been built on the table tableid
+        """
+
+    @abc.abstractmethod
+    def to_SQL(self, bounds, tableid):
+        """
+        Return a SQL predicate selecting (at least) the rows of tableid
+        within bounds, or None if this index cannot help with bounds
+        """
+
+
+class HtmIndex(SpatialIndex):
+    """
+    Index a table by the id of the Hierarchical Triangular Mesh trixel containing
+    each row, stored in an (indexed) integer column.  Circular bounds are covered
+    with trixels, which become ranges of ids.  Works with any database.
+    """
+
+    # the number of rows read, and whose ids are computed and written, at once by build()
+    chunk_size = 100000
+
+    def __init__(self, level=10, pixelColName='htmid'):
+        """
+        @param [in] level is the level of the mesh at which rows are indexed.
+        Trixels at level 10 are about 0.1 degrees across; each level halves that.
+
+        @param [in] pixelColName is the name of the column holding the trixel ids
+        """
+        self.level = level
+        self.pixelColName = pixelColName
+
+    def _uses_rowid(self, engine):
+        """
+        Return True if build() should find the rows to update by rowid (which
+        is always indexed), rather than by joining on idColKey (which may not be)
+        """
+        return engine.dialect.name == 'sqlite'
+
+    def build(self, connection, tableid, raColName, decColName, idColKey):
+        engine = connection.engine
+        quote = engine.dialect.identifier_preparer.quote
+        column_type = satypes.BIGINT().compile(dialect=engine.dialect)
+        uses_rowid = self._uses_rowid(engine)
+
+        with engine.begin() as db_connection:
+            new_column = self.pixelColName not in connection.get_column_names(tableid)
+            if new_column:
+                db_connection.execute(text('ALTER TABLE %s ADD %s %s' %
+                                           (quote(tableid), quote(self.pixelColName), column_type)))
+            table = Table(tableid, MetaData(), autoload_with=db_connection)
+            if uses_rowid:
+                query = text('SELECT rowid, %s, %s FROM %s' %
+                             (quote(raColName), quote(decColName), quote(tableid)))
+                update = text('UPDATE %s SET %s = :htmid WHERE rowid = :id' %
+                              (quote(tableid), quote(self.pixelColName)))
+            else:
+                # the trixel ids are loaded into a temporary table keyed on idColKey,
+                # and copied into the table by a single UPDATE
+                query = text('SELECT %s, %s, %s FROM %s' %
+                             (quote(idColKey), quote(raColName), quote(decColName), quote(tableid)))
+                pixels = Table('%s_%s_tmp' % (tableid, self.pixelColName), MetaData(),
+                               Column('id', table.c[idColKey].type, primary_key=True),
+                               Column('htmid', satypes.BIGINT),
+                               prefixes=['TEMPORARY'])
+                pixels.create(db_connection)
+                update = pixels.insert()
+            # MySQL cannot run the updates on a connection with an unbuffered
+            # (streamed) result open, so its rows are buffered by the driver
+            if engine.dialect.name != 'mysql':
+                query = query.execution_options(stream_results=True)
+            rows = db_connection.execute(query)
+            try:
+                while True:
+                    chunk = rows.fetchmany(self.chunk_size)
+                    if len(chunk) == 0:
+                        break
+                    htmid = findHtmid(np.array([row[1] for row in chunk], dtype=float),
+                                      np.array([row[2] for row in chunk], dtype=float),
+                                      self.level)
+                    db_connection.execute(update, [{'htmid': int(pixel), 'id': row[0]}
+                                                   for pixel, row in zip(htmid, chunk)])
+            finally:
+                rows.close()
+            if not uses_rowid:
+                pixel = select([pixels.c.htmid]).where(pixels.c.id == table.c[idColKey])
+                db_connection.execute(table.update().values({self.pixelColName:
+                                                             pixel.scalar_subquery()}))
+                pixels.drop(db_connection)
+            if new_column:
+                db_connection.execute(text('CREATE INDEX %s ON %s (%s)' %
+                                           (quote('%s_%s_idx' % (tableid, self.pixelColName)),
+                                            quote(tableid), quote(self.pixelColName))))
+        connection.refresh_schema()
+
+    def exists(self, connection, tableid):
+        return self.pixelColName in connection.get_column_names(tableid)
+
+    def get_ranges(self, ra, dec, radius):
+        """
+        Return a list of (min, max) tuples of the ids (at self.level) of
+        the trixels covering a circle
+
+        @param [in] ra, dec are the center of the circle in radians
+
+        @param [in] radius is the radius of the circle in radians
+        """
+        center = np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+        cos_radius = np.cos(radius)
+
+        # trixels at level L are about 90/2**L degrees across; stop dividing
+        # partially covered trixels when they are a few times smaller than the circle
+        max_level = self.level
+        while max_level > 0 and np.radians(90.0)/2**(max_level-1) < 0.25*radius:
+            max_level -= 1
+
+        ids = np.arange(8, 16, dtype=np.int64)
+        corners = _htm_roots
+        ranges = []
+        for level in range(max_level + 1):
+            centers = _normalize(corners.sum(axis=1))
+            extent = np.arccos(np.clip((centers[:, None, :]*corners).sum(axis=-1), -1.0, 1.0)).max(axis=1)
+            distance = np.arccos(np.clip(np.dot(centers, center), -1.0, 1.0))
+            touching = distance <= extent + radius
+            if radius < 0.5*np.pi:
+                inside = ((corners*center).sum(axis=-1) >= cos_radius).all(axis=1)
+            else:
+                inside = np.zeros(len(ids), dtype=bool)
+
+            shift = 2*(self.level - level)
+            done = inside | (touching & (level == max_level))
+            for pixel in ids[done]:
+                ranges.append((int(pixel) << shift, ((int(pixel) + 1) << shift) - 1))
+
+            divide = touching & ~done
+            ids = (4*ids[divide][:, None] + np.arange(4)).flatten()
+            corners = _children(corners[divide]).reshape(-1, 3, 3)
+            if len(ids) == 0:
+                break
+
+        ranges.sort()
+        merged = []
+        for low, high in ranges:
+            if len(merged) > 0 and low <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(high, merged[-1][1]))
+            else:
+                merged.append((low, high))
+        return merged
+
+    def to_SQL(self, bounds, tableid):
+        if getattr(bounds, 'boundType', None) != 'circle':
+            return None
+        ranges = self.get_ranges(bounds.RA, bounds.DEC, bounds.radius)
+        if len(ranges) == 0:
+            return '0 = 1'
+        return '(%s)' % ' OR '.join(['%s BETWEEN %d AND %d' % (self.pixelColName, low, high)
+                                     for low, high in ranges])
+
+
+class RTreeIndex(SpatialIndex):
+    """
+    Index a sqlite table with an R*Tree virtual table holding the RA and Dec
+    of each row (keyed on its rowid).  Both circular and box bounds are
+    turned into boxes in RA and Dec.  The R*Tree is not updated when rows are
+    added to the table; build it again after loading data.
+    """
+
+    def __init__(self, rtreeName=None):
+        """
+        @param [in] rtreeName is the name of the R*Tree table
+        (the default is tableid + '_rtree')
+        """
+        self.rtreeName = rtreeName
+
+    def _get_name(self, tableid):
+        if self.rtreeName is not None:
+            return self.rtreeName
+        return '%s_rtree' % tableid
+
+    def build(self, connection, tableid, raColName, decColName, idColKey):
+        engine = connection.engine
+        if engine.dialect.name != 'sqlite':
+            raise RuntimeError("RTreeIndex only works with sqlite; "
+                               "you are using %s" % engine.dialect.name)
+        quote = engine.dialect.identifier_preparer.quote
+        rtree = quote(self._get_name(tableid))
+
+        with engine.begin() as db_connection:
+            db_connection.execute(text('DROP TABLE IF EXISTS %s' % rtree))
+            db_connection.execute(text('CREATE VIRTUAL TABLE %s USING rtree'
+                                       '(id, ra_min, ra_max, dec_min, dec_max)' % rtree))
+            db_connection.execute(text('INSERT INTO %s SELECT rowid, %s, %s, %s, %s FROM %s' %
+                                       (rtree, quote(raColName), quote(raColName),
+                                        quote(decColName), quote(decColName), quote(tableid))))
+        connection.refresh_schema()
+
+    def exists(self, connection, tableid):
+        return self._get_name(tableid) in connection.get_table_names()
+
+    def get_boxes(self, bounds):
+        """
+        Return a list of (ra_min, ra_max, dec_min, dec_max) tuples (in degrees)
+        covering bounds, or None if bounds are neither a circle nor a box.
+        Boxes are repeated 360 degrees either side, so RA may run from
+        0 to 360 or from -180 to 180.
+        """
+        bound_type = getattr(bounds, 'boundType', None)
+        if bound_type == 'circle':
+            dec_min = np.degrees(bounds.DEC - bounds.radius)
+            dec_max = np.degrees(bounds.DEC + bounds.radius)
+            if dec_min <= -90.0 or dec_max >= 90.0:
+                return [(-360.0, 720.0, max(dec_min, -90.0), min(dec_max, 90.0))]
+            half_width = np.degrees(np.arcsin(np.sin(bounds.radius)/np.cos(bounds.DEC)))
+            ra_min = np.degrees(bounds.RA) - half_width
+            ra_max = np.degrees(bounds.RA) + half_width
+        elif bound_type == 'box':
+            dec_min = bounds.DECminDeg
+            dec_max = bounds.DECmaxDeg
+            ra_min = bounds.RAminDeg
+            ra_max = bounds.RAmaxDeg
+            if ra_max < ra_min:
+                ra_max += 360.0
+        else:
+            return None
+        return [(ra_min + offset, ra_max + offset, dec_min, dec_max)
+                for offset in (-360.0, 0.0, 360.0)]
+
+    def to_SQL(self, bounds, tableid):
+        boxes = self.get_boxes(bounds)
+        if boxes is None:
+            return None
+        where = ' OR '.join(['(ra_max >= %.17g AND ra_min <= %.17g AND dec_max >= %.17g AND dec_min <= %.17g)' %
+                             box for box in boxes])
+        return '%s.rowid IN (SELECT id FROM %s WHERE %s)' % (tableid, self._get_name(tableid), where)
@@ -33,6 +33,103 @@ def np_to_sql_type(input_type):
     raise RuntimeError("Do not know how to map %s to SQL" % str(input_type))
 
 
+def parse_byte_budget(budget):
+    """
+    Convert a memory budget into a number of bytes.
+
+    budget is either a number of bytes or a string like '256MB', '1.5 GB'
+    or '512kB' (units are powers of 1024; a bare number is bytes)
+
+    Returns an int
+    """
+    units = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+
+    try:
+        is_string = isinstance(budget, basestring)
+    except NameError:
+        is_string = isinstance(budget, str)
+
+    if is_string:
+        value = budget.strip().upper()
+        factor = 1
+        for unit in ('KB', 'MB', 'GB', 'TB', 'B'):
+            if value.endswith(unit):
+                factor = units[unit]
+                value = value[:-len(unit)].strip()
+                break
+        try:
+            n_bytes = int(float(value)*factor)
+        except ValueError:
+            raise ValueError("Cannot interpret '%s' as a number of bytes" % budget)
+    else:
+        n_bytes = int(budget)
+
+    if n_bytes <= 0:
+        raise ValueError("A byte budget must be positive; you gave %s" % str(budget))
+    return n_bytes
+
+
+def add_unit_vector_columns(connection, tableid, raColName, decColName,
+                            unitVectorColNames=('unit_x', 'unit_y', 'unit_z')):
+    """
+    Add (or recompute) three columns holding the Cartesian unit vector
+    (cos(dec)*cos(ra), cos(dec)*sin(ra), sin(dec)) pointing at each row of a table,
+    so that CatalogDBObject can test whether a row lies in a circular field of view
+    with a dot product, rather than with the Haversine formula (see
+    CatalogDBObject.unitVectorColNames).
+
+    Parameters
+    ----------
+    connection is the DBConnection to the database (e.g. a DBObject's connection),
+    or a sqlalchemy engine connected to it
+    tableid is the name of the table
+    raColName and decColName are the names of the columns holding RA and Dec in degrees
+    unitVectorColNames are the names of the three columns to write
+
+    Given a DBConnection, the schema of the table it has read is discarded (the
+    reflected Table, see CatalogDBObject.table, and the column names), as is the
+    table's entry in CatalogDBObject.schema_cache, so that the CatalogDBObjects
+    using the connection see the new columns.  Given an engine, nothing is
+    refreshed: the CatalogDBObjects must be re-instantiated on a new connection.
+    """
+    from sqlalchemy import inspect, text
+    from .dbConnection import DBConnection, CatalogDBObject, declareTrigFunctions
+
+    if isinstance(connection, DBConnection):
+        engine = connection.engine
+    else:
+        engine, connection = connection, None
+
+    existing = [column['name'] for column in inspect(engine).get_columns(tableid)]
+    column_type = satypes.Float(precision=53).compile(dialect=engine.dialect)
+    quote = engine.dialect.identifier_preparer.quote
+
+    ra = '%s*PI()/180.0' % quote(raColName)
+    dec = '%s*PI()/180.0' % quote(decColName)
+    values = ['COS(%s)*COS(%s)' % (dec, ra), 'COS(%s)*SIN(%s)' % (dec, ra), 'SIN(%s)' % dec]
+
+    with engine.begin() as db_connection:
+        if engine.dialect.name == 'sqlite':
+            # make sure the math functions are defined on this connection
+            declareTrigFunctions(db_connection.connection, None)
+        for name in unitVectorColNames:
+            if name not in existing:
+                db_connection.execute(text('ALTER TABLE %s ADD %s %s' %
+                                           (quote(tableid), quote(name), column_type)))
+        db_connection.execute(text('UPDATE %s SET %s' %
+                                   (quote(tableid),
+                                    ', '.join(['%s = %s' % (quote(name), value)
+                                               for name, value in zip(unitVectorColNames, values)]))))
+
+    if connection is not None:
+        with connection._schema_lock:
+            table = connection.metadata.tables.get(tableid)
+            if table is not None:
+                connection.metadata.remove(table)
+        connection.refresh_schema()
+        CatalogDBObject.schema_cache.invalidate(connection, tableid)
+
+
 # from http://stackoverflow.com/questions/2257441/python-random-string-generation-with-upper-case-letters-and-digits
 def id_generator(size=8, chars=string.ascii_lowercase):
     return ''.join(random.choice(chars) for x in range(size))
@@ -7,11 +7,14 @@ from builtins import object
 import warnings
 import numpy as np
 import inspect
+import json
+import os
 import re
 import copy
 from collections import OrderedDict
 from lsst.sims.utils import defaultSpecMap
 from lsst.sims.utils import ObservationMetaData
+from lsst.sims.catalogs.db.categorical import get_vocabulary, decode_categorical
 from future.utils import with_metaclass
 
 __all__ = ["InstanceCatalog"]
@@ -118,6 +121,19 @@ class _MimicRecordArray(object):
         return 0
 
 
+def _as_record_array(chunk):
+    """
+    Return chunk (a chunk of the results of CatalogDBObject.query_columns),
+    with a pyarrow RecordBatch wrapped in a RecordBatchChunk so that it can
+    be read like a recarray
+    """
+    if isinstance(chunk, np.ndarray) or not hasattr(chunk, 'schema'):
+        return chunk
+    # only reached if pyarrow is installed
+    from lsst.sims.catalogs.db.arrowOutput import RecordBatchChunk
+    return RecordBatchChunk(chunk)
+
+
 class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
     """ Base class for instance catalogs generated by simulations.
 
@@ -147,6 +163,9 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
     endline = "\n"
     _pre_screen = False  # if true, write_catalog() will check database query results against
                          # cannot_be_null before calculating getter columns
+    query_output = None  # if 'arrow', the database is queried for pyarrow RecordBatches
+                         # (see CatalogDBObject.query_columns), which getters see through
+                         # numpy views (see RecordBatchChunk)
 
     @classmethod
     def new_catalog(cls, catalog_type, *args, **kwargs):
@@ -366,7 +385,14 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
         return db_required_columns, list(required_columns_with_defaults)
 
     def column_by_name(self, column_name, *args, **kwargs):
-        """Given a column name, return the column data"""
+        """Given a column name, return the column data
+
+        Columns the db_obj returns dictionary-encoded (see
+        CatalogDBObject.categoricalColumns) are returned as their codes;
+        decode them with decode_categorical if the strings are needed.
+        If query_output is 'arrow', database columns are read-only views
+        of the Arrow data wherever possible.
+        """
 
         if (isinstance(self._current_chunk, _MimicRecordArray) and
             column_name not in self._actually_calculated_columns):
@@ -464,7 +490,8 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
                           self.endline)
 
     def write_catalog(self, filename, chunk_size=None,
-                      write_header=True, write_mode='w'):
+                      write_header=True, write_mode='w', prefetch=None,
+                      chunk_bytes=None, checkpoint_file=None):
         """
         Write query self.db_obj and write the resulting InstanceCatalog to
         an ASCII output file
@@ -480,6 +507,23 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
 
         @param [in] write_mode is 'w' if you want to overwrite the output file or
         'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] prefetch is an optional int.  If specified, up to prefetch
+        chunks will be queried from the database in a background thread while
+        the current chunk is being written (see CatalogDBObject.query_columns)
+
+        @param [in] chunk_bytes is an optional memory budget per chunk (an int
+        number of bytes or a string like '256MB') to use instead of chunk_size.
+        The number of rows per chunk accounts for the columns computed by the
+        catalog's getters, as measured on the chunks already written.
+
+        @param [in] checkpoint_file is the optional name of a file in which
+        to record progress after each chunk is written.  The database is
+        paged through by the id column (see CatalogDBObject.query_columns
+        with keyset=True), so that, if the checkpoint_file exists when
+        write_catalog is called (because a previous call was interrupted),
+        the catalog is resumed from the last chunk that was completely
+        written.  checkpoint_file is deleted once the catalog is complete.
         """
 
         self._write_pre_process()
@@ -488,10 +532,14 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
                               write_header=write_header,
                               write_mode=write_mode,
                               obs_metadata=self.obs_metadata,
-                              constraint=self.constraint)
+                              constraint=self.constraint,
+                              prefetch=prefetch,
+                              chunk_bytes=chunk_bytes,
+                              checkpoint_file=checkpoint_file)
 
     def _query_and_write(self, filename, chunk_size=None, write_header=True,
-                         write_mode='w', obs_metadata=None, constraint=None):
+                         write_mode='w', obs_metadata=None, constraint=None,
+                         prefetch=None, chunk_bytes=None, checkpoint_file=None):
         """
         This method queries db_obj, and then writes the resulting recarray
         to the specified ASCII output file.
@@ -512,19 +560,80 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
 
         @param [in] write_mode is 'w' if you want to overwrite the output file or
         'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] prefetch is an optional int specifying how many chunks to
+        query from the database in a background thread while writing
+
+        @param [in] chunk_bytes is an optional memory budget per chunk
+        to use instead of chunk_size
+
+        @param [in] checkpoint_file is an optional file in which to record
+        the progress of the catalog, so that an interrupted write can be resumed
         """
 
+        checkpoint = None
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            with open(checkpoint_file, 'r') as input_file:
+                checkpoint = json.load(input_file)
+            write_mode = 'a'
+            write_header = False
+
         with open(filename, write_mode) as file_handle:
+            if checkpoint is not None:
+                # discard anything written after the last checkpoint
+                file_handle.truncate(checkpoint['file_offset'])
+                file_handle.seek(checkpoint['file_offset'])
+
             if write_header:
                 self.write_header(file_handle)
 
+            query_kwargs = {}
+            if prefetch is not None:
+                query_kwargs['prefetch'] = prefetch
+            if chunk_bytes is not None:
+                query_kwargs['chunk_bytes'] = chunk_bytes
+            if checkpoint_file is not None:
+                query_kwargs['keyset'] = True
+                if checkpoint is not None:
+                    query_kwargs['resume_from'] = checkpoint['position']
+            if self.query_output is not None:
+                query_kwargs['output'] = self.query_output
+
             query_result = self.db_obj.query_columns(colnames=self._active_columns,
                                                      obs_metadata=obs_metadata,
                                                      constraint=constraint,
-                                                     chunk_size=chunk_size)
-
-            for chunk in query_result:
-                self._write_recarray(chunk, file_handle)
+                                                     chunk_size=chunk_size,
+                                                     **query_kwargs)
+
+            try:
+                for chunk in query_result:
+                    self._write_recarray(chunk, file_handle)
+                    if chunk_bytes is not None and hasattr(query_result, 'set_row_overhead'):
+                        query_result.set_row_overhead(self._row_overhead)
+                    if checkpoint_file is not None:
+                        self._write_checkpoint(checkpoint_file, file_handle,
+                                               query_result.position)
+            finally:
+                if hasattr(query_result, 'close'):
+                    query_result.close()
+
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            os.unlink(checkpoint_file)
+
+    def _write_checkpoint(self, checkpoint_file, file_handle, position):
+        """
+        Record that everything up to the current end of file_handle
+        has been written, and that the database query has reached position.
+        The checkpoint is written to a temporary file and moved into place,
+        so that an interruption never leaves a partial checkpoint behind.
+        """
+        file_handle.flush()
+        os.fsync(file_handle.fileno())
+        checkpoint = {'file_offset': file_handle.tell(), 'position': position}
+        temp_name = checkpoint_file + '.tmp'
+        with open(temp_name, 'w') as output_file:
+            json.dump(checkpoint, output_file)
+        os.rename(temp_name, checkpoint_file)
 
     def _write_pre_process(self):
         """
@@ -533,6 +642,7 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
         """
         db_required_columns, required_columns_with_defaults = self.db_required_columns()
         self._template = None
+        self._row_overhead = 0
 
     def _update_current_chunk(self, good_dexes):
         """
@@ -564,6 +674,7 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
         this test.  Return a numpy array of the indices of those rows relative to
         the original chunk.
         """
+        chunk = _as_record_array(chunk)
         final_dexes = np.arange(len(chunk), dtype=int)
 
         if self._pre_screen and self._cannot_be_null is not None:
@@ -571,12 +682,13 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
             # rows that have already run afoul of self._cannot_be_null
             for col_name in self._cannot_be_null:
                 if col_name in chunk.dtype.names:
-                    if chunk[col_name].dtype == float:
+                    if get_vocabulary(chunk[col_name]) is not None:
+                        good_dexes = np.where(self._not_null_categorical(chunk[col_name],
+                                                                         self._not_null_str))
+                    elif chunk[col_name].dtype == float:
                         good_dexes = np.where(np.isfinite(chunk[col_name]))
                     else:
-                        str_vec = np.char.lower(chunk[col_name].astype('str'))
-                        good_dexes = np.where(np.logical_and(str_vec != 'none',
-                                              np.logical_and(str_vec != 'nan', str_vec != 'null')))
+                        good_dexes = np.where(self._not_null_str(chunk[col_name]))
                     chunk = chunk[good_dexes]
                     final_dexes = final_dexes[good_dexes]
 
@@ -588,16 +700,10 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
             filter_switch = None
             for filter_col in self._cannot_be_null:
                 filter_vals = self.column_by_name(filter_col)
-                if filter_vals.dtype == float:
-                    local_switch = np.isfinite(filter_vals)
+                if get_vocabulary(filter_vals) is not None:
+                    local_switch = self._not_null_categorical(filter_vals, self._not_null)
                 else:
-                    try:
-                       filter_vals = filter_vals.astype(float)
-                       local_switch = np.isfinite(filter_vals)
-                    except ValueError:
-                        filter_vals = np.char.lower(filter_vals.astype('str'))
-                        local_switch = np.logical_and(filter_vals != 'none',
-                                                      np.logical_and(filter_vals  != 'nan', filter_vals != 'null'))
+                    local_switch = self._not_null(filter_vals)
                 if filter_switch is None:
                     filter_switch = local_switch
                 else:
@@ -611,6 +717,40 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
 
         return final_dexes
 
+    def _not_null(self, filter_vals):
+        """
+        Return a boolean array which is False where filter_vals
+        (a numpy array) is None, NaN or NULL
+        """
+        if filter_vals.dtype == float:
+            return np.isfinite(filter_vals)
+        try:
+            return np.isfinite(filter_vals.astype(float))
+        except ValueError:
+            return self._not_null_str(filter_vals)
+
+    def _not_null_str(self, filter_vals):
+        """
+        Return a boolean array which is False where filter_vals,
+        as strings, are 'None', 'NaN' or 'NULL' (in any case)
+        """
+        filter_vals = np.char.lower(filter_vals.astype('str'))
+        return np.logical_and(filter_vals != 'none',
+                              np.logical_and(filter_vals != 'nan', filter_vals != 'null'))
+
+    def _not_null_categorical(self, filter_vals, not_null):
+        """
+        Apply not_null (_not_null or _not_null_str) to the categorical column
+        filter_vals.  Only the values of the vocabulary which occur in the
+        column are tested (and only once each); the rows are then
+        selected by their codes.
+        """
+        codes = np.asarray(filter_vals, dtype=np.int32)
+        present = np.flatnonzero(np.bincount(codes, minlength=1))
+        vocabulary_switch = np.zeros(present[-1]+1 if len(present) > 0 else 0, dtype=bool)
+        vocabulary_switch[present] = not_null(decode_categorical(present.astype(filter_vals.dtype)))
+        return vocabulary_switch[codes]
+
     def _write_current_chunk(self, file_handle):
         """
         write self._current_chunk to the file specified by file_handle
@@ -620,11 +760,20 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
 
         list_of_transform_keys = list(self.transformations.keys())
 
-        chunk_cols = [self.transformations[col](self.column_by_name(col))
+        # categorical columns are decoded into the strings of their
+        # vocabularies (not copies of them) just to be formatted
+        chunk_cols = [self.transformations[col](decode_categorical(self.column_by_name(col)))
                       if col in list_of_transform_keys else
-                      self.column_by_name(col)
+                      decode_categorical(self.column_by_name(col), dtype=object)
                       for col in self.iter_column_names()]
 
+        # Record the memory per row taken up by the columns computed
+        # from the chunk (columns that are just views of the chunk cost nothing)
+        computed_bytes = sum(col.nbytes for col in chunk_cols
+                             if isinstance(col, np.ndarray) and
+                             not self._shares_memory_with_chunk(col))
+        self._row_overhead = computed_bytes/float(len(self._current_chunk))
+
         # Create the template with the first chunk
         if self._template is None:
             self._template = self._make_line_template(chunk_cols)
@@ -633,6 +782,14 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
         # for memory efficiency
         file_handle.writelines(self._template % line for line in zip(*chunk_cols))
 
+    def _shares_memory_with_chunk(self, col):
+        """
+        Return True if the numpy array col may be a view of self._current_chunk
+        """
+        if isinstance(self._current_chunk, np.ndarray):
+            return np.may_share_memory(col, self._current_chunk)
+        return self._current_chunk.shares_memory(col)
+
     def _write_recarray(self, chunk, file_handle):
         """
         This method takes a recarray (usually returned by querying db_obj),
@@ -660,18 +817,23 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
         """
         self.db_required_columns()
 
+        query_kwargs = {}
+        if self.query_output is not None:
+            query_kwargs['output'] = self.query_output
+
         query_result = self.db_obj.query_columns(colnames=self._active_columns,
                                                  obs_metadata=self.obs_metadata,
                                                  constraint=self.constraint,
-                                                 chunk_size=chunk_size)
+                                                 chunk_size=chunk_size,
+                                                 **query_kwargs)
 
         list_of_transform_keys = list(self.transformations.keys())
 
         for chunk in query_result:
             self._filter_chunk(chunk)
-            chunk_cols = [self.transformations[col](self.column_by_name(col))
+            chunk_cols = [self.transformations[col](decode_categorical(self.column_by_name(col)))
                           if col in list_of_transform_keys else
-                          self.column_by_name(col)
+                          decode_categorical(self.column_by_name(col))
                           for col in self.iter_column_names()]
             for line in zip(*chunk_cols):
                 yield line
@@ -701,18 +863,23 @@ class InstanceCatalog(with_metaclass(InstanceCatalogMeta, object)):
         """
         self.db_required_columns()
 
+        query_kwargs = {}
+        if self.query_output is not None:
+            query_kwargs['output'] = self.query_output
+
         query_result = self.db_obj.query_columns(colnames=self._active_columns,
                                                  obs_metadata=self.obs_metadata,
                                                  constraint=self.constraint,
-                                                 chunk_size=chunk_size)
+                                                 chunk_size=chunk_size,
+                                                 **query_kwargs)
 
         list_of_transform_keys = list(self.transformations.keys())
 
         for chunk in query_result:
             self._filter_chunk(chunk)
-            chunk_cols = [self.transformations[col](self.column_by_name(col))
+            chunk_cols = [self.transformations[col](decode_categorical(self.column_by_name(col)))
                           if col in list_of_transform_keys else
-                          self.column_by_name(col)
+                          decode_categorical(self.column_by_name(col))
                           for col in self.iter_column_names()]
             chunkColMap = dict([(col, i) for i, col in enumerate(self.iter_column_names())])
             yield chunk_cols, chunkColMap
@@ -0,0 +1,198 @@
+import os
+import sqlite3
+import unittest
+import tempfile
+import shutil
+import numpy as np
+import lsst.utils.tests
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.utils import ObservationMetaData
+from lsst.sims.catalogs.db import CatalogDBObject, get_vocabulary, decode_categorical
+
+try:
+    import pyarrow
+    from lsst.sims.catalogs.db.arrowOutput import RecordBatchChunk
+    _has_pyarrow = True
+except ImportError:
+    _has_pyarrow = False
+
+try:
+    import adbc_driver_sqlite
+    _has_adbc = True
+except ImportError:
+    _has_adbc = False
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class arrowTestDB(CatalogDBObject):
+    objid = 'arrowOutputTest'
+    tableid = 'test'
+    idColKey = 'id'
+    driver = 'sqlite'
+    raColName = 'ra'
+    decColName = 'dec'
+    skipRegistration = True
+    dbDefaultValues = {'name': 'none'}
+    columns = [('raJ2000', 'ra*%f' % (np.pi/180.)),
+               ('decJ2000', 'dec*%f' % (np.pi/180.)),
+               ('name', 'name', str, 10)]
+
+
+class arrowCursorTestDB(arrowTestDB):
+    useADBC = False
+
+
+class arrowCategoricalTestDB(arrowCursorTestDB):
+    categoricalColumns = ('sed',)
+
+
+class arrowFinalPassTestDB(arrowTestDB):
+
+    def _final_pass(self, results):
+        return results
+
+
+@unittest.skipIf(not _has_pyarrow, "pyarrow is not installed")
+class ArrowOutputTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='ArrowOutputTestCase-')
+        cls.db_name = os.path.join(cls.scratch_dir, 'arrowOutputTestDB.db')
+        rng = np.random.RandomState(512)
+        ra = rng.random_sample(2000)*360.0
+        dec = np.degrees(np.arcsin(rng.random_sample(2000)*2.0 - 1.0))
+        mag = rng.random_sample(2000)*10.0 + 15.0
+        conn = sqlite3.connect(cls.db_name)
+        conn.execute('CREATE TABLE test (id int, ra real, dec real, name text, sed text, mag real)')
+        conn.executemany('INSERT INTO test VALUES (?, ?, ?, ?, ?, ?)',
+                         [(ii, ra[ii], dec[ii], None if ii % 3 == 0 else 'star_%d' % ii,
+                           'sed_%d.dat' % (ii % 7), None if ii % 5 == 0 else mag[ii])
+                          for ii in range(2000)])
+        conn.commit()
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+
+    def assertBatchMatches(self, batch, control):
+        """
+        Assert that the RecordBatch batch holds the same values
+        as the recarray control
+        """
+        self.assertIsInstance(batch, pyarrow.RecordBatch)
+        self.assertEqual(batch.schema.names, list(control.dtype.names))
+        chunk = RecordBatchChunk(batch)
+        self.assertEqual(len(chunk), len(control))
+        for name in control.dtype.names:
+            values = decode_categorical(chunk[name])
+            control_values = decode_categorical(control[name])
+            if control_values.dtype.kind in 'US':
+                values = values.astype(control_values.dtype)
+            np.testing.assert_array_equal(values, control_values)
+
+    def testResults(self):
+        """
+        Test that query_columns(..., output='arrow') returns the
+        same chunks as query_columns, read by ADBC or from the cursor
+        """
+        obs = ObservationMetaData(boundType='circle', pointingRA=10.0, pointingDec=-20.0,
+                                  boundLength=30.0)
+        colnames = ['id', 'raJ2000', 'decJ2000', 'name', 'mag']
+        db_classes = [arrowCursorTestDB]
+        if _has_adbc:
+            db_classes.append(arrowTestDB)
+
+        for db_class in db_classes:
+            dbobj = db_class(database=self.db_name)
+            for kwargs in ({'chunk_size': 100}, {}, {'obs_metadata': obs, 'chunk_size': 50},
+                           {'obs_metadata': obs}, {'obs_metadata': obs, 'limit': 20},
+                           {'constraint': 'id < 500', 'chunk_size': 33},
+                           {'constraint': 'id < 0', 'chunk_size': 10}):
+                control = list(dbobj.query_columns(colnames=colnames, **kwargs))
+                test = list(dbobj.query_columns(colnames=colnames, output='arrow', **kwargs))
+                self.assertEqual(len(test), len(control))
+                for batch, control_chunk in zip(test, control):
+                    self.assertBatchMatches(batch, control_chunk)
+
+            batch = next(dbobj.query_columns(colnames=colnames, output='arrow'))
+            self.assertEqual(batch.schema.field('id').type, pyarrow.int64())
+            self.assertEqual(batch.schema.field('name').type, pyarrow.string())
+            # NULLs are kept, except in columns with defaults
+            self.assertEqual(batch.column('name').null_count, 0)
+            self.assertEqual(batch.column('mag').null_count, 400)
+
+    def testCategorical(self):
+        """
+        Test that categorical columns are returned dictionary-encoded, and
+        are read by RecordBatchChunk as categorical numpy columns
+        """
+        dbobj = arrowCategoricalTestDB(database=self.db_name)
+        control = list(dbobj.query_columns(colnames=['id', 'sed'], chunk_size=300))
+        test = list(dbobj.query_columns(colnames=['id', 'sed'], chunk_size=300, output='arrow'))
+        self.assertEqual(len(test), len(control))
+        for batch, control_chunk in zip(test, control):
+            self.assertTrue(pyarrow.types.is_dictionary(batch.schema.field('sed').type))
+            self.assertBatchMatches(batch, control_chunk)
+            sed = RecordBatchChunk(batch)['sed']
+            self.assertEqual(sed.dtype, np.int32)
+            self.assertEqual(sorted(get_vocabulary(sed)), ['sed_%d.dat' % ii for ii in range(7)])
+
+    def testRecordBatchChunk(self):
+        """
+        Test that RecordBatchChunk returns zero-copy views of numeric
+        columns, and selects rows as a recarray would
+        """
+        dbobj = arrowCursorTestDB(database=self.db_name)
+        batch = next(dbobj.query_columns(colnames=['id', 'raJ2000', 'name', 'mag'],
+                                         chunk_size=100, output='arrow'))
+        chunk = RecordBatchChunk(batch)
+        self.assertEqual(chunk.dtype.names, ('id', 'raJ2000', 'name', 'mag'))
+
+        ra = chunk['raJ2000']
+        self.assertIs(chunk['raJ2000'], ra)
+        self.assertFalse(ra.flags.writeable)
+        buffer = batch.column('raJ2000').buffers()[1]
+        self.assertEqual(ra.__array_interface__['data'][0], buffer.address)
+        self.assertTrue(chunk.shares_memory(ra[10:20]))
+        self.assertFalse(chunk.shares_memory(ra*2.0))
+        # a column with NULLs cannot be viewed, and is copied
+        self.assertTrue(np.isnan(chunk['mag'][0]))
+
+        good_dexes = np.where(chunk['id'] % 2 == 0)
+        selected = chunk[good_dexes]
+        self.assertIsInstance(selected, RecordBatchChunk)
+        np.testing.assert_array_equal(selected['id'], np.arange(0, 100, 2))
+        np.testing.assert_array_equal(selected['name'], chunk['name'][good_dexes])
+        np.testing.assert_array_equal(chunk[chunk['id'] < 5]['id'], np.arange(5))
+
+    def testInvalidArguments(self):
+        """
+        Test that output='arrow' cannot be combined with options it does not support
+        """
+        dbobj = arrowCursorTestDB(database=self.db_name)
+        with self.assertRaises(ValueError):
+            dbobj.query_columns(colnames=['id'], output='pandas')
+        for kwargs in ({'prefetch': 2}, {'chunk_bytes': '1MB'}, {'keyset': True},
+                       {'partitions': 2}):
+            with self.assertRaises(ValueError):
+                dbobj.query_columns(colnames=['id'], chunk_size=10, output='arrow', **kwargs)
+        with self.assertRaises(ValueError):
+            arrowFinalPassTestDB(database=self.db_name).query_columns(colnames=['id'], output='arrow')
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import unittest
+import tempfile
+import shutil
+import numpy as np
+import lsst.utils.tests
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.utils import ObservationMetaData
+from lsst.sims.catalogs.db import CatalogDBObject
+
+try:
+    import asyncio
+    import aiosqlite
+    from sqlalchemy import event
+    from lsst.sims.catalogs.db.asyncQuery import get_async_engine
+    _has_aiosqlite = True
+except ImportError:
+    _has_aiosqlite = False
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class asyncTestDB(CatalogDBObject):
+    objid = 'asyncQueryTest'
+    tableid = 'test'
+    idColKey = 'id'
+    driver = 'sqlite'
+    raColName = 'ra'
+    decColName = 'dec'
+    skipRegistration = True
+    dbDefaultValues = {'name': 'none'}
+    columns = [('raJ2000', 'ra*%f' % (np.pi/180.)),
+               ('decJ2000', 'dec*%f' % (np.pi/180.)),
+               ('name', 'name', str, 10)]
+
+
+class asyncLimitedTestDB(asyncTestDB):
+    async_concurrency = 2
+
+
+async def _consume(iterator):
+    chunks = []
+    async for chunk in iterator:
+        chunks.append(chunk)
+    return chunks
+
+
+@unittest.skipIf(not _has_aiosqlite, "aiosqlite is not installed")
+class AsyncQueryTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='AsyncQueryTestCase-')
+        cls.db_name = os.path.join(cls.scratch_dir, 'asyncQueryTestDB.db')
+        rng = np.random.RandomState(816)
+        ra = rng.random_sample(2000)*360.0
+        dec = np.degrees(np.arcsin(rng.random_sample(2000)*2.0 - 1.0))
+        conn = sqlite3.connect(cls.db_name)
+        conn.execute('CREATE TABLE test (id int, ra real, dec real, name text)')
+        conn.executemany('INSERT INTO test VALUES (?, ?, ?, ?)',
+                         [(ii, ra[ii], dec[ii], None if ii % 3 == 0 else 'star_%d' % ii)
+                          for ii in range(2000)])
+        conn.commit()
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+
+    def testResults(self):
+        """
+        Test that query_columns_async returns the same chunks as query_columns
+        """
+        dbobj = asyncTestDB(database=self.db_name)
+        obs = ObservationMetaData(boundType='circle', pointingRA=10.0, pointingDec=-20.0,
+                                  boundLength=30.0)
+        colnames = ['id', 'raJ2000', 'decJ2000', 'name']
+
+        for kwargs in ({'chunk_size': 100}, {}, {'obs_metadata': obs, 'chunk_size': 50},
+                       {'obs_metadata': obs, 'limit': 20}, {'constraint': 'id < 500'},
+                       {'constraint': 'id < 0', 'chunk_size': 10}):
+            control = list(dbobj.query_columns(colnames=colnames, **kwargs))
+            test = asyncio.run(_consume(dbobj.query_columns_async(colnames=colnames, **kwargs)))
+            self.assertEqual(len(test), len(control))
+            for test_chunk, control_chunk in zip(test, control):
+                self.assertEqual(test_chunk.dtype, control_chunk.dtype)
+                np.testing.assert_array_equal(test_chunk, control_chunk)
+
+    def testConcurrency(self):
+        """
+        Test that many queries can run at once, and that no more than
+        async_concurrency queries are open at once
+        """
+        async def run_queries():
+            dbobj = asyncLimitedTestDB(database=self.db_name)
+            iterators = [dbobj.query_columns_async(colnames=['id'], chunk_size=100,
+                                                   constraint='id %% 10 = %d' % ii)
+                         for ii in range(3)]
+            first = await iterators[0].__anext__()
+            second = await iterators[1].__anext__()
+            self.assertEqual(len(first), 100)
+            self.assertEqual(len(second), 100)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(iterators[2].__anext__(), 0.5)
+
+            # a query which is cancelled is closed; start it again
+            await iterators[0].aclose()
+            iterators[2] = dbobj.query_columns_async(colnames=['id'], chunk_size=100,
+                                                     constraint='id % 10 = 2')
+            third = await iterators[2].__anext__()
+            self.assertEqual(len(third), 100)
+            await iterators[1].aclose()
+            await iterators[2].aclose()
+
+            results = await asyncio.gather(*[_consume(dbobj.query_columns_async(colnames=['id'],
+                                                                                 chunk_size=30,
+                                                                                 constraint='id < %d' % ii))
+                                             for ii in range(0, 200, 10)])
+            self.assertEqual([sum([len(chunk) for chunk in chunks]) for chunks in results],
+                             list(range(0, 200, 10)))
+
+        asyncio.run(run_queries())
+
+    def testEarlyExit(self):
+        """
+        Test that leaving a loop over the chunks early releases the query's
+        connection and its place in the semaphore
+        """
+        async def run_queries():
+            dbobj = asyncLimitedTestDB(database=self.db_name)
+            for ii in range(3):
+                async with dbobj.query_columns_async(colnames=['id'], chunk_size=100) as chunks:
+                    async for chunk in chunks:
+                        break
+            engine, semaphore = get_async_engine(dbobj.connection)
+            self.assertFalse(semaphore.locked())
+
+            # without async with, the query is closed when its iterator is collected
+            for ii in range(3):
+                async for chunk in dbobj.query_columns_async(colnames=['id'], chunk_size=100):
+                    self.assertEqual(len(chunk), 100)
+                    break
+            chunks = await asyncio.wait_for(_consume(dbobj.query_columns_async(colnames=['id'],
+                                                                               chunk_size=500)), 5.0)
+            self.assertEqual([len(chunk) for chunk in chunks], [500]*4)
+
+        asyncio.run(run_queries())
+
+    def testDispose(self):
+        """
+        Test that the asyncio engine is disposed of when the last query
+        running on it finishes, and can then be used again
+        """
+        n_disposed = []
+
+        async def run_queries():
+            dbobj = asyncTestDB(database=self.db_name)
+            engine, semaphore = get_async_engine(dbobj.connection)
+            event.listen(engine.sync_engine, 'engine_disposed', lambda engine: n_disposed.append(1))
+
+            chunks = dbobj.query_columns_async(colnames=['id'], chunk_size=100)
+            await chunks.__anext__()
+            results = await asyncio.gather(*[_consume(dbobj.query_columns_async(colnames=['id'],
+                                                                                 constraint='id < %d' % ii))
+                                             for ii in (10, 20)])
+            self.assertEqual([len(chunks[0]) for chunks in results], [10, 20])
+            self.assertEqual(len(n_disposed), 0)
+            await chunks.aclose()
+            self.assertEqual(len(n_disposed), 1)
+
+            self.assertEqual(len((await _consume(dbobj.query_columns_async(colnames=['id'])))[0]), 2000)
+            self.assertIs(get_async_engine(dbobj.connection)[0], engine)
+            self.assertEqual(len(n_disposed), 2)
+
+        asyncio.run(run_queries())
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -15,7 +15,7 @@ import shutil
 import lsst.utils.tests
 from lsst.sims.utils.CodeUtilities import sims_clean_up
 from lsst.sims.utils import ObservationMetaData
-from lsst.sims.catalogs.db import CatalogDBObject, fileDBObject
+from lsst.sims.catalogs.db import CatalogDBObject, fileDBObject, add_unit_vector_columns, QueryStats
 import lsst.sims.catalogs.utils.testUtils as tu
 from lsst.sims.catalogs.utils.testUtils import myTestStars, myTestGals
 from lsst.sims.utils import haversine
@@ -85,6 +85,34 @@ class testCatalogDBObjectTestGalaxies(myTestGals):
     driver = 'sqlite'
 
 
+class dbForStringSizingTest(CatalogDBObject):
+    objid = 'stringSizingTest'
+    tableid = 'stringSizingTest'
+    idColKey = 'id'
+    sizeStrings = True
+
+
+class dbForBytesStringTest(dbForStringSizingTest):
+    objid = 'bytesStringTest'
+    stringDtype = 'S'
+
+
+class dbForFixedStringTest(dbForStringSizingTest):
+    objid = 'fixedStringTest'
+    sizeStrings = False
+
+
+class compactTestGalaxies(myTestGals):
+    objid = 'compactTestGalaxies'
+    compactNumerics = True
+    precisionCriticalColumns = ('redshift',)
+
+
+class columnPrecisionTestGalaxies(myTestGals):
+    objid = 'columnPrecisionTestGalaxies'
+    columnPrecision = {'gmag': np.float32, 'id': np.int64}
+
+
 class CatalogDBObjectTestCase(unittest.TestCase):
 
     @classmethod
@@ -263,6 +291,163 @@ class CatalogDBObjectTestCase(unittest.TestCase):
             self.assertGreater(distance, radius)
         self.assertGreater(ct, 0)
 
+    def testUnitVectorCircularConstraints(self):
+        """
+        Test that a circle bound applied with unit vector columns (rather
+        than the Haversine formula) selects the same objects
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectNonsenseDB.db')
+        unit_db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectUnitVectorDB.db')
+        shutil.copyfile(db_name, unit_db_name)
+
+        # an object which has already read the table sees the new columns
+        unitNonsense = myNonsenseDB(database=unit_db_name)
+        self.assertFalse(unitNonsense._has_unit_vector_columns())
+        self.assertNotIn('unit_x', unitNonsense.get_column_names('test'))
+        add_unit_vector_columns(unitNonsense.connection, 'test', 'ra', 'dec')
+        self.assertTrue(unitNonsense._has_unit_vector_columns())
+        self.assertIn('unit_x', unitNonsense.get_column_names('test'))
+        self.assertTrue(myNonsenseDB(database=unit_db_name)._has_unit_vector_columns())
+
+        myNonsense = myNonsenseDB(database=db_name)
+
+        mycolumns = ['NonsenseId', 'NonsenseRaJ2000', 'NonsenseDecJ2000', 'NonsenseMag']
+        for raCenter, decCenter, radius in ((210.0, -60.0, 20.0), (100.0, 70.0, 10.0), (200.0, 0.0, 30.0)):
+            circObsMd = ObservationMetaData(boundType='circle', pointingRA=raCenter, pointingDec=decCenter,
+                                            boundLength=radius, mjd=52000., bandpassName='r')
+            self.assertIsNone(myNonsense._unit_vector_SQL(circObsMd.bounds))
+            self.assertIsNotNone(unitNonsense._unit_vector_SQL(circObsMd.bounds))
+            # with unit vector columns, the circle is tested by the database
+            # rather than on the rows in the box around it
+            self.assertIsNotNone(myNonsense.query_columns(colnames=mycolumns, obs_metadata=circObsMd,
+                                                          chunk_size=100).bounds)
+            self.assertIsNone(unitNonsense.query_columns(colnames=mycolumns, obs_metadata=circObsMd,
+                                                         chunk_size=100).bounds)
+
+            control = np.concatenate(list(myNonsense.query_columns(colnames=mycolumns,
+                                                                   obs_metadata=circObsMd,
+                                                                   chunk_size=100)))
+            test = np.concatenate(list(unitNonsense.query_columns(colnames=mycolumns,
+                                                                  obs_metadata=circObsMd,
+                                                                  chunk_size=100)))
+            self.assertGreater(len(test), 0)
+            np.testing.assert_array_equal(np.sort(test['NonsenseId']), np.sort(control['NonsenseId']))
+
+            distance = haversine(np.radians(raCenter), np.radians(decCenter),
+                                 test['NonsenseRaJ2000'], test['NonsenseDecJ2000'])
+            self.assertLessEqual(distance.max(), np.radians(radius))
+
+        boxObsMd = ObservationMetaData(boundType='box', pointingRA=210.0, pointingDec=-60.0,
+                                       boundLength=np.array([10.0, 5.0]), mjd=52000., bandpassName='r')
+        self.assertIsNone(unitNonsense._unit_vector_SQL(boxObsMd.bounds))
+
+    def testBoundingBoxPrefilter(self):
+        """
+        Test that testing circle bounds on the rows returned by the box
+        around them selects the objects within the circle (including
+        circles crossing RA = 0 or containing a pole), and the same
+        objects as testing them in SQL
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectNonsenseDB.db')
+        myNonsense = myNonsenseDB(database=db_name)
+
+        mycolumns = ['NonsenseId', 'NonsenseRaJ2000', 'NonsenseDecJ2000', 'NonsenseMag']
+        for raCenter, decCenter, radius in ((210.0, -60.0, 20.0), (5.0, 10.0, 20.0),
+                                            (100.0, 80.0, 15.0), (350.0, -75.0, 30.0)):
+            circObsMd = ObservationMetaData(boundType='circle', pointingRA=raCenter, pointingDec=decCenter,
+                                            boundLength=radius, mjd=52000., bandpassName='r')
+            self.assertIsNotNone(myNonsense._bounding_box_SQL(circObsMd.bounds))
+
+            distance = haversine(np.radians(raCenter), np.radians(decCenter),
+                                 np.radians(self.baselineData['ra']), np.radians(self.baselineData['dec']))
+            control = np.sort(self.baselineData['id'][distance < np.radians(radius)])
+            self.assertGreater(len(control), 0)
+
+            chunks = list(myNonsense.query_columns(colnames=mycolumns, obs_metadata=circObsMd,
+                                                   chunk_size=100))
+            for chunk in chunks[:-1]:
+                self.assertEqual(len(chunk), 100)
+            test = np.concatenate(chunks)
+            self.assertEqual(test.dtype.names, tuple(mycolumns))
+            np.testing.assert_array_equal(np.sort(test['NonsenseId']), control)
+
+            test = next(myNonsense.query_columns(colnames=mycolumns, obs_metadata=circObsMd))
+            np.testing.assert_array_equal(np.sort(test['NonsenseId']), control)
+
+            test = next(myNonsense.query_columns(colnames=mycolumns, obs_metadata=circObsMd, limit=10))
+            self.assertEqual(len(test), min(10, len(control)))
+            self.assertLessEqual(set(test['NonsenseId']), set(control))
+
+        # away from RA = 0 and the poles, the SQL of the bounds selects the same objects
+        circObsMd = ObservationMetaData(boundType='circle', pointingRA=210.0, pointingDec=-60.0,
+                                        boundLength=20.0, mjd=52000., bandpassName='r')
+        query = myNonsense._get_filtered_query(mycolumns, obs_metadata=circObsMd, exact=True)
+        exact = myNonsense._postprocess_results(query.all())
+        test = next(myNonsense.query_columns(colnames=mycolumns, obs_metadata=circObsMd))
+        self.assertEqual(test.dtype, exact.dtype)
+        np.testing.assert_array_equal(np.sort(test['NonsenseId']), np.sort(exact['NonsenseId']))
+
+        boxObsMd = ObservationMetaData(boundType='box', pointingRA=210.0, pointingDec=-60.0,
+                                       boundLength=np.array([10.0, 5.0]), mjd=52000., bandpassName='r')
+        self.assertIsNone(myNonsense._bounding_box_SQL(boxObsMd.bounds))
+
+    def testMultiPointingQuery(self):
+        """
+        Test that query_columns_multi returns, for each pointing, the
+        objects within its bounds
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectNonsenseDB.db')
+        myNonsense = myNonsenseDB(database=db_name)
+
+        mycolumns = ['NonsenseId', 'NonsenseRaJ2000', 'NonsenseDecJ2000', 'NonsenseMag']
+        obsList = [ObservationMetaData(boundType='circle', pointingRA=raCenter, pointingDec=decCenter,
+                                       boundLength=radius, mjd=52000., bandpassName='r')
+                   for raCenter, decCenter, radius in ((210.0, -60.0, 20.0), (220.0, -55.0, 20.0),
+                                                       (5.0, 10.0, 20.0), (100.0, 80.0, 15.0))]
+        obsList.append(ObservationMetaData(boundType='box', pointingRA=100.0, pointingDec=5.0,
+                                           boundLength=np.array([50.0, 25.0]),
+                                           mjd=52000., bandpassName='r'))
+
+        masks = []
+        for obs in obsList[:-1]:
+            distance = haversine(obs.bounds.RA, obs.bounds.DEC,
+                                 np.radians(self.baselineData['ra']), np.radians(self.baselineData['dec']))
+            masks.append(distance < obs.bounds.radius)
+        masks.append((self.baselineData['ra'] >= 50.0) & (self.baselineData['ra'] <= 150.0) &
+                     (self.baselineData['dec'] >= -20.0) & (self.baselineData['dec'] <= 30.0))
+        # the first two pointings overlap
+        self.assertGreater((masks[0] & masks[1]).sum(), 0)
+
+        for chunk_size in (None, 100):
+            results = [[] for obs in obsList]
+            for i_obs, chunk in myNonsense.query_columns_multi(obsList, colnames=mycolumns,
+                                                               chunk_size=chunk_size):
+                self.assertEqual(chunk.dtype.names, tuple(mycolumns))
+                self.assertGreater(len(chunk), 0)
+                if chunk_size is not None:
+                    self.assertLessEqual(len(chunk), chunk_size)
+                results[i_obs].append(chunk)
+
+            for i_obs, mask in enumerate(masks):
+                self.assertGreater(mask.sum(), 0)
+                test = np.concatenate(results[i_obs])
+                np.testing.assert_array_equal(np.sort(test['NonsenseId']),
+                                              np.sort(self.baselineData['id'][mask]))
+
+        magCut = np.median(self.baselineData['mag'])
+        results = [[] for obs in obsList[:2]]
+        for i_obs, chunk in myNonsense.query_columns_multi(obsList[:2], colnames=['NonsenseId'],
+                                                           constraint='mag > %.17g' % magCut,
+                                                           chunk_size=50, prefetch=2):
+            results[i_obs].append(chunk)
+        for i_obs, mask in enumerate(masks[:2]):
+            test = np.concatenate(results[i_obs])
+            control = self.baselineData['id'][mask & (self.baselineData['mag'] > magCut)]
+            self.assertGreater(len(control), 0)
+            np.testing.assert_array_equal(np.sort(test['NonsenseId']), np.sort(control))
+
+        self.assertRaises(ValueError, myNonsense.query_columns_multi, [])
+
     def testNonsenseSelectOnlySomeColumns(self):
         """
         Test a query performed only a subset of the available columns
@@ -471,6 +656,173 @@ class CatalogDBObjectTestCase(unittest.TestCase):
                 self.assertEqual(len(row), 5)
         self.assertGreater(ct, 0)
 
+    def testStreamingChunks(self):
+        """
+        Test that a chunked query streams its results and returns the same
+        rows as an un-chunked (buffered) query
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectDatabase.db')
+        mystars = testCatalogDBObjectTestStars(database=db_name)
+        mycolumns = ['id', 'raJ2000', 'decJ2000', 'umag', 'gmag']
+
+        buffered = mystars.query_columns(colnames=mycolumns)
+        self.assertFalse(buffered.stream_results)
+        control = next(buffered)
+
+        streamed = mystars.query_columns(colnames=mycolumns, chunk_size=333)
+        self.assertTrue(streamed.stream_results)
+        chunk_list = list(streamed)
+        for chunk in chunk_list[:-1]:
+            self.assertEqual(len(chunk), 333)
+
+        self.assertEqual(sum(len(chunk) for chunk in chunk_list), len(control))
+        for name in control.dtype.names:
+            test = np.concatenate([chunk[name] for chunk in chunk_list])
+            self.assertEqual(test.dtype, control[name].dtype)
+            np.testing.assert_array_equal(test, control[name])
+
+    def testPrefetchChunks(self):
+        """
+        Test that prefetching chunks in a background thread returns the same
+        chunks as a synchronous query, propagates exceptions, and shuts down
+        cleanly when the consumer stops early
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectDatabase.db')
+        mystars = testCatalogDBObjectTestStars(database=db_name)
+        mycolumns = ['id', 'raJ2000', 'decJ2000', 'umag', 'gmag']
+
+        control = list(mystars.query_columns(colnames=mycolumns, chunk_size=500))
+        prefetched = mystars.query_columns(colnames=mycolumns, chunk_size=500, prefetch=2)
+        test = list(prefetched)
+        self.assertEqual(len(test), len(control))
+        for test_chunk, control_chunk in zip(test, control):
+            self.assertEqual(test_chunk.dtype, control_chunk.dtype)
+            np.testing.assert_array_equal(test_chunk, control_chunk)
+        self.assertRaises(StopIteration, next, prefetched)
+
+        # stop after the first chunk
+        prefetched = mystars.query_columns(colnames=mycolumns, chunk_size=100, prefetch=3)
+        chunk = next(prefetched)
+        self.assertEqual(len(chunk), 100)
+        prefetched.close()
+        self.assertFalse(prefetched._worker.is_alive())
+        self.assertRaises(StopIteration, next, prefetched)
+
+        # errors in the background thread should surface in the consumer
+        bad_query = mystars.query_columns(colnames=mycolumns, chunk_size=100, prefetch=2,
+                                          constraint='not_a_column > 3')
+        self.assertRaises(Exception, next, bad_query)
+
+        self.assertRaises(ValueError, mystars.query_columns, colnames=mycolumns,
+                          chunk_size=100, prefetch=0)
+
+    def testQueryStats(self):
+        """
+        Test that a QueryStats passed to query_columns records the SQL,
+        query plan and per-chunk timings of the query, with and without prefetch
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectDatabase.db')
+        mystars = testCatalogDBObjectTestStars(database=db_name)
+        mycolumns = ['id', 'raJ2000', 'decJ2000', 'umag', 'gmag']
+
+        control = list(mystars.query_columns(colnames=mycolumns, chunk_size=500))
+        for prefetch in (None, 2):
+            reported = []
+            stats = QueryStats(explain=True, callback=reported.append)
+            query = mystars.query_columns(colnames=mycolumns, chunk_size=500, prefetch=prefetch,
+                                          stats=stats)
+            self.assertIs(query.stats, stats)
+            test = list(query)
+            self.assertEqual(len(test), len(control))
+            for test_chunk, control_chunk in zip(test, control):
+                np.testing.assert_array_equal(test_chunk, control_chunk)
+
+            self.assertIn('FROM', stats.sql.upper())
+            self.assertGreater(len(stats.query_plan), 0)
+            self.assertGreaterEqual(stats.execute_time, 0.0)
+            self.assertEqual(len(stats.chunks), len(control))
+            self.assertEqual(reported, stats.chunks)
+            self.assertEqual(stats.n_rows, sum([len(chunk) for chunk in control]))
+            self.assertEqual(stats.nbytes, sum([chunk.nbytes for chunk in control]))
+            for chunk_stats, chunk in zip(stats.chunks, control):
+                self.assertEqual(chunk_stats.n_rows, len(chunk))
+                self.assertGreaterEqual(chunk_stats.fetch_time, 0.0)
+                self.assertGreaterEqual(chunk_stats.convert_time, 0.0)
+                self.assertGreaterEqual(chunk_stats.final_pass_time, 0.0)
+            self.assertIn('%d rows' % stats.n_rows, str(stats))
+
+        stats = QueryStats()
+        test = next(mystars.query_columns(colnames=mycolumns, stats=stats))
+        self.assertIsNone(stats.query_plan)
+        self.assertEqual(len(stats.chunks), 1)
+        self.assertEqual(stats.n_rows, len(test))
+
+        self.assertRaises(ValueError, mystars.query_columns, colnames=mycolumns,
+                          chunk_size=100, keyset=True, stats=QueryStats())
+
+    def testChunkBytes(self):
+        """
+        Test that a query with a specified chunk_bytes returns chunks
+        that fit in that memory budget
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectDatabase.db')
+        mystars = testCatalogDBObjectTestStars(database=db_name)
+        mycolumns = ['id', 'raJ2000', 'decJ2000', 'umag', 'gmag']
+
+        control = next(mystars.query_columns(colnames=mycolumns))
+        row_bytes = control.dtype.itemsize
+
+        myquery = mystars.query_columns(colnames=mycolumns, chunk_bytes=250*row_bytes)
+        self.assertEqual(myquery.chunk_size, 250)
+        chunk_list = list(myquery)
+        for chunk in chunk_list[:-1]:
+            self.assertEqual(len(chunk), 250)
+        self.assertEqual(sum(len(chunk) for chunk in chunk_list), len(control))
+        np.testing.assert_array_equal(np.concatenate(chunk_list), control)
+
+        # the consumer reporting its own memory use per row should shrink the chunks
+        myquery = mystars.query_columns(colnames=mycolumns, chunk_bytes='%dkB' % row_bytes)
+        chunk = next(myquery)
+        self.assertEqual(len(chunk), 1024)
+        myquery.set_row_overhead(row_bytes)
+        chunk = next(myquery)
+        self.assertEqual(len(chunk), 512)
+        self.assertLessEqual(chunk.nbytes + len(chunk)*row_bytes, 1024*row_bytes)
+        myquery.close()
+
+        self.assertRaises(ValueError, mystars.query_columns, colnames=mycolumns,
+                          chunk_size=100, chunk_bytes='1MB')
+        self.assertRaises(ValueError, mystars.query_columns, colnames=mycolumns,
+                          chunk_bytes='lots')
+
+    def testPartitionedChunks(self):
+        """
+        Test that a query partitioned on the id column returns the same rows
+        as an ordinary query, in order or not
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectDatabase.db')
+        mystars = testCatalogDBObjectTestStars(database=db_name)
+        mycolumns = ['id', 'raJ2000', 'decJ2000', 'umag', 'gmag']
+
+        control = next(mystars.query_columns(colnames=mycolumns, constraint='ra > 100.0'))
+        control = np.sort(control, order='id')
+
+        for ordered in (True, False):
+            myquery = mystars.query_columns(colnames=mycolumns, constraint='ra > 100.0',
+                                            chunk_size=100, partitions=4, ordered=ordered)
+            self.assertEqual(myquery.n_partitions, 4)
+            test = np.sort(np.concatenate(list(myquery)), order='id')
+            np.testing.assert_array_equal(test, control)
+
+        limited = mystars.query_columns(colnames=mycolumns, chunk_size=100,
+                                        partitions=3, limit=250)
+        self.assertEqual(sum(len(chunk) for chunk in limited), 250)
+
+        # no rows at all
+        empty = mystars.query_columns(colnames=mycolumns, chunk_size=100,
+                                      partitions=3, constraint='ra > 1000.0')
+        self.assertEqual(list(empty), [])
+
     def testClassVariables(self):
         """
         Make sure that the daughter classes of CatalogDBObject properly overwrite the member
@@ -586,6 +938,120 @@ class CatalogDBObjectTestCase(unittest.TestCase):
 
         self.assertGreater(ct, 0)
 
+    def testConversionPlan(self):
+        """
+        Test that query_columns works out the dtype (and defaults) of its
+        results once, and that converting no rows gives an empty recarray
+        of that dtype
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectNonsenseDB.db')
+        db = dbForQueryColumnsTest(database=db_name, driver='sqlite')
+        colnames = ['i1', 'i2', 'i3']
+
+        n_calls = []
+        get_dtype = db._get_dtype
+
+        def counting_get_dtype(cols):
+            n_calls.append(cols)
+            return get_dtype(cols)
+
+        db._get_dtype = counting_get_dtype
+        results = db.query_columns(colnames, chunk_size=1)
+        plan = results.plan
+        self.assertEqual(plan.dtype.names, tuple(colnames))
+        self.assertEqual(plan.defaults, {'i2': -1, 'i3': -2})
+        chunks = list(results)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(len(n_calls), 1)
+        for chunk in chunks:
+            self.assertEqual(chunk.dtype, plan.dtype)
+        np.testing.assert_array_equal(np.concatenate(chunks)['i2'], [-1, 4, 6])
+        np.testing.assert_array_equal(np.concatenate(chunks)['i3'], [2, -2, 7])
+
+        empty = db._convert_results_to_numpy_recarray_catalogDBObj([], plan=plan)
+        self.assertIsInstance(empty, np.recarray)
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.dtype, plan.dtype)
+
+        rows = db._get_filtered_query(colnames).all()
+        np.testing.assert_array_equal(db._convert_results_to_numpy_recarray_catalogDBObj(rows, plan=plan),
+                                      db._convert_results_to_numpy_recarray_catalogDBObj(rows))
+
+    def testStringSizing(self):
+        """
+        Test that default string columns start at their declared lengths
+        (or at one character) if sizeStrings is set, are widened to fit the
+        values in each chunk, never narrow, and can be returned as bytes
+        """
+        db_name = os.path.join(self.scratch_dir, 'testCatalogDBObjectStringDB.db')
+        names = ['a', 'bb', 'cccc', 'dd', 'e\u00e9', 'f']
+        conn = sqlite3.connect(db_name)
+        conn.execute('CREATE TABLE stringSizingTest (id int, sed varchar(12), name text)')
+        conn.executemany('INSERT INTO stringSizingTest VALUES (?, ?, ?)',
+                         [(ii, 'sed_%d.txt' % ii, name) for ii, name in enumerate(names)])
+        conn.commit()
+        conn.close()
+
+        db = dbForStringSizingTest(database=db_name, driver='sqlite')
+        self.assertEqual(db.typeMap['sed'], (str, 12))
+        self.assertEqual(db.typeMap['name'], (str, 1))
+        chunks = list(db.query_columns(['id', 'sed', 'name'], chunk_size=2))
+        self.assertEqual([str(chunk.dtype['sed']) for chunk in chunks], ['<U12']*3)
+        self.assertEqual([str(chunk.dtype['name']) for chunk in chunks], ['<U2', '<U4', '<U4'])
+        self.assertEqual(list(np.concatenate(chunks)['name']), names)
+
+        # a bytes column is never returned as unicode
+        db = dbForBytesStringTest(database=db_name, driver='sqlite')
+        query = db.query_columns(['id', 'name'], chunk_size=2)
+        chunks = [next(query), next(query)]
+        self.assertEqual([str(chunk.dtype['name']) for chunk in chunks], ['|S2', '|S4'])
+        self.assertEqual(chunks[1]['name'][0], b'cccc')
+        self.assertRaises(ValueError, next, query)
+
+        db = dbForFixedStringTest(database=db_name, driver='sqlite')
+        chunk = next(db.query_columns(['id', 'sed', 'name']))
+        self.assertEqual(str(chunk.dtype['sed']), '<U256')
+        self.assertEqual(str(chunk.dtype['name']), '<U256')
+
+    def testPrecisionPolicy(self):
+        """
+        Test that compactNumerics returns numeric columns at single precision,
+        except for the id, RA and Dec columns and the precisionCriticalColumns,
+        and that columnPrecision sets the types of individual columns
+        """
+        db = compactTestGalaxies(database=self.dbo_db_name)
+        control = testCatalogDBObjectTestGalaxies(connection=db.connection)
+        cols = ['id', 'raJ2000', 'decJ2000', 'ra', 'umag', 'magNormDisk', 'redshift']
+        test_chunk = next(db.query_columns(cols))
+        control_chunk = next(control.query_columns(cols))
+        self.assertEqual([str(test_chunk.dtype[name]) for name in cols],
+                         ['int64', 'float64', 'float64', 'float64', 'float32', 'float32', 'float64'])
+        for name in ('id', 'raJ2000', 'decJ2000', 'ra', 'redshift'):
+            np.testing.assert_array_equal(test_chunk[name], control_chunk[name])
+        for name in ('umag', 'magNormDisk'):
+            np.testing.assert_allclose(test_chunk[name], control_chunk[name], rtol=1.0e-6)
+
+        mags = ['umag', 'gmag', 'rmag', 'imag', 'zmag', 'ymag']
+        # (the id column is added to the query, at full precision)
+        self.assertEqual(next(db.query_columns(mags)).dtype.itemsize, 8 + 4*len(mags))
+        self.assertEqual(next(control.query_columns(mags)).dtype.itemsize, 8 + 8*len(mags))
+
+        db = columnPrecisionTestGalaxies(connection=db.connection)
+        test_chunk = next(db.query_columns(['id', 'umag', 'gmag']))
+        self.assertEqual(str(test_chunk.dtype['id']), 'int64')
+        self.assertEqual(str(test_chunk.dtype['umag']), 'float64')
+        self.assertEqual(str(test_chunk.dtype['gmag']), 'float32')
+
+        class badPrecisionTestGalaxies(myTestGals):
+            objid = 'badPrecisionTestGalaxies'
+            columnPrecision = {'raJ2000': np.float32}
+
+        with self.assertRaises(ValueError):
+            badPrecisionTestGalaxies(connection=db.connection)
+        badPrecisionTestGalaxies.columnPrecision = {'not_a_column': np.float32}
+        with self.assertRaises(ValueError):
+            badPrecisionTestGalaxies(connection=db.connection)
+
     # The tests below all replicate tests above, except with CatalogDBObjects whose
     # connection was passed directly in from the constructor, in order to make sure
     # that passing a connection in works.
@@ -4,6 +4,7 @@ from builtins import range
 import unittest
 import numpy
 import os
+import sqlite3
 import tempfile
 import shutil
 import lsst.utils.tests
@@ -80,6 +81,21 @@ class dbClass6(CatalogDBObject):
                ('b', None)]
 
 
+class dbClassSizedStrings(CatalogDBObject):
+    objid = 'classSizedStrings'
+    idColKey = 'id'
+    tableid = 'test'
+    sizeStrings = True
+    columns = [('aa', 'a')]
+
+
+class dbClassComputedString(CatalogDBObject):
+    objid = 'classComputedString'
+    idColKey = 'id'
+    tableid = 'test'
+    columns = [('d', "'x' || d", str, 30)]
+
+
 class specificCompoundObj_otherTest(CompoundCatalogDBObject):
     _table_restriction = ['otherTest']
 
@@ -521,6 +537,40 @@ class CompoundCatalogDBObjectTestCase(unittest.TestCase):
                                                     decimal=6)
 
 
+    def testSizedStrings(self):
+        """
+        Test that the sized string columns of a CatalogDBObject (see
+        CatalogDBObject.sizeStrings) are still sized when they are copied
+        into a CompoundCatalogDBObject under prefixed names
+        """
+        db_name = os.path.join(self.baseDir, 'sizedStringsTestDB.db')
+        conn = sqlite3.connect(db_name)
+        conn.execute('CREATE TABLE test (id int, a real, d text)')
+        conn.executemany('INSERT INTO test VALUES (?, ?, ?)',
+                         [(ix, self.controlArray['a'][ix], self.controlArray['d'][ix])
+                          for ix in range(len(self.controlArray))])
+        conn.commit()
+        conn.close()
+
+        class testDbClass22(dbClassSizedStrings):
+            database = db_name
+            driver = 'sqlite'
+
+        class testDbClass23(dbClassComputedString):
+            database = db_name
+            driver = 'sqlite'
+
+        compoundDb = CompoundCatalogDBObject([testDbClass22, testDbClass23])
+        sized_name = compoundDb.name_map('%s_d' % testDbClass22.objid)
+        computed_name = compoundDb.name_map('%s_d' % testDbClass23.objid)
+        self.assertNotEqual(sized_name, computed_name)
+
+        chunk = next(compoundDb.query_columns(colnames=[sized_name, computed_name]))
+        numpy.testing.assert_array_equal(chunk[sized_name], self.controlArray['d'])
+        numpy.testing.assert_array_equal(chunk[computed_name],
+                                         ['x' + dd for dd in self.controlArray['d']])
+
+
 class testStarDB1(CatalogDBObject):
     tableid = 'test'
     raColName = 'ra'
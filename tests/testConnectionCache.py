@@ -6,10 +6,13 @@ import os
 import numpy as np
 import tempfile
 import shutil
+import threading
+import warnings
 
 import lsst.utils.tests
 from lsst.sims.utils.CodeUtilities import sims_clean_up
 from lsst.sims.catalogs.db import CatalogDBObject, DBObject
+from lsst.sims.catalogs.db.dbConnection import DBConnection, _ConnectionRegistry
 
 ROOT = os.path.abspath(os.path.dirname(__file__))
 
@@ -117,6 +120,163 @@ class CachingTestCase(unittest.TestCase):
         np.testing.assert_array_equal(results['i1'], results['other'])
         np.testing.assert_array_equal(results['id']*(-1), results['i2'])
 
+    def test_registry_threads_and_lru(self):
+        """
+        Test that threads asking for the same database get the same connection,
+        and that the least recently used connections are pushed out of the cache
+        """
+        registry = _ConnectionRegistry(max_size=2)
+
+        connections = []
+
+        def get_connection():
+            connections.append(registry.get_connection(self.db_name, 'sqlite', None, None))
+
+        threads = [threading.Thread(target=get_connection) for ii in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(connections), 8)
+        self.assertEqual(len(set([id(conn) for conn in connections])), 1)
+        self.assertEqual(len(registry), 1)
+
+        other_names = []
+        for ii in range(2):
+            other_names.append(os.path.join(self.scratch_dir, 'other_db_%d.db' % ii))
+        evicted = registry.get_connection(other_names[0], 'sqlite', None, None)
+        evicted_pool = evicted.engine.pool
+        evicted_session = evicted.session()
+        # touch the first database, so that other_names[0] is the least recently used
+        self.assertIs(registry.get_connection(self.db_name, 'sqlite', None, None), connections[0])
+        registry.get_connection(other_names[1], 'sqlite', None, None)
+        self.assertEqual(len(registry), 2)
+        self.assertIn(_ConnectionRegistry.make_key('sqlite', None, None, self.db_name), registry)
+        self.assertNotIn(_ConnectionRegistry.make_key('sqlite', None, None, other_names[0]), registry)
+
+        # the engine of the connection pushed out is disposed of, but this
+        # thread's session is left to whoever is using it
+        self.assertIsNot(evicted.engine.pool, evicted_pool)
+        self.assertIs(evicted.session(), evicted_session)
+
+        # the pool settings of sqlite databases are ignored, so they do not
+        # make another connection; for other dialects they do
+        self.assertEqual(_ConnectionRegistry.make_key('sqlite', None, None, self.db_name,
+                                                      pool_size=4, max_overflow=2),
+                         _ConnectionRegistry.make_key('sqlite', None, None, self.db_name))
+        self.assertNotEqual(_ConnectionRegistry.make_key('postgresql', 'host', 5432, 'db',
+                                                         pool_size=4, max_overflow=2),
+                            _ConnectionRegistry.make_key('postgresql', 'host', 5432, 'db'))
+
+        # a connection pushed out of the registry is still usable
+        dbobj = DBObject(connection=connections[0])
+        self.assertEqual(len(dbobj.execute_arbitrary('SELECT id FROM test')), 5)
+
+    def test_pool_kwargs_sqlite(self):
+        """
+        Test that pool_size and max_overflow are ignored, with a warning,
+        for a sqlite database (whose pool is not a QueuePool)
+        """
+        class PoolDbClass(CatalogDBObject):
+            database = self.db_name
+            driver = 'sqlite'
+            tableid = 'test'
+            idColKey = 'id'
+            objid = 'test_db_class_pool'
+            skipRegistration = True
+            pool_size = 4
+            max_overflow = 2
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            conn = DBConnection(database=self.db_name, driver='sqlite', pool_size=4, max_overflow=2)
+            dbobj = PoolDbClass(connection=conn)
+        self.assertTrue(any('pool_size' in str(ww.message) and 'NullPool' in str(ww.message)
+                            for ww in caught))
+        self.assertEqual(conn.pool_size, 4)
+        self.assertEqual(len(next(dbobj.query_columns(colnames=['id', 'i1']))), 5)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            conn = DBConnection(database=self.db_name, driver='sqlite')
+        self.assertEqual(len(caught), 0)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "os.fork is not available")
+    def test_fork(self):
+        """
+        Test that a forked child process does not reuse the database connections
+        opened by its parent
+        """
+        conn = DBConnection(database=self.db_name, driver='sqlite')
+        dbobj = DBObject(connection=conn)
+        self.assertEqual(len(dbobj.execute_arbitrary('SELECT id FROM test')), 5)
+        parent_engine_pool = conn.engine.pool
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                results = dbobj.execute_arbitrary('SELECT id FROM test')
+                if len(results) == 5 and conn.engine.pool is not parent_engine_pool:
+                    status = 0
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertIs(conn.engine.pool, parent_engine_pool)
+        self.assertEqual(len(dbobj.execute_arbitrary('SELECT id FROM test')), 5)
+
+    def test_sqlite_profile(self):
+        """
+        Test that a sqlite_profile sets its PRAGMAs on the connection, and
+        that connections with different profiles are not shared
+        """
+        db_name = os.path.join(self.scratch_dir, 'sqlite_profile_test_db.db')
+        shutil.copyfile(self.db_name, db_name)
+
+        file_stats = os.stat(db_name)
+        dbobj = DBObject(database=db_name, driver='sqlite', sqlite_profile='read')
+        self.assertEqual(dbobj.execute_arbitrary('PRAGMA journal_mode')[0][0], 'delete')
+        self.assertEqual(dbobj.execute_arbitrary('PRAGMA query_only')[0][0], 1)
+        self.assertEqual(dbobj.execute_arbitrary('PRAGMA cache_size')[0][0], -262144)
+        self.assertEqual(dbobj.execute_arbitrary('PRAGMA temp_store')[0][0], 2)
+        self.assertEqual(len(dbobj.execute_arbitrary('SELECT id FROM test')), 5)
+        with self.assertRaises(Exception):
+            dbobj.connection.session.execute('CREATE TABLE other (id int)')
+        # the 'read' profile leaves the database file alone
+        self.assertEqual(os.stat(db_name).st_mtime, file_stats.st_mtime)
+        self.assertEqual(os.stat(db_name).st_size, file_stats.st_size)
+        self.assertFalse(os.path.exists(db_name + '-wal'))
+
+        dbobj = DBObject(database=db_name, driver='sqlite', sqlite_profile='read_wal')
+        self.assertEqual(dbobj.execute_arbitrary('PRAGMA journal_mode')[0][0], 'wal')
+        self.assertEqual(dbobj.execute_arbitrary('PRAGMA query_only')[0][0], 1)
+        self.assertEqual(len(dbobj.execute_arbitrary('SELECT id FROM test')), 5)
+
+        dbobj = DBObject(database=db_name, driver='sqlite', sqlite_profile={'cache_size': -1000})
+        self.assertEqual(dbobj.execute_arbitrary('PRAGMA cache_size')[0][0], -1000)
+        self.assertEqual(dbobj.execute_arbitrary('PRAGMA query_only')[0][0], 0)
+
+        with self.assertRaises(ValueError):
+            DBObject(database=db_name, driver='sqlite', sqlite_profile='nonsense')
+        with self.assertRaises(ValueError):
+            DBObject(database=db_name, driver='sqlite', sqlite_profile={'cache_size': '1; DROP TABLE test'})
+
+        class ProfileDbClass(CatalogDBObject):
+            database = db_name
+            driver = 'sqlite'
+            tableid = 'test'
+            idColKey = 'id'
+            objid = 'test_db_class_profile'
+            skipRegistration = True
+
+        plain = ProfileDbClass()
+        read_only = ProfileDbClass(sqlite_profile='read')
+        self.assertIsNot(plain.connection, read_only.connection)
+        self.assertIs(ProfileDbClass(sqlite_profile='read').connection, read_only.connection)
+        self.assertEqual(len(next(read_only.query_columns(colnames=['id', 'i1']))), 5)
+
 
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
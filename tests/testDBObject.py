@@ -180,6 +180,43 @@ class DBObjectTestCase(unittest.TestCase):
         self.assertIn('twice', names['intTable'])
         self.assertIn('thrice', names['intTable'])
 
+    def testCachedSchema(self):
+        """
+        Test that the names read in bulk match those read table by table,
+        and that table and column names are cached until refresh_schema()
+        """
+        db_name = os.path.join(self.scratch_dir, 'testDBObject_schema_DB.db')
+        if os.path.exists(db_name):
+            os.unlink(db_name)
+        conn = sqlite3.connect(db_name)
+        c = conn.cursor()
+        c.execute('''CREATE TABLE aTable (id int, a float, b float)''')
+        c.execute('''CREATE TABLE bTable (id int, c text)''')
+        c.execute('''CREATE VIEW abView AS SELECT aTable.id, a, c FROM aTable, bTable WHERE aTable.id=bTable.id''')
+        conn.commit()
+
+        dbobj = DBObject(driver=self.driver, database=db_name)
+        bulk_names = dbobj.get_column_names()
+        dbobj.connection.refresh_schema()
+        self.assertIsNotNone(dbobj.connection._get_bulk_column_names())
+        self.assertEqual(bulk_names, dbobj.get_column_names(bulk=False))
+        self.assertEqual(bulk_names, {'aTable': ['id', 'a', 'b'], 'bTable': ['id', 'c'],
+                                      'abView': ['id', 'a', 'c']})
+
+        c.execute('''CREATE TABLE cTable (id int)''')
+        c.execute('''ALTER TABLE aTable ADD COLUMN d float''')
+        conn.commit()
+        conn.close()
+        self.assertEqual(sorted(dbobj.get_table_names()), ['aTable', 'abView', 'bTable'])
+        self.assertEqual(dbobj.get_column_names('aTable'), ['id', 'a', 'b'])
+
+        dbobj.connection.refresh_schema()
+        self.assertEqual(sorted(dbobj.get_table_names()), ['aTable', 'abView', 'bTable', 'cTable'])
+        self.assertEqual(dbobj.get_column_names('aTable'), ['id', 'a', 'b', 'd'])
+
+        if os.path.exists(db_name):
+            os.unlink(db_name)
+
     def testSingleTableQuery(self):
         """
         Test a query on a single table (using chunk iterator)
@@ -435,6 +472,49 @@ class DBObjectTestCase(unittest.TestCase):
         if os.path.exists(db_name):
             os.unlink(db_name)
 
+    def testDtypeFromValueTypes(self):
+        """
+        Test that DBObject infers dtypes from the types of the values returned,
+        so that strings of digits stay strings and NULLs do not break detection,
+        and that the inferred dtype is cached per query
+        """
+        db_name = os.path.join(self.scratch_dir, 'testDBObject_value_types_DB.db')
+        if os.path.exists(db_name):
+            os.unlink(db_name)
+
+        conn = sqlite3.connect(db_name)
+        c = conn.cursor()
+        c.execute('''CREATE TABLE testTable (id int, code text, mag float, flux float)''')
+        for ii in range(10):
+            c.execute('''INSERT INTO testTable VALUES (?, ?, ?, ?)''',
+                      (ii, '%05d' % (ii*11), None if ii % 3 == 0 else 0.5*ii, None))
+        conn.commit()
+        conn.close()
+
+        db = DBObject(database=db_name, driver='sqlite')
+        query = 'SELECT id, code, mag, flux FROM testTable'
+        results = db.execute_arbitrary(query)
+        self.assertEqual(str(results.dtype['id']), 'int64')
+        self.assertEqual(results.dtype['code'].kind, 'U')
+        self.assertEqual(str(results.dtype['mag']), 'float64')
+        self.assertEqual(str(results.dtype['flux']), 'float64')
+        self.assertEqual(list(results['code']), ['%05d' % (ii*11) for ii in range(10)])
+        self.assertTrue(np.isnan(results['mag'][0]))
+        self.assertTrue(np.isnan(results['flux']).all())
+
+        # the same query (up to whitespace) is served from the cache of dtypes
+        self.assertEqual(list(db._dtype_cache.values()), [results.dtype])
+        cached_dtype = db._dtype_cache['SELECT id, code, mag, flux FROM testTable']
+        chunk_list = list(db.get_chunk_iterator('SELECT id, code,\n mag, flux  FROM testTable',
+                                                chunk_size=4))
+        self.assertEqual(len(db._dtype_cache), 1)
+        for chunk in chunk_list:
+            self.assertEqual(chunk.dtype, cached_dtype)
+        np.testing.assert_array_equal(np.concatenate(chunk_list)['code'], results['code'])
+
+        if os.path.exists(db_name):
+            os.unlink(db_name)
+
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
 
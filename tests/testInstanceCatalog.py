@@ -16,11 +16,17 @@ import shutil
 import lsst.utils.tests
 from lsst.sims.utils.CodeUtilities import sims_clean_up
 from lsst.sims.utils import ObservationMetaData
-from lsst.sims.catalogs.db import CatalogDBObject
+from lsst.sims.catalogs.db import CatalogDBObject, get_vocabulary, decode_categorical
 from lsst.sims.catalogs.utils import myTestStars, makeStarTestDB
 from lsst.sims.catalogs.definitions import InstanceCatalog
 from lsst.sims.utils import Site
 
+try:
+    import pyarrow
+    _has_pyarrow = True
+except ImportError:
+    _has_pyarrow = False
+
 ROOT = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -120,6 +126,11 @@ class myCannotBeNullDBObject(CatalogDBObject):
     columns = [('n5', 'n5', str, 40)]
 
 
+class myCategoricalCannotBeNullDBObject(myCannotBeNullDBObject):
+    objid = 'categoricalCannotBeNull'
+    categoricalColumns = ('n4', 'n5')
+
+
 class floatCannotBeNullCatalog(InstanceCatalog):
     """
     This catalog class will not write rows with a null value in the n2 column
@@ -334,6 +345,54 @@ class InstanceCatalogMetaDataTest(unittest.TestCase):
             for col in columns:
                 self.assertIn(col, cat._actually_calculated_columns)
 
+    def testCheckpoint(self):
+        """
+        Test that a catalog written with a checkpoint_file can be resumed
+        after being interrupted, and that the result is the same as the
+        catalog written in one go
+        """
+        class interruptedCatalogClass(testStellarCatalogClass):
+            n_chunks_to_write = None
+
+            def _write_recarray(self, chunk, file_handle):
+                if self.n_chunks_to_write is not None:
+                    if self.n_chunks_to_write == 0:
+                        raise RuntimeError("interrupted")
+                    self.n_chunks_to_write -= 1
+                testStellarCatalogClass._write_recarray(self, chunk, file_handle)
+
+        control_name = os.path.join(self.scratch_dir, 'checkpoint_control_cat.txt')
+        cat_name = os.path.join(self.scratch_dir, 'checkpoint_cat.txt')
+        checkpoint_name = os.path.join(self.scratch_dir, 'checkpoint.json')
+
+        control_cat = testStellarCatalogClass(self.myDB)
+        control_cat.write_catalog(control_name, chunk_size=100)
+
+        cat = interruptedCatalogClass(self.myDB)
+        cat.n_chunks_to_write = 3
+        with self.assertRaises(RuntimeError):
+            cat.write_catalog(cat_name, chunk_size=100, checkpoint_file=checkpoint_name)
+        self.assertTrue(os.path.exists(checkpoint_name))
+
+        # leave a partially written chunk at the end of the file
+        with open(cat_name, 'a') as output_file:
+            output_file.write('1.0, 2.')
+
+        cat = interruptedCatalogClass(self.myDB)
+        cat.write_catalog(cat_name, chunk_size=100, checkpoint_file=checkpoint_name)
+        self.assertFalse(os.path.exists(checkpoint_name))
+
+        with open(control_name, 'r') as input_file:
+            control_lines = input_file.readlines()
+        with open(cat_name, 'r') as input_file:
+            test_lines = input_file.readlines()
+        self.assertEqual(len(control_lines), 1001)
+        self.assertEqual(sorted(test_lines), sorted(control_lines))
+
+        for name in (control_name, cat_name):
+            if os.path.exists(name):
+                os.unlink(name)
+
 
 class InstanceCatalogCannotBeNullTest(unittest.TestCase):
 
@@ -466,6 +525,75 @@ class InstanceCatalogCannotBeNullTest(unittest.TestCase):
                 if os.path.exists(control_fileName):
                     os.unlink(control_fileName)
 
+        def testCategoricalColumns(self):
+            """
+            Test that catalogs written from dictionary-encoded string columns
+            are identical to those written from the strings themselves
+            """
+            availableCatalogs = [floatCannotBeNullCatalog, strCannotBeNullCatalog, unicodeCannotBeNullCatalog,
+                                 severalCannotBeNullCatalog, CanBeNullCatalog]
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+            categorical_dbobj = CatalogDBObject.from_objid('categoricalCannotBeNull')
+
+            chunk = next(categorical_dbobj.query_columns(['id', 'n4', 'n5']))
+            self.assertEqual(chunk['n4'].dtype, np.int32)
+            self.assertEqual(sorted(get_vocabulary(chunk['n4'])), ['None', 'word'])
+            np.testing.assert_array_equal(decode_categorical(chunk['n4']), self.baselineOutput['n4'])
+            np.testing.assert_array_equal(decode_categorical(chunk['n5'][::2]), self.baselineOutput['n5'][::2])
+
+            for catClass in availableCatalogs:
+                for pre_screen in (False, True):
+                    control_cat = catClass(dbobj)
+                    control_cat._pre_screen = pre_screen
+                    cat = catClass(categorical_dbobj)
+                    cat._pre_screen = pre_screen
+                    fileName = os.path.join(self.scratch_dir, 'categoricalTestFile.txt')
+                    control_fileName = os.path.join(self.scratch_dir, 'categoricalTestFile_control.txt')
+                    cat.write_catalog(fileName, chunk_size=7)
+                    control_cat.write_catalog(control_fileName, chunk_size=7)
+
+                    with open(fileName, 'r') as test_file:
+                        with open(control_fileName, 'r') as control_file:
+                            self.assertEqual(test_file.readlines(), control_file.readlines())
+
+                    # (compared as strings, since NaN != NaN)
+                    self.assertEqual([str(line) for line in cat.iter_catalog(chunk_size=7)],
+                                     [str(line) for line in control_cat.iter_catalog(chunk_size=7)])
+
+        @unittest.skipIf(not _has_pyarrow, "pyarrow is not installed")
+        def testArrowOutput(self):
+            """
+            Test that catalogs written from pyarrow RecordBatches (query_output = 'arrow')
+            are identical to those written from recarrays
+            """
+            availableCatalogs = [floatCannotBeNullCatalog, strCannotBeNullCatalog, unicodeCannotBeNullCatalog,
+                                 severalCannotBeNullCatalog, CanBeNullCatalog]
+
+            for objid in ('cannotBeNull', 'categoricalCannotBeNull'):
+                dbobj = CatalogDBObject.from_objid(objid)
+                for catClass in availableCatalogs:
+                    for pre_screen in (False, True):
+                        control_cat = catClass(dbobj)
+                        control_cat._pre_screen = pre_screen
+                        cat = catClass(dbobj)
+                        cat._pre_screen = pre_screen
+                        cat.query_output = 'arrow'
+                        fileName = os.path.join(self.scratch_dir, 'arrowTestFile.txt')
+                        control_fileName = os.path.join(self.scratch_dir, 'arrowTestFile_control.txt')
+                        cat.write_catalog(fileName, chunk_size=7)
+                        control_cat.write_catalog(control_fileName, chunk_size=7)
+
+                        with open(fileName, 'r') as test_file:
+                            with open(control_fileName, 'r') as control_file:
+                                self.assertEqual(test_file.readlines(), control_file.readlines())
+
+                        # (compared as strings, since NaN != NaN; the strings
+                        # from Arrow are python strings rather than numpy.str_)
+                        self.assertEqual([[str(value) for value in line]
+                                          for line in cat.iter_catalog(chunk_size=7)],
+                                         [[str(value) for value in line]
+                                          for line in control_cat.iter_catalog(chunk_size=7)])
+
         def testCanBeNull(self):
             """
             Test to make sure that we can still write all rows to catalogs,
@@ -0,0 +1,270 @@
+from __future__ import with_statement
+import os
+import unittest
+import numpy as np
+import tempfile
+import shutil
+import lsst.utils.tests
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.utils import ObservationMetaData
+from lsst.sims.catalogs.db import QueryCache, CachedChunkIterator
+from lsst.sims.catalogs.utils.testUtils import myTestStars, makeStarTestDB
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class queryCacheTestStars(myTestStars):
+    objid = 'queryCacheTestStars'
+    driver = 'sqlite'
+
+
+class QueryCacheTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='QueryCacheTestCase-')
+        cls.db_name = os.path.join(cls.scratch_dir, 'queryCacheTestDatabase.db')
+        makeStarTestDB(filename=cls.db_name, size=2000, seedVal=11)
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(dir=self.scratch_dir, prefix='cache-')
+        self.colnames = ['id', 'raJ2000', 'decJ2000', 'umag']
+        self.control = next(queryCacheTestStars(database=self.db_name).query_columns(colnames=self.colnames))
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def testCacheHit(self):
+        """
+        Test that a query is read back from the cache once it has been
+        iterated over, re-chunked to the requested chunk_size
+        """
+        dbobj = queryCacheTestStars(database=self.db_name)
+        dbobj.query_cache = QueryCache(self.cache_dir)
+
+        first = list(dbobj.query_columns(colnames=self.colnames, chunk_size=300))
+        self.assertGreater(dbobj.query_cache.nbytes, 0)
+
+        cached = dbobj.query_columns(colnames=self.colnames, chunk_size=700)
+        self.assertIsInstance(cached, CachedChunkIterator)
+        chunk_list = list(cached)
+        self.assertEqual([len(chunk) for chunk in chunk_list], [700, 700, 600])
+        for chunk in chunk_list:
+            self.assertIsInstance(chunk, np.recarray)
+        np.testing.assert_array_equal(np.concatenate(chunk_list), self.control)
+        np.testing.assert_array_equal(np.concatenate(first), self.control)
+
+        # a different constraint is a different result
+        constrained = dbobj.query_columns(colnames=self.colnames, constraint='ra < 100.0')
+        self.assertNotIsInstance(constrained, CachedChunkIterator)
+
+    def testIncompleteQueryNotCached(self):
+        """
+        Test that a query which is abandoned before all of its rows are
+        returned is not cached
+        """
+        dbobj = queryCacheTestStars(database=self.db_name)
+        dbobj.query_cache = QueryCache(self.cache_dir)
+
+        query = dbobj.query_columns(colnames=self.colnames, chunk_size=300)
+        next(query)
+        query.close()
+        self.assertEqual(dbobj.query_cache.nbytes, 0)
+        self.assertNotIsInstance(dbobj.query_columns(colnames=self.colnames, chunk_size=300),
+                                 CachedChunkIterator)
+
+    def testEviction(self):
+        """
+        Test that the least recently used results are evicted once the cache
+        exceeds its byte budget
+        """
+        dbobj = queryCacheTestStars(database=self.db_name)
+        row_bytes = self.control.dtype.itemsize
+        dbobj.query_cache = QueryCache(self.cache_dir, byte_budget=2500*row_bytes)
+
+        constraints = ['ra < 100.0', 'ra >= 100.0', 'ra < 200.0']
+        for constraint in constraints[:2]:
+            list(dbobj.query_columns(colnames=self.colnames, constraint=constraint, chunk_size=500))
+
+        # touch the first result, so that the second is least recently used
+        list(dbobj.query_columns(colnames=self.colnames, constraint=constraints[0], chunk_size=500))
+        list(dbobj.query_columns(colnames=self.colnames, constraint=constraints[2], chunk_size=500))
+        self.assertLessEqual(dbobj.query_cache.nbytes, 2500*row_bytes)
+
+        self.assertIsInstance(dbobj.query_columns(colnames=self.colnames, constraint=constraints[2]),
+                              CachedChunkIterator)
+        self.assertIsInstance(dbobj.query_columns(colnames=self.colnames, constraint=constraints[0]),
+                              CachedChunkIterator)
+        self.assertNotIsInstance(dbobj.query_columns(colnames=self.colnames, constraint=constraints[1]),
+                                 CachedChunkIterator)
+
+        dbobj.query_cache.clear()
+        self.assertEqual(dbobj.query_cache.nbytes, 0)
+
+    def testEvictionWhileReading(self):
+        """
+        Test that a cached result which is evicted while it is being read
+        is only deleted once it has been read
+        """
+        dbobj = queryCacheTestStars(database=self.db_name)
+        dbobj.query_cache = QueryCache(self.cache_dir)
+        list(dbobj.query_columns(colnames=self.colnames, chunk_size=300))
+
+        cached = dbobj.query_columns(colnames=self.colnames, chunk_size=100)
+        self.assertIsInstance(cached, CachedChunkIterator)
+        chunk_list = [next(cached)]
+
+        # another process sharing the cache evicts the result
+        QueryCache(self.cache_dir).clear()
+        self.assertEqual(dbobj.query_cache.nbytes, 0)
+        self.assertEqual(len([name for name in os.listdir(self.cache_dir)
+                              if name.startswith('entry-')]), 1)
+
+        chunk_list.extend(cached)
+        np.testing.assert_array_equal(np.concatenate(chunk_list), self.control)
+
+        dbobj.query_cache.clear()
+        self.assertEqual(len([name for name in os.listdir(self.cache_dir)
+                              if name.startswith('entry-')]), 0)
+
+    def testColumnSuperset(self):
+        """
+        Test that a query for a subset of the columns of a cached result
+        is served from that result
+        """
+        dbobj = queryCacheTestStars(database=self.db_name)
+        dbobj.query_cache = QueryCache(self.cache_dir, widen=False)
+        list(dbobj.query_columns(colnames=self.colnames, constraint='ra < 200.0', chunk_size=500))
+
+        subset = ['id', 'umag', 'raJ2000']
+        control = next(queryCacheTestStars(database=self.db_name).query_columns(colnames=subset,
+                                                                                constraint='ra < 200.0'))
+        cached = dbobj.query_columns(colnames=subset, constraint='ra < 200.0', chunk_size=500)
+        self.assertIsInstance(cached, CachedChunkIterator)
+        test = np.concatenate(list(cached))
+        self.assertEqual(test.dtype, control.dtype)
+        np.testing.assert_array_equal(test, control)
+
+        # a column that is not cached (with widening turned off)
+        self.assertNotIsInstance(dbobj.query_columns(colnames=['id', 'gmag'], constraint='ra < 200.0'),
+                                 CachedChunkIterator)
+
+    def testWiden(self):
+        """
+        Test that a cached result is widened with the columns it is missing
+        """
+        dbobj = queryCacheTestStars(database=self.db_name)
+        dbobj.query_cache = QueryCache(self.cache_dir)
+        list(dbobj.query_columns(colnames=self.colnames, constraint='ra < 200.0', chunk_size=500))
+
+        wider = ['id', 'gmag', 'raJ2000', 'rmag']
+        control = next(queryCacheTestStars(database=self.db_name).query_columns(colnames=wider,
+                                                                                constraint='ra < 200.0'))
+        widened = dbobj.query_columns(colnames=wider, constraint='ra < 200.0', chunk_size=500)
+        self.assertIsInstance(widened, CachedChunkIterator)
+        test = np.concatenate(list(widened))
+        self.assertEqual(test.dtype, control.dtype)
+        np.testing.assert_array_equal(test, control)
+
+        # the widened result replaced the original, and serves both queries
+        self.assertEqual(len(dbobj.query_cache._load_index()), 1)
+        test = next(dbobj.query_columns(colnames=self.colnames, constraint='ra < 200.0'))
+        control = next(queryCacheTestStars(database=self.db_name).query_columns(colnames=self.colnames,
+                                                                                constraint='ra < 200.0'))
+        np.testing.assert_array_equal(test, control)
+
+    def testWidenBounds(self):
+        """
+        Test that a result within circular bounds is widened with the same rows
+        """
+        obs = ObservationMetaData(boundType='circle', pointingRA=100.0, pointingDec=-20.0,
+                                  boundLength=40.0)
+        dbobj = queryCacheTestStars(database=self.db_name)
+        dbobj.query_cache = QueryCache(self.cache_dir)
+        list(dbobj.query_columns(colnames=self.colnames, obs_metadata=obs, chunk_size=500))
+
+        wider = ['id', 'gmag', 'raJ2000', 'rmag']
+        control = next(queryCacheTestStars(database=self.db_name).query_columns(colnames=wider,
+                                                                                obs_metadata=obs))
+        self.assertGreater(len(control), 0)
+        widened = dbobj.query_columns(colnames=wider, obs_metadata=obs, chunk_size=500)
+        self.assertIsInstance(widened, CachedChunkIterator)
+        np.testing.assert_array_equal(np.concatenate(list(widened)), control)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "os.fork is not available")
+    def testProcesses(self):
+        """
+        Test that processes adding results to the same cache at once
+        do not lose each other's entries
+        """
+        n_processes = 4
+        n_queries = 8
+        pids = []
+        for i_process in range(n_processes):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    dbobj = queryCacheTestStars(database=self.db_name)
+                    dbobj.query_cache = QueryCache(self.cache_dir)
+                    for i_query in range(n_queries):
+                        list(dbobj.query_columns(colnames=self.colnames,
+                                                 constraint='id %% %d = %d' % (n_processes*n_queries,
+                                                                               i_process*n_queries + i_query)))
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+
+        cache = QueryCache(self.cache_dir)
+        self.assertEqual(len(cache._load_index()), n_processes*n_queries)
+        self.assertEqual(len([name for name in os.listdir(self.cache_dir)
+                              if name.startswith('entry-')]), n_processes*n_queries)
+        dbobj = queryCacheTestStars(database=self.db_name)
+        dbobj.query_cache = cache
+        cached = dbobj.query_columns(colnames=self.colnames, constraint='id %% %d = 5' % (n_processes*n_queries))
+        self.assertIsInstance(cached, CachedChunkIterator)
+        np.testing.assert_array_equal(next(cached), self.control[self.control['id'] % (n_processes*n_queries) == 5])
+
+    def testInvalidation(self):
+        """
+        Test that cached results are discarded when the schema version
+        or the database file changes
+        """
+        dbobj = queryCacheTestStars(database=self.db_name)
+        dbobj.query_cache = QueryCache(self.cache_dir, schema_version=1)
+        list(dbobj.query_columns(colnames=self.colnames, chunk_size=500))
+        self.assertIsInstance(dbobj.query_columns(colnames=self.colnames), CachedChunkIterator)
+
+        dbobj.query_cache = QueryCache(self.cache_dir, schema_version=2)
+        self.assertNotIsInstance(dbobj.query_columns(colnames=self.colnames), CachedChunkIterator)
+
+        list(dbobj.query_columns(colnames=self.colnames, chunk_size=500))
+        self.assertIsInstance(dbobj.query_columns(colnames=self.colnames), CachedChunkIterator)
+        file_stats = os.stat(self.db_name)
+        os.utime(self.db_name, (file_stats.st_atime, file_stats.st_mtime + 10.0))
+        self.assertNotIsInstance(dbobj.query_columns(colnames=self.colnames), CachedChunkIterator)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
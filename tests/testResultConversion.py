@@ -0,0 +1,186 @@
+from builtins import range
+import unittest
+import decimal
+import numpy as np
+
+import lsst.utils.tests
+from lsst.sims.catalogs.db import rows_to_recarray, ConversionPlan
+from lsst.sims.catalogs.db import get_vocabulary, decode_categorical
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class RowsToRecarrayTestCase(unittest.TestCase):
+    """
+    Test that rows_to_recarray produces exactly what numpy.rec.fromrecords
+    produces
+    """
+
+    def setUp(self):
+        self.rng = np.random.RandomState(8812)
+
+    def assertSameRecarray(self, test, control):
+        self.assertIsInstance(test, np.recarray)
+        self.assertEqual(test.dtype, control.dtype)
+        self.assertEqual(test.tobytes(), control.tobytes())
+
+    def test_mixed_types(self):
+        """
+        Test a mixture of numeric, boolean and string columns
+        """
+        dtype = np.dtype([('id', int), ('ra', float), ('sed', str, 40),
+                          ('mag', float), ('flag', bool), ('n', np.int32),
+                          ('dec', float), ('m32', np.float32)])
+        rows = []
+        for ii in range(200):
+            rows.append((ii, self.rng.random_sample(), 'sed_%d.txt' % ii,
+                         self.rng.random_sample()*20.0, ii % 3 == 0, -ii,
+                         decimal.Decimal('%.4f' % self.rng.random_sample()), 1.0/(ii+1)))
+
+        control = np.rec.fromrecords(rows, dtype=dtype)
+        self.assertSameRecarray(rows_to_recarray(rows, dtype), control)
+
+    def test_nulls(self):
+        """
+        Test that NULLs are handled as numpy.rec.fromrecords handles them
+        """
+        dtype = np.dtype([('id', int), ('a', float), ('b', float), ('s', str, 10)])
+        rows = [(ii, None if ii % 4 == 0 else 0.5*ii, 2.0*ii, None if ii % 5 == 0 else 'word')
+                for ii in range(50)]
+        control = np.rec.fromrecords(rows, dtype=dtype)
+        test = rows_to_recarray(rows, dtype)
+        self.assertSameRecarray(test, control)
+        self.assertTrue(np.isnan(test['a'][0]))
+
+        # NULL in an integer column raises the same error as fromrecords
+        rows[3] = (None, 1.0, 2.0, 'word')
+        with self.assertRaises(TypeError):
+            np.rec.fromrecords(rows, dtype=dtype)
+        with self.assertRaises(TypeError):
+            rows_to_recarray(rows, dtype)
+
+    def test_defaults(self):
+        """
+        Test that defaults replace NULL, zero and empty values exactly as
+        substituting them row by row does
+        """
+        dtype = np.dtype([('id', int), ('a', float), ('n', int), ('s', str, 10), ('b', float)])
+        defaults = {'a': -1.5, 'n': -2, 's': 'none'}
+        rows = [(ii, [None, 0.0, np.nan, 0.5*ii][ii % 4], [None, 0, ii][ii % 3],
+                 [None, '', 'word'][ii % 3], None if ii % 5 == 0 else 0.0)
+                for ii in range(60)]
+        control = np.rec.fromrecords([tuple(row[ii] if row[ii] or name not in defaults
+                                            else defaults[name]
+                                            for ii, name in enumerate(dtype.names))
+                                      for row in rows], dtype=dtype)
+        test = rows_to_recarray(rows, dtype, defaults=defaults)
+        self.assertSameRecarray(test, control)
+        self.assertTrue(np.isnan(test['a'][2]))
+        self.assertEqual(test['n'][0], -2)
+        self.assertEqual(test['s'][1], 'none')
+
+        # NULL in an integer column without a default still fails
+        rows[3] = (None,) + rows[3][1:]
+        with self.assertRaises(TypeError):
+            rows_to_recarray(rows, dtype, defaults=defaults)
+
+    def test_plan(self):
+        """
+        Test that a ConversionPlan can be reused, reads its fields
+        from any positions in the rows, and converts no rows into
+        an empty recarray
+        """
+        dtype = np.dtype([('a', float), ('id', int), ('s', str, 10), ('b', float)])
+        plan = ConversionPlan(dtype, indices=[3, 0, 1, 2], defaults={'s': 'none'})
+        for n_rows in (10, 20):
+            rows = [(ii, [None, '', 'word'][ii % 3], 0.5*ii, self.rng.random_sample(), 'extra')
+                    for ii in range(n_rows)]
+            control = np.rec.fromrecords([(row[3], row[0], row[1] if row[1] else 'none', row[2])
+                                          for row in rows], dtype=dtype)
+            self.assertSameRecarray(plan.convert(rows), control)
+
+        empty = plan.convert([])
+        self.assertIsInstance(empty, np.recarray)
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.dtype, dtype)
+        self.assertEqual(plan.empty().dtype, dtype)
+
+        self.assertRaises(ValueError, ConversionPlan, dtype, indices=[0, 1])
+
+    def test_sized(self):
+        """
+        Test that sized string fields are widened to fit their values (with
+        the defaults applied), never narrow, and that a bytes field which
+        meets a value that is not ASCII raises a ValueError
+        """
+        dtype = np.dtype([('id', int), ('s', str, 2), ('b', 'S', 1)])
+        plan = ConversionPlan(dtype, defaults={'s': 'default'}, sized=['s', 'b'])
+        test = plan.convert([(0, 'abc', 'x'), (1, None, 'yy')])
+        self.assertEqual(str(test.dtype['s']), '<U7')
+        self.assertEqual(str(test.dtype['b']), '|S2')
+        self.assertEqual(list(test['s']), ['abc', 'default'])
+        self.assertEqual(list(test['b']), [b'x', b'yy'])
+        self.assertEqual(plan.dtype, test.dtype)
+
+        # a bytes field never becomes unicode
+        self.assertRaises(ValueError, plan.convert, [(2, 'a', '\u00e9')])
+        self.assertEqual(plan.convert([]).dtype, test.dtype)
+
+        # the fields that are not sized are still truncated
+        test = ConversionPlan(dtype, sized=['b']).convert([(0, 'abc', 'xyz')])
+        self.assertEqual(test['s'][0], 'ab')
+        self.assertEqual(test['b'][0], b'xyz')
+
+    def test_categorical(self):
+        """
+        Test that categorical fields are encoded into a vocabulary which is
+        shared by the chunks converted by a plan, and decode to the strings
+        the fields would otherwise hold
+        """
+        dtype = np.dtype([('id', int), ('sed', str, 20), ('mag', float)])
+        plan = ConversionPlan(dtype, defaults={'sed': 'flat.txt'}, categorical=['sed'])
+        self.assertEqual(plan.dtype['sed'], np.int32)
+        control_plan = ConversionPlan(dtype, defaults={'sed': 'flat.txt'})
+
+        chunks = []
+        for i_chunk in range(3):
+            rows = [(ii, [None, 'sed_%d.txt' % (ii % 7), ''][ii % 3], 0.1*ii)
+                    for ii in range(20*i_chunk, 20*(i_chunk+1))]
+            test = plan.convert(rows)
+            control = control_plan.convert(rows)
+            self.assertIs(get_vocabulary(test['sed']), plan.vocabularies['sed'])
+            np.testing.assert_array_equal(decode_categorical(test['sed']), control['sed'])
+            np.testing.assert_array_equal(test['mag'], control['mag'])
+            chunks.append(test)
+
+        # the codes of the earlier chunks remain valid as the vocabulary grows
+        self.assertEqual(sorted(plan.vocabularies['sed']),
+                         sorted(['flat.txt'] + ['sed_%d.txt' % ii for ii in range(7)]))
+        self.assertEqual(decode_categorical(chunks[0]['sed'])[0], 'flat.txt')
+        np.testing.assert_array_equal(decode_categorical(chunks[0][[4, 1]]['sed'], dtype=object),
+                                      ['sed_4.txt', 'sed_1.txt'])
+
+        # other columns are returned as they are
+        mag = chunks[0]['mag']
+        self.assertIs(decode_categorical(mag), mag)
+
+    def test_empty(self):
+        """
+        Test that no rows gives an empty recarray of the right dtype
+        """
+        dtype = np.dtype([('id', int), ('a', float)])
+        test = rows_to_recarray([], dtype)
+        self.assertIsInstance(test, np.recarray)
+        self.assertEqual(len(test), 0)
+        self.assertEqual(test.dtype, np.rec.fromrecords([(1, 1.0)], dtype=dtype).dtype)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,194 @@
+from __future__ import with_statement
+import os
+import unittest
+import tempfile
+import shutil
+import lsst.utils.tests
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.catalogs.db import SchemaCache
+from lsst.sims.catalogs.utils.testUtils import myTestStars, makeStarTestDB
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class CountingSchemaCache(SchemaCache):
+    """
+    A SchemaCache that counts how many times it reflects a table
+    """
+    n_reflected = 0
+
+    def _reflect(self, connection, tableid):
+        CountingSchemaCache.n_reflected += 1
+        return SchemaCache._reflect(self, connection, tableid)
+
+
+class StubSchemaCache(SchemaCache):
+    """
+    A SchemaCache that makes up the schema of every table, rather than
+    reflecting it, so that it can be given StubConnections
+    """
+
+    def _reflect(self, connection, tableid):
+        return [('id', 'INTEGER', None), ('name', 'VARCHAR', 40)]
+
+
+class StubConnection(object):
+    """
+    Stands in for the DBConnection to a database other than sqlite
+    """
+    driver = 'postgresql'
+    host = 'localhost'
+    port = 5432
+    database = 'catalogs'
+
+
+class schemaCacheTestStars(myTestStars):
+    objid = 'schemaCacheTestStars'
+    driver = 'sqlite'
+
+
+class SchemaCacheTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='SchemaCacheTestCase-')
+        cls.db_name = os.path.join(cls.scratch_dir, 'schemaCacheTestDatabase.db')
+        makeStarTestDB(filename=cls.db_name, size=100, seedVal=31)
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+
+    def setUp(self):
+        self.cache_file = os.path.join(self.scratch_dir, 'schema_cache.json')
+        CountingSchemaCache.n_reflected = 0
+        self.control = schemaCacheTestStars(database=self.db_name)
+        schemaCacheTestStars.schema_cache = CountingSchemaCache(cache_file=self.cache_file)
+
+    def tearDown(self):
+        del schemaCacheTestStars.schema_cache
+        for file_name in (self.cache_file, self.cache_file + '.lock'):
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+    def testLazyReflection(self):
+        """
+        Test that instantiating a CatalogDBObject does not reflect its table,
+        that the table is reflected when it is first used, and that the
+        columns built from the cached schema are the same as without it
+        """
+        dbobj = schemaCacheTestStars(database=self.db_name)
+        self.assertEqual(CountingSchemaCache.n_reflected, 1)
+        self.assertIsNone(dbobj._table)
+        self.assertEqual(list(dbobj.columnMap.items()), list(self.control.columnMap.items()))
+        self.assertEqual(list(dbobj.typeMap.items()), list(self.control.typeMap.items()))
+
+        results = next(dbobj.query_columns(colnames=['id', 'raJ2000', 'umag']))
+        self.assertIsNotNone(dbobj._table)
+        self.assertEqual(len(results), 100)
+
+    def testPersistentCache(self):
+        """
+        Test that the schema is read back from the cache file, so that
+        a new SchemaCache need not reflect the table again, and that
+        invalidating the cache makes it reflect the table again
+        """
+        schemaCacheTestStars(database=self.db_name)
+        schemaCacheTestStars(database=self.db_name)
+        self.assertEqual(CountingSchemaCache.n_reflected, 1)
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        schemaCacheTestStars.schema_cache = CountingSchemaCache(cache_file=self.cache_file)
+        dbobj = schemaCacheTestStars(database=self.db_name)
+        self.assertEqual(CountingSchemaCache.n_reflected, 1)
+        self.assertEqual(list(dbobj.columnMap.items()), list(self.control.columnMap.items()))
+
+        # invalidating another table does nothing
+        dbobj.schema_cache.invalidate(dbobj.connection, 'galaxies')
+        schemaCacheTestStars(database=self.db_name)
+        self.assertEqual(CountingSchemaCache.n_reflected, 1)
+
+        dbobj.schema_cache.invalidate(dbobj.connection, dbobj.tableid)
+        schemaCacheTestStars(database=self.db_name)
+        self.assertEqual(CountingSchemaCache.n_reflected, 2)
+
+        # a different schema_version does not use the cached schemas
+        schemaCacheTestStars.schema_cache = CountingSchemaCache(cache_file=self.cache_file,
+                                                                schema_version=2)
+        schemaCacheTestStars(database=self.db_name)
+        self.assertEqual(CountingSchemaCache.n_reflected, 3)
+
+        dbobj.schema_cache.clear()
+        schemaCacheTestStars.schema_cache = CountingSchemaCache(cache_file=self.cache_file)
+        schemaCacheTestStars(database=self.db_name)
+        self.assertEqual(CountingSchemaCache.n_reflected, 4)
+
+    def testDatabaseChanged(self):
+        """
+        Test that the cached schema of a sqlite table is discarded
+        when the database file changes
+        """
+        schemaCacheTestStars(database=self.db_name)
+        file_stats = os.stat(self.db_name)
+        os.utime(self.db_name, (file_stats.st_atime, file_stats.st_mtime + 10.0))
+        schemaCacheTestStars(database=self.db_name)
+        self.assertEqual(CountingSchemaCache.n_reflected, 2)
+
+    def testOtherDatabases(self):
+        """
+        Test that the cached schemas of databases other than sqlite are only
+        written to the cache file if there is a schema_version to check
+        """
+        cache = StubSchemaCache(cache_file=self.cache_file)
+        self.assertEqual(cache.get_columns(StubConnection(), 'stars'),
+                         [('id', 'INTEGER'), ('name', 'VARCHAR')])
+        self.assertEqual(len(cache._entries), 1)
+        self.assertEqual(cache._load(), {})
+
+        cache = StubSchemaCache(cache_file=self.cache_file, schema_version=1)
+        cache.get_columns(StubConnection(), 'stars')
+        self.assertEqual(len(cache._load()), 1)
+        cache.invalidate(StubConnection())
+        self.assertEqual(cache._load(), {})
+
+    def testProcesses(self):
+        """
+        Test that processes adding entries to the same cache file at once
+        do not lose each other's entries
+        """
+        n_processes = 4
+        n_tables = 20
+        pids = []
+        for i_process in range(n_processes):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    cache = StubSchemaCache(cache_file=self.cache_file, schema_version=1)
+                    for i_table in range(n_tables):
+                        cache.get_columns(StubConnection(), 'table_%d_%d' % (i_process, i_table))
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+
+        self.assertEqual(len(SchemaCache(cache_file=self.cache_file)._load()), n_processes*n_tables)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,207 @@
+from __future__ import with_statement
+from builtins import range
+import os
+import sqlite3
+import unittest
+import tempfile
+import shutil
+import numpy as np
+import lsst.utils.tests
+from lsst.sims.utils.CodeUtilities import sims_clean_up
+from lsst.sims.utils import ObservationMetaData, haversine
+from lsst.sims.catalogs.db import CatalogDBObject, fileDBObject, HtmIndex, RTreeIndex, findHtmid
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class spatialIndexNonsenseDB(CatalogDBObject):
+    objid = 'spatialIndexNonsense'
+    tableid = 'test'
+    idColKey = 'NonsenseId'
+    driver = 'sqlite'
+    raColName = 'ra'
+    decColName = 'dec'
+    columns = [('NonsenseId', 'id', int),
+               ('NonsenseRaJ2000', 'ra*%f'%(np.pi/180.)),
+               ('NonsenseDecJ2000', 'dec*%f'%(np.pi/180.)),
+               ('NonsenseMag', 'mag', float)]
+
+
+class htmNonsenseDB(spatialIndexNonsenseDB):
+    objid = 'htmNonsense'
+    spatialIndex = HtmIndex(level=8)
+
+
+class rtreeNonsenseDB(spatialIndexNonsenseDB):
+    objid = 'rtreeNonsense'
+    spatialIndex = RTreeIndex()
+
+
+class rtreeNonsenseFileDB(fileDBObject):
+    objid = 'rtreeFileNonsense'
+    tableid = 'test'
+    idColKey = 'NonsenseId'
+    raColName = 'ra'
+    decColName = 'dec'
+    spatialIndex = RTreeIndex()
+    columns = [('NonsenseId', 'id', int),
+               ('NonsenseRaJ2000', 'ra*%f'%(np.pi/180.)),
+               ('NonsenseDecJ2000', 'dec*%f'%(np.pi/180.)),
+               ('NonsenseMag', 'mag', float)]
+
+
+class SpatialIndexTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='SpatialIndexTestCase-')
+        cls.data_file = os.path.join(ROOT, 'testData', 'CatalogsGenerationTestData.txt')
+        cls.db_name = os.path.join(cls.scratch_dir, 'spatialIndexTestDB.db')
+        conn = sqlite3.connect(cls.db_name)
+        c = conn.cursor()
+        c.execute('''CREATE TABLE test (id int, ra real, dec real, mag real)''')
+        with open(cls.data_file, 'r') as inFile:
+            for line in inFile:
+                values = line.split()
+                c.execute('''INSERT INTO test VALUES (%s, %s, %s, %s)''' %
+                          (values[0], values[1], values[2], values[3]))
+        conn.commit()
+        conn.close()
+
+        cls.htm_db_name = os.path.join(cls.scratch_dir, 'spatialIndexHtmDB.db')
+        shutil.copyfile(cls.db_name, cls.htm_db_name)
+        dbobj = htmNonsenseDB(database=cls.htm_db_name)
+        dbobj.spatialIndex.build(dbobj.connection, 'test', 'ra', 'dec', 'id')
+
+        cls.rtree_db_name = os.path.join(cls.scratch_dir, 'spatialIndexRTreeDB.db')
+        shutil.copyfile(cls.db_name, cls.rtree_db_name)
+        dbobj = rtreeNonsenseDB(database=cls.rtree_db_name)
+        dbobj.spatialIndex.build(dbobj.connection, 'test', 'ra', 'dec', 'id')
+
+    @classmethod
+    def tearDownClass(cls):
+        sims_clean_up()
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+
+    def testHtmid(self):
+        """
+        Test that trixel ids are consistent between levels, and that
+        the trixels covering a circle include those of the points in it
+        """
+        rng = np.random.RandomState(88)
+        ra = rng.random_sample(1000)*360.0
+        dec = np.degrees(np.arcsin(rng.random_sample(1000)*2.0 - 1.0))
+
+        htmid = findHtmid(ra, dec, 6)
+        self.assertEqual(htmid.min() >> 12, 8)
+        self.assertEqual(htmid.max() >> 12, 15)
+        np.testing.assert_array_equal(findHtmid(ra, dec, 5), htmid >> 2)
+        np.testing.assert_array_equal(findHtmid(ra, dec, 0), htmid >> 12)
+        self.assertEqual(findHtmid(ra[3], dec[3], 6)[0], htmid[3])
+
+        index = HtmIndex(level=6)
+        for ra_center, dec_center, radius in ((10.0, 85.0, 10.0), (200.0, -30.0, 2.0),
+                                              (359.0, 0.0, 20.0), (90.0, 10.0, 120.0)):
+            distance = haversine(np.radians(ra), np.radians(dec),
+                                 np.radians(ra_center), np.radians(dec_center))
+            ranges = index.get_ranges(np.radians(ra_center), np.radians(dec_center), np.radians(radius))
+            covered = np.zeros(len(htmid), dtype=bool)
+            for low, high in ranges:
+                covered |= (htmid >= low) & (htmid <= high)
+            self.assertTrue(covered[distance <= np.radians(radius)].all())
+            self.assertLess(covered.sum(), len(htmid))
+
+    def testHtmBuildInChunks(self):
+        """
+        Test that HtmIndex.build gives every row its trixel id when it reads
+        and updates the rows a few at a time, including when it is rebuilt,
+        both by rowid and by joining on the id column
+        """
+        for uses_rowid in (True, False):
+            db_name = os.path.join(self.scratch_dir, 'spatialIndexHtmChunkDB_%d.db' % uses_rowid)
+            shutil.copyfile(self.db_name, db_name)
+            dbobj = htmNonsenseDB(database=db_name)
+            index = HtmIndex(level=8)
+            index.chunk_size = 7
+            index._uses_rowid = lambda engine: uses_rowid
+            for _ in range(2):
+                index.build(dbobj.connection, 'test', 'ra', 'dec', 'id')
+                rows = np.array(dbobj.execute_arbitrary('SELECT ra, dec, htmid FROM test'))
+                self.assertGreater(len(rows), index.chunk_size)
+                np.testing.assert_array_equal(rows['htmid'], findHtmid(rows['ra'], rows['dec'], 8))
+            self.assertNotIn('test_htmid_tmp', dbobj.connection.get_table_names())
+
+    def testIndexedCircularConstraints(self):
+        """
+        Test that circle and box bounds select the same objects
+        with and without a spatial index
+        """
+        control = spatialIndexNonsenseDB(database=self.db_name)
+        htm = htmNonsenseDB(database=self.htm_db_name)
+        rtree = rtreeNonsenseDB(database=self.rtree_db_name)
+
+        self.assertIsNone(control._spatial_index_SQL(None))
+        unindexed = htmNonsenseDB(database=self.db_name)
+        self.assertFalse(unindexed.spatialIndex.exists(unindexed.connection, 'test'))
+
+        mycolumns = ['NonsenseId', 'NonsenseRaJ2000', 'NonsenseDecJ2000', 'NonsenseMag']
+        for raCenter, decCenter, radius in ((210.0, -60.0, 20.0), (100.0, 70.0, 10.0), (200.0, 0.0, 30.0)):
+            obs = ObservationMetaData(boundType='circle', pointingRA=raCenter, pointingDec=decCenter,
+                                      boundLength=radius, mjd=52000., bandpassName='r')
+            self.assertIsNone(unindexed._spatial_index_SQL(obs.bounds))
+            self.assertIsNotNone(htm._spatial_index_SQL(obs.bounds))
+            self.assertIsNotNone(rtree._spatial_index_SQL(obs.bounds))
+
+            expected = np.concatenate(list(control.query_columns(colnames=mycolumns,
+                                                                 obs_metadata=obs, chunk_size=100)))
+            self.assertGreater(len(expected), 0)
+            for dbobj in (htm, rtree):
+                test = np.concatenate(list(dbobj.query_columns(colnames=mycolumns,
+                                                               obs_metadata=obs, chunk_size=100)))
+                np.testing.assert_array_equal(np.sort(test['NonsenseId']),
+                                              np.sort(expected['NonsenseId']))
+
+        obs = ObservationMetaData(boundType='box', pointingRA=210.0, pointingDec=-60.0,
+                                  boundLength=np.array([10.0, 5.0]), mjd=52000., bandpassName='r')
+        self.assertIsNone(htm._spatial_index_SQL(obs.bounds))
+        expected = np.concatenate(list(control.query_columns(colnames=mycolumns,
+                                                             obs_metadata=obs, chunk_size=100)))
+        self.assertGreater(len(expected), 0)
+        test = np.concatenate(list(rtree.query_columns(colnames=mycolumns,
+                                                       obs_metadata=obs, chunk_size=100)))
+        np.testing.assert_array_equal(np.sort(test['NonsenseId']), np.sort(expected['NonsenseId']))
+
+    def testFileDBObject(self):
+        """
+        Test that fileDBObject builds its spatialIndex when it loads a file
+        """
+        dbobj = rtreeNonsenseFileDB(self.data_file, skipLines=0,
+                                    dtype=np.dtype([('id', int), ('ra', float),
+                                                    ('dec', float), ('mag', float)]))
+        self.assertTrue(dbobj.spatialIndex.exists(dbobj.connection, dbobj.tableid))
+
+        obs = ObservationMetaData(boundType='circle', pointingRA=210.0, pointingDec=-60.0,
+                                  boundLength=20.0, mjd=52000., bandpassName='r')
+        results = np.concatenate(list(dbobj.query_columns(colnames=['NonsenseId', 'NonsenseRaJ2000',
+                                                                    'NonsenseDecJ2000'],
+                                                          obs_metadata=obs)))
+        control = np.genfromtxt(self.data_file, dtype=[('id', int), ('ra', float),
+                                                        ('dec', float), ('mag', float)])
+        distance = haversine(np.radians(control['ra']), np.radians(control['dec']),
+                             np.radians(210.0), np.radians(-60.0))
+        np.testing.assert_array_equal(np.sort(results['NonsenseId']),
+                                      np.sort(control['id'][distance < np.radians(20.0)]))
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()